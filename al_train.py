@@ -0,0 +1,284 @@
+r"""Active learning for object detection with any acquisition strategy of detection.strategies.
+
+One driver for the cycle loop shared by the training scripts: the labeled set is trained on, the unlabeled pool
+is scored with ``--strategy`` and the ``--budget`` best images are acquired, for ``--cycles`` cycles::
+
+    python al_train.py --dataset voc2007 -p /data/VOCdevkit/ --model faster --strategy cald
+
+Training is not data parallel, run it on one GPU. Data loaders (workers included) persist over the cycles and the
+labeled and unlabeled sets are written to ``--state`` after every cycle so that an interrupted run continues
+from the last finished cycle. Learning loss, SSM and VAAL train extra modules next to the detector and are not
+strategies of this driver, run ll_train.py, ssm_train.py or vaal_train.py for them.
+"""
+import datetime
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.utils.data
+
+from detection.frcnn_la import fasterrcnn_resnet50_fpn_feature
+from detection.retinanet_cal import retinanet_resnet50_fpn_cal
+from detection.engine import coco_evaluate, voc_evaluate, train_one_epoch
+from detection import utils
+from detection.train import *
+from detection.train_step import TrainStep
+from detection.persistent_loader import PersistentLoaders
+from detection.incremental import WarmStart, CycleReport
+from detection.strategies import STRATEGIES, get_strategy
+from ll4al.data.sampler import SubsetSequentialSampler
+
+
+def default_sizes(args):
+    """(initial labeled images, images acquired per cycle, pool size) of the training scripts."""
+    if 'voc' in args.dataset:
+        if 'retina' in args.model:
+            return 1000, 500, None
+        return 500, 500, None
+    return 5000, 1000, 10000
+
+
+def create_model(args, num_classes):
+    if 'voc' in args.dataset:
+        min_size, max_size = 600, 1000
+    else:
+        min_size, max_size = 800, 1333
+    if 'faster' in args.model:
+        return fasterrcnn_resnet50_fpn_feature(num_classes=num_classes, min_size=min_size, max_size=max_size)
+    if 'retina' in args.model:
+        return retinanet_resnet50_fpn_cal(num_classes=num_classes, min_size=600, max_size=1000)
+    raise ValueError('unknown model {}'.format(args.model))
+
+
+def score_pool(strategy, task_model, loaders, dataset, pool):
+    """
+    Scores of ``pool`` (dataset indices) in pool order. Every process scores the positions rank::world_size and
+    the shards are gathered, so all processes select from the same scores.
+    """
+    rank, world_size = utils.get_rank(), utils.get_world_size()
+    if world_size > 1:
+        # the processes train their own copy (no DDP), score every shard with the weights of rank 0
+        for t in task_model.state_dict().values():
+            torch.distributed.broadcast(t, 0)
+    positions = np.arange(rank, len(pool), world_size)
+    loader = loaders.sequential(dataset, SubsetSequentialSampler([pool[p] for p in positions]), pin_memory=True)
+    shard = np.asarray(strategy.score(task_model, loader))
+    scores = None
+    for shard_positions, shard_scores in utils.all_gather((positions, shard)):
+        if scores is None:
+            scores = np.zeros((len(pool),) + shard_scores.shape[1:], dtype=shard_scores.dtype)
+        scores[shard_positions] = shard_scores
+    return scores
+
+
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location='cpu')
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy_random'])
+    torch.set_rng_state(state['torch_random'])
+    if state['cuda_random'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda_random'])
+    print('Resuming {} after cycle {} with {} labeled images'.format(path, state['cycle'], len(state['labeled_set'])))
+    return state
+
+
+def save_state(path, cycle, strategy, labeled_set, unlabeled_set, warm_start, report):
+    """Everything a run needs to continue after ``cycle``: the sets, the random states, the warm-start weights
+    of --incremental and the cycles of --cycle-report."""
+    if not path:
+        return
+    utils.save_on_master({'cycle': cycle, 'strategy': strategy.name, 'labeled_set': labeled_set,
+                          'unlabeled_set': unlabeled_set, 'random': random.getstate(),
+                          'numpy_random': np.random.get_state(), 'torch_random': torch.get_rng_state(),
+                          'cuda_random': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                          'warm_start': warm_start.state_dict(), 'report': report.state_dict()}, path)
+
+
+def main(args):
+    torch.cuda.set_device(0)
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    torch.cuda.manual_seed(0)
+    torch.cuda.manual_seed_all(0)
+    utils.init_distributed_mode(args)
+    print(args)
+
+    device = torch.device(args.device)
+
+    # Data loading code
+    print("Loading data")
+    train_split, test_split = ('trainval', 'test') if 'voc2007' in args.dataset else ('train', 'val')
+    dataset, num_classes = get_dataset(args.dataset, train_split, get_transform(True, args.uint8_images),
+                                       args.data_path)
+    dataset_test, _ = get_dataset(args.dataset, test_split, get_transform(train=False), args.data_path)
+    strategy = get_strategy(args.strategy)(args, num_classes)
+    # the sweep strategies score PIL images, augmenting them themselves
+    dataset_pool = get_dataset(args.dataset, train_split, None, args.data_path)[0] if strategy.pil_pool else dataset
+    print("Creating data loaders")
+    init_num, budget_num, pool_size = default_sizes(args)
+    init_num = args.init_num or init_num
+    budget_num = args.budget or budget_num
+    pool_size = args.pool_size or pool_size
+    indices = list(range(len(dataset)))
+    random.shuffle(indices)
+    labeled_set = indices[:init_num]
+    unlabeled_set = indices[init_num:]
+    start_cycle = 0
+    state = load_state(args.state)
+    if state is not None:
+        labeled_set, unlabeled_set = state['labeled_set'], state['unlabeled_set']
+        start_cycle = state['cycle'] + 1
+    test_sampler = torch.utils.data.SequentialSampler(dataset_test)
+    loaders = PersistentLoaders(args.workers)
+    data_loader_test = loaders.sequential(dataset_test, test_sampler)
+    warm_start = WarmStart(args.incremental, args.incremental_epochs, args.incremental_lr_steps, args.new_weight)
+    report = CycleReport(args.cycle_report, args.baseline_report)
+    if state is not None:
+        warm_start.load_state_dict(state['warm_start'])
+        report.load_state_dict(state['report'])
+    train_sampler = warm_start.sampler(labeled_set)
+    first_checkpoint = os.path.join(args.first_checkpoint_path, '{}_{}_1st.pth'.format(
+        args.dataset, 'frcnn' if 'faster' in args.model else 'retinanet'))
+    for cycle in range(start_cycle, args.cycles):
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor,
+                                    pin_memory=args.uint8_images)
+
+        print("Creating model")
+        task_model = create_model(args, num_classes)
+        task_model.to(device)
+        warm_start.load(task_model)
+        start_time = time.time()
+        if cycle == 0 and args.skip:
+            # first cycle of a previous run with the same initial labeled set
+            task_model.load_state_dict(torch.load(first_checkpoint, map_location='cpu')['model'])
+        else:
+            params = [p for p in task_model.parameters() if p.requires_grad]
+            task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum,
+                                             weight_decay=args.weight_decay)
+            train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
+            task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer,
+                                                                     milestones=warm_start.milestones(args.lr_steps),
+                                                                     gamma=args.lr_gamma)
+            if args.test_only:
+                if 'coco' in args.dataset:
+                    coco_evaluate(task_model, data_loader_test)
+                elif 'voc' in args.dataset:
+                    voc_evaluate(task_model, data_loader_test, args.dataset)
+                return
+            print("Start training")
+            total_epochs = warm_start.total_epochs(args.total_epochs)
+            for epoch in range(args.start_epoch, total_epochs):
+                train_one_epoch(task_model, task_optimizer, data_loader, device, epoch, args.print_freq, train_step)
+                task_lr_scheduler.step()
+            if 'coco' in args.dataset:
+                ap = coco_evaluate(task_model, data_loader_test).coco_eval['bbox'].stats[0]
+            else:
+                ap = voc_evaluate(task_model, data_loader_test, args.dataset, path=args.results_path)
+            report.update(cycle, len(labeled_set), ap, time.time() - start_time, warm_start.active)
+            if cycle == 0:
+                utils.save_on_master({'model': task_model.state_dict(), 'args': args}, first_checkpoint)
+        warm_start.save(labeled_set, task_model)
+        if cycle == args.cycles - 1:
+            break
+        random.shuffle(unlabeled_set)
+        pool = unlabeled_set[:pool_size] if pool_size else unlabeled_set
+        print("Scoring {} unlabeled images with {}".format(len(pool), strategy.name))
+        strategy.prepare(loaders, dataset_pool, labeled_set)
+        scores = score_pool(strategy, task_model, loaders, dataset_pool, pool)
+        selected = set(pool[i] for i in strategy.select(scores, budget_num))
+        # Update the labeled dataset and the unlabeled dataset, respectively
+        labeled_set += sorted(selected)
+        unlabeled_set = [i for i in unlabeled_set if i not in selected]
+        save_state(args.state, cycle, strategy, labeled_set, unlabeled_set, warm_start, report)
+        # Create a new dataloader for the updated labeled dataset
+        train_sampler = warm_start.sampler(labeled_set)
+        total_time_str = str(datetime.timedelta(seconds=int(time.time() - start_time)))
+        print('Cycle time {}'.format(total_time_str))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-p', '--data-path', default='/data/yuweiping/coco/', help='dataset path')
+    parser.add_argument('--dataset', default='voc2007', help='dataset')
+    parser.add_argument('--model', default='fasterrcnn_resnet50_fpn', help='model')
+    parser.add_argument('--strategy', default='cald', choices=sorted(STRATEGIES), help='acquisition strategy')
+    parser.add_argument('--augs', default='FCDR', help='CALD augmentations: F(lip), C(ut out), D(own-scale), '
+                                                       'R(otation), G(aussian noise), S(alt and pepper)')
+    parser.add_argument('--bp', default=1.3, type=float, help='CALD base point')
+    parser.add_argument('-mr', default=1.2, type=float, help='mutual range: CALD balances the classes of the '
+                                                             'mr x budget least consistent images')
+    parser.add_argument('-m', '--no-mutual', help='CALD without the class balancing', action='store_true')
+    parser.add_argument('-u', '--uniform', help='CALD balances the classes towards uniform', action='store_true')
+    parser.add_argument('--init-num', default=None, type=int, help='initially labeled images')
+    parser.add_argument('--budget', default=None, type=int, help='images acquired per cycle')
+    parser.add_argument('--pool-size', default=None, type=int,
+                        help='unlabeled images scored per cycle (default: all, 10000 on coco)')
+    parser.add_argument('--scoring-profile', action='store_true',
+                        help='score the pool with fewer proposals and detections, see SCORING_PROFILE')
+    parser.add_argument('--state', default=None,
+                        help='file keeping the labeled set after every cycle, a run continues from it if it exists')
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('-b', '--batch-size', default=4, type=int,
+                        help='images per training batch')
+    parser.add_argument('-cp', '--first-checkpoint-path', default='/data/yuweiping/',
+                        help='path to save checkpoint of first cycle')
+    parser.add_argument('-e', '--total_epochs', default=20, type=int, metavar='N',
+                        help='number of total epochs to run')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='warm-start every cycle from the previous cycle and fine-tune on a short schedule')
+    parser.add_argument('--incremental-epochs', default=5, type=int, help='epochs per cycle in incremental mode')
+    parser.add_argument('--incremental-lr-steps', default=[4], nargs='+', type=int,
+                        help='decrease lr at these epochs in incremental mode')
+    parser.add_argument('--new-weight', default=3.0, type=float,
+                        help='relative sampling weight of newly acquired images in incremental mode')
+    parser.add_argument('--cycle-report', default=None, help='path of a json file to save per-cycle mAP and time')
+    parser.add_argument('--baseline-report', default=None,
+                        help='per-cycle report of a from-scratch run to compare against')
+    parser.add_argument('--cycles', default=7, type=int, metavar='N',
+                        help='number of cycles epochs to run')
+    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                        help='number of data loading workers (default: 4)')
+    parser.add_argument('--lr', default=0.0025, type=float,
+                        help='initial learning rate, 0.02 is the default value for training '
+                             'on 8 gpus and 2 images_per_gpu')
+    parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
+                        help='momentum')
+    parser.add_argument('--wd', '--weight-decay', default=1e-4, type=float,
+                        metavar='W', help='weight decay (default: 1e-4)',
+                        dest='weight_decay')
+    parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
+    parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
+    parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--uint8-images', action='store_true',
+                        help='keep training images uint8 up to the device, where they are converted to float')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
+    parser.add_argument('--output-dir', default=None, help='path where to save')
+    parser.add_argument('-rp', '--results-path', default='results',
+                        help='path to save detection results (only for voc)')
+    parser.add_argument('--start_epoch', default=0, type=int, help='start epoch')
+    parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
+    parser.add_argument("--test-only", dest="test_only", help="Only test the model", action="store_true")
+    parser.add_argument('-s', "--skip", dest="skip", help="Skip first cycle and use pretrained model to save time",
+                        action="store_true")
+    # distributed training parameters
+    parser.add_argument('--world-size', default=1, type=int,
+                        help='number of distributed processes')
+    parser.add_argument('--dist-url', default='env://', help='url used to set up distributed training')
+
+    args = parser.parse_args()
+
+    if args.output_dir:
+        utils.mkdir(args.output_dir)
+
+    main(args)
@@ -0,0 +1,82 @@
+r"""Import time of the training scripts and detection modules, i.e. the startup cost of a job before any work.
+
+Every module is imported --repeat times in a fresh interpreter (``python -X importtime``) from the repository
+root. The report gives the best wall time and the packages with the largest cumulative import time, so a
+heavy dependency pulled in at module level shows up at the top::
+
+    python -m benchmarks.import_time --output import_time.json
+    python -m benchmarks.import_time --modules lt_c_train detection.acquisition --top 5
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['detection.acquisition', 'detection.train', 'cald_train', 'll_train', 'ls_c_train', 'lt_c_train',
+           'random_train', 'xuyang_lt_c_train']
+
+
+def parse_importtime(stderr, module):
+    """{package: cumulative seconds} of the imports made directly by ``module`` in ``python -X importtime`` output."""
+    packages, children = {}, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            # header line
+            continue
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = children.get(name.strip(), 0) + int(cumulative) / 1e6
+        elif depth == 0:
+            # a module is reported after everything it imported
+            if name.strip() == module:
+                packages = children
+            children = {}
+    return packages
+
+
+def time_import(module, repeat):
+    best, packages, error = None, {}, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=ROOT,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = time.perf_counter() - start
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1]
+            break
+        if best is None or elapsed < best:
+            best, packages = elapsed, parse_importtime(proc.stderr, module)
+    return best, packages, error
+
+
+def main(args):
+    results = []
+    for module in args.modules:
+        seconds, packages, error = time_import(module, args.repeat)
+        top = sorted(packages.items(), key=lambda kv: -kv[1])[:args.top]
+        results.append(dict(module=module, seconds=seconds, error=error, top_imports=top))
+        if error is not None:
+            print('{}: failed ({})'.format(module, error))
+            continue
+        print('{}: {:.2f} s | '.format(module, seconds) + ', '.join('{} {:.2f} s'.format(n, s) for n, s in top))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(python=sys.version, args=vars(args), results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', default=MODULES, nargs='+', help='modules to import')
+    parser.add_argument('--repeat', default=3, type=int, help='imports per module, the fastest counts')
+    parser.add_argument('--top', default=8, type=int, help='largest imports listed per module')
+    parser.add_argument('--output', default=None, help='json file for the results')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,120 @@
+r"""Ranking correlation versus throughput of acquisition scoring under lowered detector settings.
+
+Scores the same pool images with the full test-time settings of the detector and with every setting of
+--profiles (detection.acquisition.inference_profile), then reports images/s, the Spearman and Kendall rank
+correlation of every strategy's scores with the full-setting scores, and the overlap of the selected budget.
+Every run reseeds the random augmentations, so all settings see the same views::
+
+    python -m benchmarks.scoring_profile --dataset voc2007 -p /data/VOCdevkit/ \
+        --checkpoint /data/voc2007_frcnn_1st.pth --num-images 500 --budget 100
+"""
+import json
+import random
+import time
+
+import numpy as np
+import scipy.stats
+import torch
+from torch.utils.data import DataLoader
+
+from detection import utils
+from detection.acquisition import AcquisitionSweep, SCORING_PROFILE, inference_profile
+from detection.frcnn_la import fasterrcnn_resnet50_fpn_feature
+from detection.retinanet_cal import retinanet_resnet50_fpn_cal
+from detection.train import get_dataset
+from ll4al.data.sampler import SubsetSequentialSampler
+
+PROFILE_KEYS = ('rpn_pre_nms_top_n', 'rpn_post_nms_top_n', 'detections_per_img', 'topk_candidates')
+
+
+def parse_profile(text):
+    """'pre:post:dets:topk', with '-' for settings to leave unchanged."""
+    values = [None if v == '-' else int(v) for v in text.split(':')]
+    return dict(zip(PROFILE_KEYS, values))
+
+
+def score(task_model, loader, num_classes, augs, profile, seed):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    sweep = AcquisitionSweep(task_model, num_classes, augs, strategies=('cald', 'ls_c', 'lt_c'))
+    with inference_profile(task_model, **profile):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        sweep.run(loader)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return sweep, sweep.num_images / (time.time() - start)
+
+
+def main(args):
+    print(args)
+    device = torch.device(args.device)
+    dataset, num_classes = get_dataset(args.dataset, "trainval" if 'voc2007' in args.dataset else "train", None,
+                                       args.data_path)
+    pool = list(range(len(dataset)))
+    random.Random(0).shuffle(pool)
+    pool = pool[:args.num_images]
+    loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(pool), num_workers=args.workers,
+                        collate_fn=utils.collate_fn)
+
+    min_size, max_size = (600, 1000) if 'voc' in args.dataset else (800, 1333)
+    if 'faster' in args.model:
+        task_model = fasterrcnn_resnet50_fpn_feature(num_classes=num_classes, min_size=min_size, max_size=max_size)
+    else:
+        task_model = retinanet_resnet50_fpn_cal(num_classes=num_classes, min_size=min_size, max_size=max_size)
+    if args.checkpoint:
+        task_model.load_state_dict(torch.load(args.checkpoint, map_location='cpu')['model'])
+    task_model.to(device)
+
+    # warm up cudnn and the allocator
+    score(task_model, [batch for _, batch in zip(range(args.warmup), loader)], num_classes, args.augs, {}, 0)
+    reference, reference_speed = score(task_model, loader, num_classes, args.augs, {}, args.seed)
+    reference_selections = reference.selections(args.budget)
+    print('full settings: {:.2f} img/s'.format(reference_speed))
+
+    results = [dict(profile='full', img_per_s=reference_speed)]
+    for text in args.profiles:
+        profile = parse_profile(text)
+        sweep, speed = score(task_model, loader, num_classes, args.augs, profile, args.seed)
+        result = dict(profile=text, settings=profile, img_per_s=speed, speedup=speed / reference_speed)
+        selections = sweep.selections(args.budget)
+        for strategy, scores in sweep.scores.items():
+            result[strategy] = dict(
+                spearman=float(scipy.stats.spearmanr(reference.scores[strategy], scores)[0]),
+                kendall=float(scipy.stats.kendalltau(reference.scores[strategy], scores)[0]),
+                overlap=len(set(reference_selections[strategy]) & set(selections[strategy])) / float(args.budget))
+        results.append(result)
+        print('{}: {:.2f} img/s ({:.2f}x) | '.format(text, speed, speed / reference_speed) + ' | '.join(
+            '{} spearman {:.3f} kendall {:.3f} overlap {:.3f}'.format(s, r['spearman'], r['kendall'], r['overlap'])
+            for s, r in ((s, result[s]) for s in sweep.scores)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--data-path', default='/data/yuweiping/coco/', help='dataset path')
+    parser.add_argument('--dataset', default='voc2007', help='dataset')
+    parser.add_argument('--model', default='fasterrcnn_resnet50_fpn', help='model')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint of a trained cycle ({"model": state_dict})')
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('-j', '--workers', default=4, type=int, help='number of data loading workers')
+    parser.add_argument('--num-images', default=500, type=int, help='number of pool images to score')
+    parser.add_argument('--budget', default=100, type=int, help='images selected per strategy')
+    parser.add_argument('--augs', default=['flip', 'cut_out', 'smaller_resize', 'rotation'], nargs='+',
+                        help='CALD augmentations')
+    parser.add_argument('--profiles', nargs='+',
+                        default=[':'.join(str(SCORING_PROFILE[k]) for k in PROFILE_KEYS),
+                                 '1000:500:50:-', '250:150:50:100', '100:100:30:50'],
+                        help='pre-NMS proposals:post-NMS proposals:detections per image:candidates per class, '
+                             '- keeps a setting')
+    parser.add_argument('--warmup', default=10, type=int, help='images scored before timing')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the random augmentations')
+    parser.add_argument('--output', default=None, help='json file for the results')
+
+    args = parser.parse_args()
+    main(args)
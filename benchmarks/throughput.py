@@ -0,0 +1,451 @@
+r"""Throughput of training and acquisition on synthetic VOC-like data, on CPU, without datasets or checkpoints.
+
+Every benchmark runs at every pool size and reports images/s:
+
+    train           training iterations (forward, backward, TrainStep) of a randomly initialised detector
+    get_uncertainty CALD consistency scoring of cald_train.get_uncertainty
+    cls_kldiv       class-distribution matching of cald_train.cls_kldiv over synthetic class scores
+    diversity       detection.acquisition.diversity_select over random embeddings
+    voc_eval        detection.voc_eval.voc_eval of all classes, annotations and detections written as VOC files
+    coco_eval       CocoEvaluator and CocoBboxEvaluator (update, accumulate, summarize); fails unless their
+                    stats, precision and recall agree within 1e-4
+    voc_evaluate    detection.engine.voc_evaluate of a VOC devkit tree and of its packed copy (detection.packed_store);
+                    fails unless both give the same mAP, which needs every class in the pool
+
+The detector benchmarks (train, get_uncertainty) run at --model-pool-sizes, voc_evaluate at --voc-pool-sizes and
+the others at --pool-sizes::
+
+    python -m benchmarks.throughput --output throughput.json
+    python -m benchmarks.throughput --benchmarks diversity cls_kldiv --pool-sizes 1000 10000 50000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.transforms.functional as F
+from PIL import Image
+
+BENCHMARKS = ('train', 'get_uncertainty', 'cls_kldiv', 'diversity', 'voc_eval', 'coco_eval', 'voc_evaluate')
+MODEL_BENCHMARKS = ('train', 'get_uncertainty')
+
+
+class SyntheticDetection(torch.utils.data.Dataset):
+    """
+    VOC-like images: random noise with a few filled rectangles, the ground truth boxes, and their targets in the
+    format of ConvertVOCtoCOCO. Sample ``idx`` is the same for a given ``seed`` whatever was generated before.
+    """
+
+    def __init__(self, num_images, num_classes=21, height=240, width=320, max_objects=4, seed=0, transforms=None):
+        self.num_images = num_images
+        self.num_classes = num_classes
+        self.height = height
+        self.width = width
+        self.max_objects = max_objects
+        self.seed = seed
+        self._transforms = transforms
+
+    def __len__(self):
+        return self.num_images
+
+    def get_target(self, idx):
+        rng = np.random.RandomState(self.seed + idx)
+        num_objects = rng.randint(1, self.max_objects + 1)
+        x = np.sort(rng.uniform(0, self.width, (num_objects, 2)), 1)
+        y = np.sort(rng.uniform(0, self.height, (num_objects, 2)), 1)
+        # at least 16 pixels on a side
+        x[:, 1] = np.minimum(np.maximum(x[:, 1], x[:, 0] + 16), self.width)
+        x[:, 0] = np.minimum(x[:, 0], x[:, 1] - 16)
+        y[:, 1] = np.minimum(np.maximum(y[:, 1], y[:, 0] + 16), self.height)
+        y[:, 0] = np.minimum(y[:, 0], y[:, 1] - 16)
+        boxes = torch.as_tensor(np.stack([x[:, 0], y[:, 0], x[:, 1], y[:, 1]], 1).round(), dtype=torch.float32)
+        return {'boxes': boxes,
+                'labels': torch.as_tensor(rng.randint(1, self.num_classes, num_objects), dtype=torch.int64),
+                'image_id': torch.tensor([idx]),
+                'area': (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]),
+                'iscrowd': torch.zeros(num_objects, dtype=torch.int64)}
+
+    def __getitem__(self, idx):
+        target = self.get_target(idx)
+        rng = np.random.RandomState(self.seed + idx)
+        image = rng.randint(0, 256, (self.height, self.width, 3), dtype=np.uint8)
+        for box, label in zip(target['boxes'].int().tolist(), target['labels'].tolist()):
+            image[box[1]:box[3], box[0]:box[2]] = (label * 37 % 256, label * 91 % 256, label * 53 % 256)
+        image = Image.fromarray(image)
+        if self._transforms is not None:
+            image, target = self._transforms(image, target)
+        return image, target
+
+
+def synthetic_predictions(dataset, idx, num_false=6):
+    """Detections of image ``idx``: its ground truth boxes jittered, plus ``num_false`` random boxes."""
+    target = dataset.get_target(idx)
+    rng = np.random.RandomState(dataset.seed + idx + 1000003)
+    boxes = target['boxes'].numpy() + rng.normal(0, 4, target['boxes'].shape)
+    xy = np.sort(rng.uniform(0, min(dataset.width, dataset.height), (num_false, 2, 2)), 1)
+    boxes = np.concatenate([boxes, xy.transpose(0, 2, 1).reshape(-1, 4)[:, [0, 2, 1, 3]]])
+    boxes = np.clip(boxes, 0, [dataset.width, dataset.height, dataset.width, dataset.height])
+    labels = np.concatenate([target['labels'].numpy(), rng.randint(1, dataset.num_classes, num_false)])
+    return {'boxes': torch.as_tensor(boxes, dtype=torch.float32), 'labels': torch.as_tensor(labels),
+            'scores': torch.as_tensor(rng.uniform(0, 1, len(boxes)), dtype=torch.float32)}
+
+
+class ReplayDetector(torch.nn.Module):
+    """Detects synthetic_predictions of the images in the order they are evaluated."""
+
+    def __init__(self, dataset):
+        super(ReplayDetector, self).__init__()
+        self.dataset = dataset
+        self.next = 0
+
+    def forward(self, images):
+        outputs = [synthetic_predictions(self.dataset, self.next + i) for i in range(len(images))]
+        self.next += len(images)
+        return outputs
+
+
+def create_model(name, num_classes, min_size, max_size, score_thresh):
+    """Randomly initialised detector; ``score_thresh`` is lowered so that it detects anything at all."""
+    if name == 'faster':
+        from detection.frcnn_la import fasterrcnn_resnet50_fpn_feature
+        model = fasterrcnn_resnet50_fpn_feature(num_classes=num_classes, pretrained_backbone=False,
+                                                min_size=min_size, max_size=max_size)
+        model.roi_heads.score_thresh = score_thresh
+        return model
+    if name == 'retina':
+        from detection.retinanet_cal import retinanet_resnet50_fpn_cal
+        model = retinanet_resnet50_fpn_cal(num_classes=num_classes, pretrained_backbone=False,
+                                           min_size=min_size, max_size=max_size)
+    elif name == 'retina_mobilenet':
+        from detection.retinanet_cal import retinanet_mobilenet
+        model = retinanet_mobilenet(num_classes=num_classes, pretrained_backbone=False,
+                                    min_size=min_size, max_size=max_size)
+    else:
+        raise ValueError('unknown model {}'.format(name))
+    model.score_thresh = score_thresh
+    return model
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_train(args, model, dataset, pool_size, device):
+    from detection.train_step import TrainStep
+
+    samples = [dataset[i] for i in range(pool_size)]
+    batches = [([F.to_tensor(image).to(device) for image, _ in samples[b:b + args.batch_size]],
+                [{k: v.to(device) for k, v in target.items()} for _, target in samples[b:b + args.batch_size]])
+               for b in range(0, pool_size, args.batch_size)]
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=1e-4, momentum=0.9, weight_decay=1e-4)
+    train_step = TrainStep(optimizer, device, args.amp)
+
+    def run(batches):
+        model.train()
+        train_step.start_epoch(None, args.print_freq, len(batches))
+        for images, targets in batches:
+            with train_step.autocast():
+                losses = sum(loss for loss in model(images, targets).values())
+            train_step(losses, loss=losses)
+
+    run(batches[:args.warmup])
+    return timed(run, batches)
+
+
+def bench_get_uncertainty(args, model, dataset, pool_size):
+    import cald_train
+
+    # get_uncertainty reads the base point from the script's arguments
+    cald_train.args = argparse.Namespace(bp=args.bp, uniform=False)
+    loader = [([dataset[i][0]], [None]) for i in range(pool_size)]
+    with quiet():
+        random.seed(args.seed)
+        cald_train.get_uncertainty(model, loader[:args.warmup], args.augs, dataset.num_classes)
+        random.seed(args.seed)
+        return timed(cald_train.get_uncertainty, model, loader, args.augs, dataset.num_classes)
+
+
+def bench_cls_kldiv(args, dataset, pool_size):
+    import cald_train
+
+    cald_train.args = argparse.Namespace(bp=args.bp, uniform=False)
+    rng = np.random.RandomState(args.seed)
+    cls_corrs = rng.uniform(0, 1, (pool_size, dataset.num_classes - 1)) * (rng.uniform(0, 1, (pool_size, 1)) > 0.05)
+    labeled_loader = [(None, [dataset.get_target(i) for i in range(b, b + 4)]) for b in range(0, args.labeled, 4)]
+    return timed(cald_train.cls_kldiv, labeled_loader, list(cls_corrs), min(args.budget, pool_size), 0)
+
+
+def bench_diversity(args, pool_size, device):
+    from detection.acquisition import diversity_select
+
+    rng = np.random.RandomState(args.seed)
+    embeddings = torch.as_tensor(rng.normal(0, 1, (pool_size, args.embedding_dim)), dtype=torch.float32).to(device)
+    uncertainty = torch.as_tensor(rng.uniform(0, 1, pool_size), dtype=torch.float32).to(device)
+    return timed(diversity_select, min(args.budget, pool_size), embeddings, args.block_size, uncertainty)
+
+
+def write_voc_files(dataset, pool_size, root, classes):
+    """VOC annotation xmls, the image set file and one detection file per class, as _write_voc_results_file."""
+    os.makedirs(os.path.join(root, 'Annotations'))
+    names = ['{:06d}'.format(i) for i in range(pool_size)]
+    dets = {c: [] for c in classes}
+    for idx, name in enumerate(names):
+        target = dataset.get_target(idx)
+        objects = ''.join(
+            '<object><name>{}</name><difficult>0</difficult><bndbox><xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax>'
+            '<ymax>{}</ymax></bndbox></object>'.format(classes[label - 1], *box)
+            for box, label in zip(target['boxes'].int().tolist(), target['labels'].tolist()))
+        with open(os.path.join(root, 'Annotations', name + '.xml'), 'w') as f:
+            f.write('<annotation><size><width>{}</width><height>{}</height></size>{}</annotation>'.format(
+                dataset.width, dataset.height, objects))
+        prediction = synthetic_predictions(dataset, idx)
+        for box, label, score in zip(prediction['boxes'].tolist(), prediction['labels'].tolist(),
+                                     prediction['scores'].tolist()):
+            dets[classes[label - 1]].append('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(name, score, *box))
+    with open(os.path.join(root, 'test.txt'), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    for c in classes:
+        with open(os.path.join(root, 'det_{}.txt'.format(c)), 'w') as f:
+            f.writelines(dets[c])
+
+
+def bench_voc_eval(args, dataset, pool_size):
+    from detection.voc_eval import voc_eval
+
+    classes = ['class{}'.format(i) for i in range(1, dataset.num_classes)]
+    root = tempfile.mkdtemp(prefix='voc_eval_')
+    try:
+        write_voc_files(dataset, pool_size, root, classes)
+
+        def run():
+            for c in classes:
+                voc_eval(c, os.path.join(root, 'det_{}.txt'), os.path.join(root, 'test.txt'),
+                         os.path.join(root, 'Annotations', '{}.xml'), use_07_metric=True)
+
+        return timed(run)
+    finally:
+        shutil.rmtree(root)
+
+
+def write_voc_devkit(dataset, pool_size, root, classes):
+    """A VOCdevkit/VOC2007 tree of the first ``pool_size`` images, with 1-based xml boxes and a test image set."""
+    voc = os.path.join(root, 'VOCdevkit', 'VOC2007')
+    for d in ('JPEGImages', 'Annotations', os.path.join('ImageSets', 'Main')):
+        os.makedirs(os.path.join(voc, d))
+    names = ['{:06d}'.format(i) for i in range(pool_size)]
+    for idx, name in enumerate(names):
+        image, target = dataset[idx]
+        image.save(os.path.join(voc, 'JPEGImages', name + '.jpg'), quality=95)
+        objects = ''.join(
+            '<object><name>{}</name><difficult>0</difficult><bndbox><xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax>'
+            '<ymax>{}</ymax></bndbox></object>'.format(classes[label], *(v + 1 for v in box))
+            for box, label in zip(target['boxes'].int().tolist(), target['labels'].tolist()))
+        with open(os.path.join(voc, 'Annotations', name + '.xml'), 'w') as f:
+            f.write('<annotation><filename>{}.jpg</filename><size><width>{}</width><height>{}</height></size>{}'
+                    '</annotation>'.format(name, dataset.width, dataset.height, objects))
+    with open(os.path.join(voc, 'ImageSets', 'Main', 'test.txt'), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+
+
+def bench_voc_evaluate(args, dataset, pool_size):
+    """(seconds, mAP) of voc_evaluate over a VOC devkit tree and over its packed copy."""
+    from detection import transforms as T
+    from detection.engine import voc_evaluate
+    from detection.packed_store import get_packed, pack
+    from detection.utils import collate_fn
+    from detection.voc_utils import ConvertVOCtoCOCO, get_voc2007
+
+    if dataset.num_classes > len(ConvertVOCtoCOCO.CLASSES):
+        raise ValueError('voc_evaluate needs --num-classes {} or less'.format(len(ConvertVOCtoCOCO.CLASSES)))
+    root = tempfile.mkdtemp(prefix='voc_evaluate_')
+    # _write_voc_results_file writes to /tmp/<path>
+    path = os.path.basename(root) + '_results'
+    try:
+        write_voc_devkit(dataset, pool_size, root, ConvertVOCtoCOCO.CLASSES)
+        with quiet():
+            pack(get_voc2007(root, 'test', None), os.path.join(root, 'packed', 'test'), num_workers=0)
+        results = {}
+        for variant, voc_dataset in (('VOCDetection', get_voc2007(root, 'test', T.ToTensor())),
+                                     ('PackedDetection', get_packed(os.path.join(root, 'packed'), 'test',
+                                                                    T.ToTensor()))):
+            loader = torch.utils.data.DataLoader(voc_dataset, batch_size=args.batch_size, collate_fn=collate_fn)
+            start = time.perf_counter()
+            with quiet():
+                ap = voc_evaluate(ReplayDetector(dataset), loader, 'voc2007', path=path, device='cpu')
+            results[variant] = time.perf_counter() - start, ap
+        return results
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(os.path.join('/tmp', path), ignore_errors=True)
+
+
+def check_voc_evaluate(results, atol=1e-6):
+    """Raises AssertionError unless the packed dataset evaluates to the mAP of the VOC devkit tree."""
+    expected, actual = results['VOCDetection'][1], results['PackedDetection'][1]
+    if not np.isfinite(expected):
+        raise AssertionError('voc_evaluate mAP is {}, some class has no ground truth in the pool'.format(expected))
+    if not abs(expected - actual) <= atol:
+        raise AssertionError('voc_evaluate mAP of PackedDetection {} differs from VOCDetection {}'.format(
+            actual, expected))
+
+
+def coco_ground_truth(dataset, pool_size):
+    from pycocotools.coco import COCO
+
+    images, annotations = [], []
+    for idx in range(pool_size):
+        target = dataset.get_target(idx)
+        images.append({'id': idx, 'height': dataset.height, 'width': dataset.width})
+        boxes = target['boxes'].clone()
+        boxes[:, 2:] -= boxes[:, :2]
+        for box, label, area in zip(boxes.tolist(), target['labels'].tolist(), target['area'].tolist()):
+            annotations.append({'id': len(annotations) + 1, 'image_id': idx, 'bbox': box, 'category_id': label,
+                                'area': area, 'iscrowd': 0})
+    coco = COCO()
+    coco.dataset = {'images': images, 'annotations': annotations,
+                    'categories': [{'id': i} for i in range(1, dataset.num_classes)]}
+    with quiet():
+        coco.createIndex()
+    return coco
+
+
+def bench_coco_eval(args, dataset, pool_size, evaluator_class):
+    """Seconds of a full evaluation with ``evaluator_class`` and its COCOeval, for check_coco_eval."""
+    coco_gt = coco_ground_truth(dataset, pool_size)
+    predictions = [{idx: synthetic_predictions(dataset, idx) for idx in range(b, min(b + args.batch_size, pool_size))}
+                   for b in range(0, pool_size, args.batch_size)]
+    evaluator = evaluator_class(coco_gt, ['bbox'])
+
+    def run():
+        for batch in predictions:
+            evaluator.update(batch)
+        evaluator.synchronize_between_processes()
+        evaluator.accumulate()
+        evaluator.summarize()
+
+    with quiet():
+        return timed(run), evaluator.coco_eval['bbox']
+
+
+def check_coco_eval(reference, coco_eval, atol=1e-4):
+    """Raises AssertionError unless CocoBboxEvaluator's stats, precision and recall match pycocotools'."""
+    for name, expected, actual in (('stats', reference.stats, coco_eval.stats),
+                                   ('precision', reference.eval['precision'], coco_eval.eval['precision']),
+                                   ('recall', reference.eval['recall'], coco_eval.eval['recall'])):
+        expected, actual = np.asarray(expected), np.asarray(actual)
+        if expected.shape != actual.shape or not np.allclose(expected, actual, rtol=0, atol=atol):
+            diff = np.abs(expected - actual).max() if expected.shape == actual.shape else 'shape'
+            raise AssertionError('CocoBboxEvaluator {} differs from CocoEvaluator by {}'.format(name, diff))
+
+
+def run_benchmark(args, name, model, dataset, pool_size, device):
+    if name == 'train':
+        return {'': bench_train(args, model, dataset, pool_size, device)}
+    if name == 'get_uncertainty':
+        return {'': bench_get_uncertainty(args, model, dataset, pool_size)}
+    if name == 'cls_kldiv':
+        return {'': bench_cls_kldiv(args, dataset, pool_size)}
+    if name == 'diversity':
+        return {'': bench_diversity(args, pool_size, device)}
+    if name == 'voc_eval':
+        return {'': bench_voc_eval(args, dataset, pool_size)}
+    if name == 'coco_eval':
+        from detection.coco_eval import CocoEvaluator, CocoBboxEvaluator
+        reference_seconds, reference = bench_coco_eval(args, dataset, pool_size, CocoEvaluator)
+        seconds, coco_eval = bench_coco_eval(args, dataset, pool_size, CocoBboxEvaluator)
+        check_coco_eval(reference, coco_eval)
+        return {'CocoEvaluator': reference_seconds, 'CocoBboxEvaluator': seconds}
+    if name == 'voc_evaluate':
+        results = bench_voc_evaluate(args, dataset, pool_size)
+        check_voc_evaluate(results)
+        return {variant: seconds for variant, (seconds, ap) in results.items()}
+    raise ValueError('unknown benchmark {}'.format(name))
+
+
+def main(args):
+    print(args)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    height, width = args.image_size
+    num_images = max(args.model_pool_sizes + args.pool_sizes + args.voc_pool_sizes + [args.labeled])
+    dataset = SyntheticDetection(num_images, args.num_classes, height, width, seed=args.seed)
+    results = []
+    for name in args.benchmarks:
+        models = args.models if name in MODEL_BENCHMARKS else [None]
+        pool_sizes = args.model_pool_sizes if name in MODEL_BENCHMARKS else args.pool_sizes
+        if name == 'voc_evaluate':
+            pool_sizes = args.voc_pool_sizes
+        for model_name in models:
+            model = None
+            if model_name is not None:
+                torch.manual_seed(args.seed)
+                model = create_model(model_name, args.num_classes, min(height, width), max(height, width),
+                                     args.score_thresh).to(device)
+            for pool_size in pool_sizes:
+                for variant, seconds in run_benchmark(args, name, model, dataset, pool_size, device).items():
+                    result = dict(benchmark=name, variant=variant or None, model=model_name, pool_size=pool_size,
+                                  seconds=seconds, img_per_s=pool_size / seconds)
+                    results.append(result)
+                    print('{:<16} {:<18} {:<17} pool {:>6}: {:9.3f} s {:12.1f} img/s'.format(
+                        name, variant, model_name or '', pool_size, seconds, pool_size / seconds))
+    if args.output:
+        environment = dict(python=sys.version, platform=platform.platform(), torch=torch.__version__,
+                           numpy=np.__version__, threads=torch.get_num_threads())
+        with open(args.output, 'w') as f:
+            json.dump(dict(environment=environment, args=vars(args), results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmarks', default=list(BENCHMARKS), nargs='+', choices=BENCHMARKS,
+                        help='benchmarks to run')
+    parser.add_argument('--models', default=['faster', 'retina'], nargs='+',
+                        choices=['faster', 'retina', 'retina_mobilenet'], help='detectors of train and get_uncertainty')
+    parser.add_argument('--model-pool-sizes', default=[4, 16], nargs='+', type=int,
+                        help='images of the train and get_uncertainty benchmarks')
+    parser.add_argument('--voc-pool-sizes', default=[100, 400], nargs='+', type=int,
+                        help='images of the voc_evaluate benchmark')
+    parser.add_argument('--pool-sizes', default=[500, 2000, 8000], nargs='+', type=int,
+                        help='images of the other benchmarks')
+    parser.add_argument('--device', default='cpu', help='device')
+    parser.add_argument('--threads', default=0, type=int, help='torch threads, 0 keeps the default')
+    parser.add_argument('--image-size', default=[240, 320], nargs=2, type=int, help='height and width of the images')
+    parser.add_argument('--num-classes', default=21, type=int, help='number of classes including the background')
+    parser.add_argument('-b', '--batch-size', default=2, type=int, help='images per training step and evaluator update')
+    parser.add_argument('--amp', action='store_true', help='train with automatic mixed precision')
+    parser.add_argument('--print-freq', default=1000, type=int, help='TrainStep logging frequency')
+    parser.add_argument('--warmup', default=2, type=int, help='batches (images for get_uncertainty) before timing')
+    parser.add_argument('--score-thresh', default=0.01, type=float,
+                        help='detection score threshold of the randomly initialised detectors')
+    parser.add_argument('--augs', default=['flip', 'cut_out', 'smaller_resize', 'rotation'], nargs='+',
+                        help='CALD augmentations')
+    parser.add_argument('--bp', default=1.3, type=float, help='CALD base point')
+    parser.add_argument('--budget', default=100, type=int, help='images selected by cls_kldiv and diversity')
+    parser.add_argument('--labeled', default=200, type=int, help='labeled images of cls_kldiv')
+    parser.add_argument('--embedding-dim', default=1280, type=int, help='embedding size of diversity')
+    parser.add_argument('--block-size', default=2000, type=int, help='block size of diversity')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic data and the augmentations')
+    parser.add_argument('--output', default=None, help='json file for the results')
+
+    args = parser.parse_args()
+    main(args)
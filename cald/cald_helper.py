@@ -113,7 +113,7 @@ def cutout(image, boxes, labels, cut_num=2, fill_val=0, bbox_remove_thres=0.4, b
         right = left + cutout_size_w
         top = random.uniform(0, original_h - cutout_size_h)
         bottom = top + cutout_size_h
-        cutout = torch.FloatTensor([int(left), int(top), int(right), int(bottom)]).cuda()
+        cutout = torch.FloatTensor([int(left), int(top), int(right), int(bottom)]).to(boxes.device)
 
         # Calculate intersect between cutout and bounding boxes
         overlap_size = intersect(cutout.unsqueeze(0), boxes)
@@ -178,7 +178,7 @@ def rotate(image, boxes, angle):
     corners = torch.stack((x1, y1, x2, y2, x3, y3, x4, y4), dim=1)
     corners.reshape(len(boxes), 8)  # Tensors of dimensions (#objects, 8)
     corners = corners.reshape(-1, 2)  # Tensors of dimension (4* #objects, 2)
-    corners = torch.cat((corners, torch.ones(corners.shape[0], 1).cuda()),
+    corners = torch.cat((corners, torch.ones(corners.shape[0], 1, device=boxes.device)),
                         dim=1)  # (Tensors of dimension (4* #objects, 3))
 
     cos = np.abs(AffineMatrix[0, 0])
@@ -190,7 +190,7 @@ def rotate(image, boxes, angle):
     AffineMatrix[1, 2] += (nH / 2) - cy
 
     # Apply affine transform
-    rotate_corners = torch.mm(AffineMatrix.cuda().float(), corners.t()).t()
+    rotate_corners = torch.mm(AffineMatrix.to(boxes.device).float(), corners.t()).t()
     rotate_corners = rotate_corners.reshape(-1, 8)
 
     x_corners = rotate_corners[:, [0, 2, 4, 6]]
@@ -215,7 +215,7 @@ def rotate(image, boxes, angle):
     new_image = new_image.resize((w, h))
 
     # Resize boxes
-    new_boxes /= torch.Tensor([scale_x, scale_y, scale_x, scale_y]).cuda()
+    new_boxes /= torch.Tensor([scale_x, scale_y, scale_x, scale_y]).to(boxes.device)
     new_boxes[:, 0] = torch.clamp(new_boxes[:, 0], 0, w)
     new_boxes[:, 1] = torch.clamp(new_boxes[:, 1], 0, h)
     new_boxes[:, 2] = torch.clamp(new_boxes[:, 2], 0, w)
@@ -265,10 +265,9 @@ def intersect(boxes1, boxes2):
 #             draw.rectangle(xy=boxes[i])  # , outline=label_color_map[rev_label_map[labels[i]]])
 #     new_image.save('vis/{}.jpg'.format(name))
 
-import matplotlib.pyplot as plt
-
-
 def draw_PIL_image(image, boxes, labels, scores, name):
+    import matplotlib.pyplot as plt
+
     if type(image) != PIL.Image.Image:
         image = F.to_pil_image(image)
     plt.imshow(image)
@@ -293,6 +292,8 @@ def draw_PIL_image(image, boxes, labels, scores, name):
 
 
 def draw_PIL_image_1(image, ref_boxes, boxes, ref_labels, labels, scores, pm, name, no=None):
+    import matplotlib.pyplot as plt
+
     if type(image) != PIL.Image.Image:
         image = F.to_pil_image(image)
     plt.imshow(image)
@@ -329,6 +330,8 @@ def draw_PIL_image_1(image, ref_boxes, boxes, ref_labels, labels, scores, pm, na
 
 
 def draw_PIL_image_2(image, boxes, ref_labels, name, no=None, color='green'):
+    import matplotlib.pyplot as plt
+
     if type(image) != PIL.Image.Image:
         image = F.to_pil_image(image)
     plt.imshow(image)
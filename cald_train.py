@@ -1,14 +1,12 @@
 import datetime
 import os
 import time
+import heapq
 import random
 import math
 import sys
 import numpy as np
 import math
-import scipy.stats
-from scipy.stats import gaussian_kde
-import matplotlib.pyplot as plt
 import pickle
 
 import torch
@@ -29,6 +27,11 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.persistent_loader import PersistentLoaders
+from detection.incremental import WarmStart, CycleReport
+from detection.acquisition import AUG_VIEWS, SCORING_PROFILE, AcquisitionSweep, class_balanced_select, \
+    inference_profile, make_view
 from torchvision.models.detection.faster_rcnn import fasterrcnn_resnet50_fpn
 from torchvision.models.detection.retinanet import retinanet_resnet50_fpn
 from cald.cald_helper import *
@@ -37,9 +40,9 @@ from detection.frcnn_la import fasterrcnn_resnet50_fpn_feature
 from detection.retinanet_cal import retinanet_mobilenet, retinanet_resnet50_fpn_cal
 
 
-def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq, train_step):
     task_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -50,26 +53,15 @@ def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoc
         warmup_iters = min(1000, len(data_loader) - 1)
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
+        images = utils.images_to_device(images, device)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        task_losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
     return metric_logger
 
@@ -88,23 +80,55 @@ def calcu_iou(A, B):
     return iner_area / (Aarea + Barea - iner_area)
 
 
-def get_uncertainty(task_model, unlabeled_loader, augs, num_cls):
+def get_uncertainty(task_model, unlabeled_loader, augs, num_cls, select_num=None):
+    """
+    Consistency of every image over the augmented views of ``augs`` and its mean class scores.
+
+    With ``select_num`` the views of an image are run one at a time and its scoring stops as soon as it can no
+    longer be among the ``select_num`` least consistent images seen so far: every view scores in [0, 1], so after
+    k of n views the consistency is at least sum / n, and once that bound exceeds the select_num-th smallest
+    complete score the image stays outside the selection whatever the remaining views give. Such images keep the
+    bound as their consistency; only the images that can be selected are scored on every view. The random views
+    of every image are drawn from a seed of its own, so skipping views does not change those of the next images
+    and the selection is the one of the full scoring.
+    """
+    import scipy.stats
+
     for aug in augs:
-        if aug not in ['flip', 'multi_ga', 'color_adjust', 'color_swap', 'multi_color_adjust', 'multi_sp', 'cut_out',
-                       'multi_cut_out', 'multi_resize', 'larger_resize', 'smaller_resize', 'rotation', 'ga', 'sp']:
+        if aug not in AUG_VIEWS:
             print('{} is not in the pre-set augmentations!'.format(aug))
+    views = [v for aug in AUG_VIEWS if aug in augs for v in AUG_VIEWS[aug]]
     task_model.eval()
+    device = next(task_model.parameters()).device
+    # max-heap (negated) of the select_num smallest complete consistencies
+    selected = []
+    num_passes = 0
+    num_images = 0
+    base_seed = random.getrandbits(32)
+    random_state, torch_state = random.getstate(), torch.get_rng_state()
+
+    def keep(consistency):
+        if not select_num:
+            return
+        if len(selected) < select_num:
+            heapq.heappush(selected, -consistency)
+        elif consistency < -selected[0]:
+            heapq.heapreplace(selected, -consistency)
+
     with torch.no_grad():
         consistency_all = []
         mean_all = []
         cls_all = []
         for images, _ in unlabeled_loader:
-            torch.cuda.synchronize()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
             # only support 1 batch size
-            aug_images = []
-            aug_boxes = []
             for image in images:
-                output = task_model([F.to_tensor(image).cuda()])
+                random.seed(base_seed + num_images)
+                torch.default_generator.manual_seed(base_seed + num_images)
+                num_images += 1
+                output = task_model([F.to_tensor(image).to(device)])
+                num_passes += 1
                 ref_boxes, prob_max, ref_scores_cls, ref_labels, ref_scores = output[0]['boxes'], output[0][
                     'prob_max'], output[0]['scores_cls'], output[0]['labels'], output[0]['scores']
                 if len(ref_scores) > 40:
@@ -118,75 +142,16 @@ def get_uncertainty(task_model, unlabeled_loader, augs, num_cls):
                 if output[0]['boxes'].shape[0] == 0:
                     consistency_all.append(0.0)
                     cls_all.append(np.mean(cls_corrs, axis=0))
+                    keep(0.0)
                     break
-                # start augment
-                if 'flip' in augs:
-                    flip_image, flip_boxes = HorizontalFlip(image, ref_boxes)
-                    aug_images.append(flip_image.cuda())
-                    aug_boxes.append(flip_boxes.cuda())
-                if 'ga' in augs:
-                    ga_image = GaussianNoise(image, 16)
-                    aug_images.append(ga_image.cuda())
-                    aug_boxes.append(ref_boxes.cuda())
-                if 'multi_ga' in augs:
-                    for i in range(1, 7):
-                        ga_image = GaussianNoise(image, i * 8)
-                        aug_images.append(ga_image.cuda())
-                        aug_boxes.append(ref_boxes.cuda())
-                if 'color_adjust' in augs:
-                    color_adjust_image = ColorAdjust(image, 1.5)
-                    aug_images.append(color_adjust_image.cuda())
-                    aug_boxes.append(ref_boxes)
-                if 'color_swap' in augs:
-                    color_swap_image = ColorSwap(image)
-                    aug_images.append(color_swap_image.cuda())
-                    aug_boxes.append(ref_boxes)
-                if 'multi_color_adjust' in augs:
-                    for i in range(2, 6):
-                        color_adjust_image = ColorAdjust(image, i)
-                        aug_images.append(color_adjust_image.cuda())
-                        aug_boxes.append(reference_boxes)
-                if 'sp' in augs:
-                    sp_image = SaltPepperNoise(image, 0.1)
-                    aug_images.append(sp_image.cuda())
-                    aug_boxes.append(ref_boxes)
-                if 'multi_sp' in augs:
-                    for i in range(1, 7):
-                        sp_image = SaltPepperNoise(image, i * 0.05)
-                        aug_images.append(sp_image.cuda())
-                        aug_boxes.append(ref_boxes)
-                if 'cut_out' in augs:
-                    cutout_image = cutout(image, ref_boxes, ref_labels, 2)
-                    aug_images.append(cutout_image.cuda())
-                    aug_boxes.append(ref_boxes)
-                if 'multi_cut_out' in augs:
-                    for i in range(1, 5):
-                        cutout_image = cutout(image, ref_boxes, ref_labels, i)
-                        aug_images.append(cutout_image.cuda())
-                        aug_boxes.append(ref_boxes)
-                if 'multi_resize' in augs:
-                    for i in range(7, 10):
-                        resize_image, resize_boxes = resize(image, ref_boxes, i * 0.1)
-                        aug_images.append(resize_image.cuda())
-                        aug_boxes.append(resize_boxes)
-                if 'larger_resize' in augs:
-                    resize_image, resize_boxes = resize(image, ref_boxes, 1.2)
-                    aug_images.append(resize_image.cuda())
-                    aug_boxes.append(resize_boxes)
-                if 'smaller_resize' in augs:
-                    resize_image, resize_boxes = resize(image, ref_boxes, 0.8)
-                    aug_images.append(resize_image.cuda())
-                    aug_boxes.append(resize_boxes)
-                if 'rotation' in augs:
-                    rot_image, rot_boxes = rotate(image, ref_boxes, 5)
-                    aug_images.append(rot_image.cuda())
-                    aug_boxes.append(rot_boxes)
-                outputs = []
-                for aug_image in aug_images:
-                    outputs.append(task_model([aug_image])[0])
+                threshold = -selected[0] if select_num and len(selected) == select_num else None
                 consistency_aug = []
                 mean_aug = []
-                for output, aug_box, aug_image in zip(outputs, aug_boxes, aug_images):
+                # views are augmented and run one at a time, so that an early exit skips both
+                for view in views:
+                    aug_image, aug_box = make_view(view, image, ref_boxes, ref_labels)
+                    output = task_model([aug_image.to(device)])[0]
+                    num_passes += 1
                     consistency_img = 1.0
                     mean_img = []
                     boxes, scores_cls, pm, labels, scores = output['boxes'], output['scores_cls'], output['prob_max'], \
@@ -222,17 +187,29 @@ def get_uncertainty(task_model, unlabeled_loader, augs, num_cls):
                             torch.max(iou) + 0.5 * (1 - js) * (ref_pm + pm[torch.argmax(iou)])).item())
                     consistency_aug.append(np.mean(consistency_img))
                     mean_aug.append(np.mean(mean_img))
-                consistency_all.append(np.mean(consistency_aug))
-                mean_all.append(mean_aug)
+                    if threshold is not None and np.sum(consistency_aug) / len(views) > threshold:
+                        break
+                if len(consistency_aug) < len(views):
+                    # lower bound, above the threshold
+                    consistency_all.append(np.sum(consistency_aug) / len(views))
+                else:
+                    consistency_all.append(np.mean(consistency_aug))
+                    mean_all.append(mean_aug)
+                    keep(consistency_all[-1])
                 cls_corrs = np.mean(np.array(cls_corrs), axis=0)
                 cls_all.append(cls_corrs)
+    # the same random state after scoring, whatever was skipped
+    random.setstate(random_state)
+    torch.set_rng_state(torch_state)
     mean_aug = np.mean(mean_all, axis=0)
     print(mean_aug)
+    if select_num:
+        print('Forward passes per image: {:.2f} of {}'.format(num_passes / max(len(consistency_all), 1),
+                                                              len(views) + 1))
     return consistency_all, cls_all
 
 
 def cls_kldiv(labeled_loader, cls_corrs, budget, cycle):
-    cls_inds = []
     result = []
     for _, targets in labeled_loader:
         for target in targets:
@@ -243,32 +220,22 @@ def cls_kldiv(labeled_loader, cls_corrs, budget, cycle):
         # with open("vis/mutual_cald_label_{}_{}_{}_{}.txt".format(args.uniform, args.model, args.dataset, cycle),
         #           "wb") as fp:  # Pickling
         # pickle.dump(result, fp)
-    for a in list(np.where(np.sum(cls_corrs, axis=1) == 0)[0]):
-        cls_inds.append(a)
-        # result.append(cls_corrs[a])
-    while len(cls_inds) < budget:
-        # batch cls_corrs together to accelerate calculating
-        KLDivLoss = nn.KLDivLoss(reduction='none')
-        _cls_corrs = torch.tensor(cls_corrs)
-        _result = torch.tensor(np.mean(np.array(result), axis=0)).unsqueeze(0)
-        if args.uniform:
-            p = torch.nn.functional.softmax(_result + _cls_corrs, -1)
-            q = torch.nn.functional.softmax(torch.ones(_result.shape) / len(_result), -1)
-            log_mean = ((p + q) / 2).log()
-            jsdiv = torch.sum(KLDivLoss(log_mean, p), dim=1) / 2 + torch.sum(KLDivLoss(log_mean, q), dim=1) / 2
-            jsdiv[cls_inds] = 100
-            max_ind = torch.argmin(jsdiv).item()
-            cls_inds.append(max_ind)
-        else:
-            p = torch.nn.functional.softmax(_result, -1)
-            q = torch.nn.functional.softmax(_cls_corrs, -1)
-            log_mean = ((p + q) / 2).log()
-            jsdiv = torch.sum(KLDivLoss(log_mean, p), dim=1) / 2 + torch.sum(KLDivLoss(log_mean, q), dim=1) / 2
-            jsdiv[cls_inds] = -1
-            max_ind = torch.argmax(jsdiv).item()
-            cls_inds.append(max_ind)
-        # result.append(cls_corrs[max_ind])
-    return cls_inds
+    return class_balanced_select(np.mean(np.array(result), axis=0), cls_corrs, budget, args.uniform)
+
+
+def score_pool(task_model, unlabeled_loader, augs, num_cls, subset, budget, cycle):
+    """
+    Consistency and class scores of the pool. With --acquisition-out the other strategies are scored in the same
+    sweep and the selections of all of them are written to a json file.
+    """
+    with inference_profile(task_model, **(SCORING_PROFILE if args.scoring_profile else {})):
+        if not args.acquisition_out:
+            # only the images of the first (mr x) budget are needed exactly
+            select_num = (budget if args.no_mutual else int(args.mr * budget)) if args.early_exit else None
+            return get_uncertainty(task_model, unlabeled_loader, augs, num_cls, select_num)
+        sweep = AcquisitionSweep(task_model, num_cls, augs, args.bp).run(unlabeled_loader)
+        sweep.save(args.acquisition_out.format(cycle=cycle), subset, budget, cycle=cycle, model=args.model)
+        return sweep.scores['cald'], sweep.cls_corrs
 
 
 def main(args):
@@ -285,11 +252,13 @@ def main(args):
     print("Loading data")
 
     if 'voc2007' in args.dataset:
-        dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(train=True), args.data_path)
+        dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(True, args.uint8_images),
+                                           args.data_path)
         dataset_aug, _ = get_dataset(args.dataset, "trainval", None, args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "test", get_transform(train=False), args.data_path)
     else:
-        dataset, num_classes = get_dataset(args.dataset, "train", get_transform(train=True), args.data_path)
+        dataset, num_classes = get_dataset(args.dataset, "train", get_transform(True, args.uint8_images),
+                                           args.data_path)
         dataset_aug, _ = get_dataset(args.dataset, "train", None, args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "val", get_transform(train=False), args.data_path)
 
@@ -309,8 +278,8 @@ def main(args):
     labeled_set = indices[:init_num]
     unlabeled_set = list(set(indices) - set(labeled_set))
     train_sampler = SubsetRandomSampler(labeled_set)
-    data_loader_test = DataLoader(dataset_test, batch_size=1, sampler=SequentialSampler(dataset_test),
-                                  num_workers=args.workers, collate_fn=utils.collate_fn)
+    loaders = PersistentLoaders(args.workers)
+    data_loader_test = loaders.sequential(dataset_test, SequentialSampler(dataset_test))
     augs = []
     if 'F' in args.augs:
         augs.append('flip')
@@ -324,15 +293,11 @@ def main(args):
         augs.append('ga')
     if 'S' in args.augs:
         augs.append('sp')
+    warm_start = WarmStart(args.incremental, args.incremental_epochs, args.incremental_lr_steps, args.new_weight)
+    report = CycleReport(args.cycle_report, args.baseline_report)
     for cycle in range(args.cycles):
-        if args.aspect_ratio_group_factor >= 0:
-            group_ids = create_aspect_ratio_groups(dataset, k=args.aspect_ratio_group_factor)
-            train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
-        else:
-            train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.batch_size, drop_last=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-                                                  collate_fn=utils.collate_fn)
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor,
+                                    pin_memory=args.uint8_images)
 
         print("Creating model")
         if 'voc' in args.dataset:
@@ -346,6 +311,7 @@ def main(args):
             elif 'retina' in args.model:
                 task_model = retinanet_resnet50_fpn_cal(num_classes=num_classes, min_size=800, max_size=1333)
         task_model.to(device)
+        warm_start.load(task_model)
         if cycle == 0 and args.skip:
             if 'faster' in args.model:
                 checkpoint = torch.load(os.path.join(args.first_checkpoint_path,
@@ -354,6 +320,7 @@ def main(args):
                 checkpoint = torch.load(os.path.join(args.first_checkpoint_path,
                                                      '{}_retinanet_1st.pth'.format(args.dataset)), map_location='cpu')
             task_model.load_state_dict(checkpoint['model'])
+            warm_start.save(labeled_set, task_model)
             if args.test_only:
                 if 'coco' in args.dataset:
                     coco_evaluate(task_model, data_loader_test)
@@ -367,23 +334,22 @@ def main(args):
             else:
                 subset = unlabeled_set
             if not args.no_mutual:
-                unlabeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                              num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-                uncertainty, _cls_corrs = get_uncertainty(task_model, unlabeled_loader, augs, num_classes)
+                unlabeled_loader = loaders.sequential(dataset_aug, SubsetSequentialSampler(subset), pin_memory=True)
+                uncertainty, _cls_corrs = score_pool(task_model, unlabeled_loader, augs, num_classes,
+                                                     subset, budget_num, cycle)
                 arg = np.argsort(np.array(uncertainty))
                 cls_corrs_set = arg[:int(args.mr * budget_num)]
                 cls_corrs = [_cls_corrs[i] for i in cls_corrs_set]
-                labeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(labeled_set),
-                                            num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
+                labeled_loader = loaders.sequential(dataset_aug, SubsetSequentialSampler(labeled_set), pin_memory=True)
                 tobe_labeled_set = cls_kldiv(labeled_loader, cls_corrs, budget_num, cycle)
                 # Update the labeled dataset and the unlabeled dataset, respectively
                 tobe_labeled_set = list(torch.tensor(subset)[arg][tobe_labeled_set].numpy())
                 labeled_set += tobe_labeled_set
                 unlabeled_set = list(set(indices) - set(labeled_set))
             else:
-                unlabeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                              num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-                uncertainty, _ = get_uncertainty(task_model, unlabeled_loader, augs, num_classes)
+                unlabeled_loader = loaders.sequential(dataset_aug, SubsetSequentialSampler(subset), pin_memory=True)
+                uncertainty, _ = score_pool(task_model, unlabeled_loader, augs, num_classes,
+                                            subset, budget_num, cycle)
                 arg = np.argsort(np.array(uncertainty))
                 # Update the labeled dataset and the unlabeled dataset, respectively
                 labeled_set += list(torch.tensor(subset)[arg][:budget_num].numpy())
@@ -391,11 +357,13 @@ def main(args):
                 unlabeled_set = list(set(indices) - set(labeled_set))
 
             # Create a new dataloader for the updated labeled dataset
-            train_sampler = SubsetRandomSampler(labeled_set)
+            train_sampler = warm_start.sampler(labeled_set)
             continue
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-        task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
+        task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer,
+                                                                 milestones=warm_start.milestones(args.lr_steps),
                                                                  gamma=args.lr_gamma)
         # Start active learning cycles training
         if args.test_only:
@@ -406,15 +374,19 @@ def main(args):
             return
         print("Start training")
         start_time = time.time()
-        for epoch in range(args.start_epoch, args.total_epochs):
-            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq)
+        total_epochs = warm_start.total_epochs(args.total_epochs)
+        for epoch in range(args.start_epoch, total_epochs):
+            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq,
+                            train_step)
             task_lr_scheduler.step()
             # evaluate after pre-set epoch
-            if (epoch + 1) == args.total_epochs:
+            if (epoch + 1) == total_epochs:
                 if 'coco' in args.dataset:
-                    coco_evaluate(task_model, data_loader_test)
+                    ap = coco_evaluate(task_model, data_loader_test).coco_eval['bbox'].stats[0]
                 elif 'voc' in args.dataset:
-                    voc_evaluate(task_model, data_loader_test, args.dataset, False, path=args.results_path)
+                    ap = voc_evaluate(task_model, data_loader_test, args.dataset, False, path=args.results_path)
+                report.update(cycle, len(labeled_set), ap, time.time() - start_time, warm_start.active)
+        warm_start.save(labeled_set, task_model)
         if not args.skip and cycle == 0:
             if 'faster' in args.model:
                 utils.save_on_master({
@@ -431,32 +403,31 @@ def main(args):
             subset = unlabeled_set
         print("Getting stability")
         if not args.no_mutual:
-            unlabeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                          num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-            uncertainty, _cls_corrs = get_uncertainty(task_model, unlabeled_loader, augs, num_classes)
+            unlabeled_loader = loaders.sequential(dataset_aug, SubsetSequentialSampler(subset), pin_memory=True)
+            uncertainty, _cls_corrs = score_pool(task_model, unlabeled_loader, augs, num_classes,
+                                                 subset, budget_num, cycle)
             # labeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(labeled_set),
             #                             num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
             arg = np.argsort(np.array(uncertainty))
             cls_corrs_set = arg[:int(args.mr * budget_num)]
             cls_corrs = [_cls_corrs[i] for i in cls_corrs_set]
-            labeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(labeled_set),
-                                        num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
+            labeled_loader = loaders.sequential(dataset_aug, SubsetSequentialSampler(labeled_set), pin_memory=True)
             tobe_labeled_set = cls_kldiv(labeled_loader, cls_corrs, budget_num, cycle)
             # Update the labeled dataset and the unlabeled dataset, respectively
             tobe_labeled_set = list(torch.tensor(subset)[arg][tobe_labeled_set].numpy())
             labeled_set += tobe_labeled_set
             unlabeled_set = list(set(indices) - set(labeled_set))
         else:
-            unlabeled_loader = DataLoader(dataset_aug, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                          num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-            uncertainty, _ = get_uncertainty(task_model, unlabeled_loader, augs, num_classes)
+            unlabeled_loader = loaders.sequential(dataset_aug, SubsetSequentialSampler(subset), pin_memory=True)
+            uncertainty, _ = score_pool(task_model, unlabeled_loader, augs, num_classes,
+                                        subset, budget_num, cycle)
             arg = np.argsort(np.array(uncertainty))
             # Update the labeled dataset and the unlabeled dataset, respectively
             labeled_set += list(torch.tensor(subset)[arg][:budget_num].numpy())
             labeled_set = list(set(labeled_set))
             unlabeled_set = list(set(indices) - set(labeled_set))
         # Create a new dataloader for the updated labeled dataset
-        train_sampler = SubsetRandomSampler(labeled_set)
+        train_sampler = warm_start.sampler(labeled_set)
 
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -482,6 +453,16 @@ if __name__ == "__main__":
                         help='number of total epochs to run')
     parser.add_argument('-e', '--total_epochs', default=20, type=int, metavar='N',
                         help='number of total epochs to run')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='warm-start every cycle from the previous cycle and fine-tune on a short schedule')
+    parser.add_argument('--incremental-epochs', default=5, type=int, help='epochs per cycle in incremental mode')
+    parser.add_argument('--incremental-lr-steps', default=[4], nargs='+', type=int,
+                        help='decrease lr at these epochs in incremental mode')
+    parser.add_argument('--new-weight', default=3.0, type=float,
+                        help='relative sampling weight of newly acquired images in incremental mode')
+    parser.add_argument('--cycle-report', default=None, help='path of a json file to save per-cycle mAP and time')
+    parser.add_argument('--baseline-report', default=None,
+                        help='per-cycle report of a from-scratch run to compare against')
     parser.add_argument('--cycles', default=7, type=int, metavar='N',
                         help='number of cycles epochs to run')
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
@@ -500,6 +481,15 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--uint8-images', action='store_true',
+                        help='keep training images uint8 up to the device, where they are converted to float')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
+    parser.add_argument('--scoring-profile', dest='scoring_profile', action='store_true',
+                        help='score the pool with fewer proposals and detections per image '
+                             '(detection.acquisition.SCORING_PROFILE)')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
@@ -515,6 +505,11 @@ if __name__ == "__main__":
                         action="store_true")
     parser.add_argument('-mr', default=1.2, type=float, help='mutual range')
     parser.add_argument('-bp', default=1.3, type=float, help='base point')
+    parser.add_argument('--early-exit', dest='early_exit', action='store_true',
+                        help='stop running the augmentations of an image once it cannot be selected')
+    parser.add_argument('--acquisition-out', default=None,
+                        help='score the cald, ls_c, lt_c, diversity and random strategies in one sweep and write '
+                             'their selections to this json path, formatted with {cycle}')
     parser.add_argument("--pretrained", dest="pretrained", help="Use pre-trained models from the modelzoo",
                         action="store_true")
     # distributed training parameters
@@ -0,0 +1,420 @@
+import contextlib
+import json
+import os
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as F
+
+from cald.cald_helper import HorizontalFlip, GaussianNoise, ColorAdjust, ColorSwap, SaltPepperNoise, cutout, resize, \
+    rotate
+from ll4al.models.lossnet import loss_features
+
+STRATEGIES = ('cald', 'ls_c', 'lt_c', 'll', 'diversity', 'random')
+
+# augmented views of every CALD augmentation, as (kind, parameter), in the order of cald_train.get_uncertainty
+AUG_VIEWS = {
+    'flip': [('flip', None)],
+    'ga': [('noise', 16)],
+    'multi_ga': [('noise', i * 8) for i in range(1, 7)],
+    'color_adjust': [('color_adjust', 1.5)],
+    'color_swap': [('color_swap', None)],
+    'multi_color_adjust': [('color_adjust', i) for i in range(2, 6)],
+    'sp': [('sp', 0.1)],
+    'multi_sp': [('sp', i * 0.05) for i in range(1, 7)],
+    'cut_out': [('cut_out', 2)],
+    'multi_cut_out': [('cut_out', i) for i in range(1, 5)],
+    'multi_resize': [('resize', i * 0.1) for i in range(7, 10)],
+    'larger_resize': [('resize', 1.2)],
+    'smaller_resize': [('resize', 0.8)],
+    'rotation': [('rotation', 5)],
+}
+# views that move or depend on the reference boxes, they are built after the reference pass
+BOX_VIEWS = ('flip', 'cut_out', 'resize', 'rotation')
+# the Gaussian noise views of ls_c_train
+STABILITY_VIEWS = [('noise', i * 8) for i in range(1, 7)]
+# test-time settings of the detectors while scoring: the scoring functions use at most 50 reference boxes
+SCORING_PROFILE = dict(rpn_pre_nms_top_n=500, rpn_post_nms_top_n=300, detections_per_img=50, topk_candidates=200)
+
+
+@contextlib.contextmanager
+def inference_profile(task_model, rpn_pre_nms_top_n=None, rpn_post_nms_top_n=None, detections_per_img=None,
+                      topk_candidates=None):
+    """
+    Temporarily lowers the test-time proposal and detection counts of a Faster R-CNN (RPN proposals before and after
+    NMS, detections per image) or a RetinaNet (per-class candidates before NMS, detections per image). Settings left
+    to None, or that the model does not have, are not changed.
+    """
+    changes = []
+    rpn = getattr(task_model, 'rpn', None)
+    if rpn is not None:
+        changes += [(rpn._pre_nms_top_n, 'testing', rpn_pre_nms_top_n),
+                    (rpn._post_nms_top_n, 'testing', rpn_post_nms_top_n)]
+    roi_heads = getattr(task_model, 'roi_heads', None)
+    changes.append((vars(roi_heads if roi_heads is not None else task_model), 'detections_per_img', detections_per_img))
+    if hasattr(task_model, 'topk_candidates'):
+        changes.append((vars(task_model), 'topk_candidates', topk_candidates))
+    changes = [(d, k, v, d[k]) for d, k, v in changes if v is not None]
+    for d, k, v, _ in changes:
+        d[k] = v
+    try:
+        yield task_model
+    finally:
+        for d, k, _, old in changes:
+            d[k] = old
+
+
+def make_view(view, image, boxes, labels):
+    """Augmented image of ``view`` and the reference boxes moved to it."""
+    kind, param = view
+    if kind == 'noise':
+        return GaussianNoise(image, param), boxes
+    if kind == 'color_adjust':
+        return ColorAdjust(image, param), boxes
+    if kind == 'color_swap':
+        return ColorSwap(image), boxes
+    if kind == 'sp':
+        return SaltPepperNoise(image, param), boxes
+    if kind == 'flip':
+        return HorizontalFlip(image, boxes)
+    if kind == 'cut_out':
+        return cutout(image, boxes, labels, param), boxes
+    if kind == 'resize':
+        return resize(image, boxes, param)
+    if kind == 'rotation':
+        return rotate(image, boxes, param)
+    raise ValueError('unknown view {}'.format(view))
+
+
+def detect(task_model, images):
+    """Runs ``task_model`` on ``images`` with one call per image shape, so no image is padded to another's size."""
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(tuple(image.shape[-2:]), []).append(i)
+    outputs = [None] * len(images)
+    for inds in groups.values():
+        for i, output in zip(inds, task_model([images[i] for i in inds])):
+            outputs[i] = output
+    return outputs
+
+
+def pairwise_iou(boxes1, boxes2):
+    """IoU matrix with the conventions of the get_uncertainty loops (no +1, 0 if the boxes do not overlap)."""
+    width = torch.min(boxes1[:, None, 2], boxes2[None, :, 2]) - torch.max(boxes1[:, None, 0], boxes2[None, :, 0])
+    height = torch.min(boxes1[:, None, 3], boxes2[None, :, 3]) - torch.max(boxes1[:, None, 1], boxes2[None, :, 1])
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    inter = width * height
+    iou = inter / (area1[:, None] + area2[None, :] - inter)
+    iou[(width < 0) | (height < 0)] = 0.0
+    return iou
+
+
+def js_divergence(p, q):
+    """Row-wise Jensen-Shannon divergence, normalized like scipy.stats.entropy."""
+    p = p.double() / p.double().sum(1, keepdim=True)
+    q = q.double() / q.double().sum(1, keepdim=True)
+    m = (p + q) / 2
+
+    def kl(a):
+        return torch.where(a > 0, a * (a / m).log(), torch.zeros_like(a)).sum(1)
+
+    return 0.5 * kl(p) + 0.5 * kl(q)
+
+
+def class_scores(output, num_cls):
+    """Highest score of every foreground class among the detections of ``output``."""
+    scores = torch.zeros(len(output['labels']), num_cls - 1, device=output['scores'].device)
+    scores[torch.arange(len(scores)), output['labels'] - 1] = output['scores']
+    return scores.max(0)[0] if len(scores) else scores.new_zeros(num_cls - 1)
+
+
+def cald_consistency(ref, views, num_cls, bp):
+    """
+    Consistency and mean class scores of one image, as in cald_train.get_uncertainty. ``ref`` holds the
+    subsampled reference detections, ``views`` (output, reference boxes in the view) pairs.
+    """
+    cls_corrs = [class_scores(ref, num_cls)]
+    consistency = []
+    for output, view_boxes in views:
+        cls_corrs.append(class_scores(output, num_cls))
+        if len(output['boxes']) == 0:
+            consistency.append(0.0)
+            continue
+        iou = pairwise_iou(view_boxes, output['boxes'])
+        max_iou, match = iou.max(1)
+        js = js_divergence(ref['scores_cls'], output['scores_cls'][match]).clamp(min=0).to(iou.dtype)
+        value = torch.abs(max_iou + 0.5 * (1 - js) * (ref['prob_max'] + output['prob_max'][match]) - bp)
+        consistency.append(min(1.0, value.min().item()))
+    return float(np.mean(consistency)), torch.stack(cls_corrs).mean(0).cpu().numpy()
+
+
+def localization_stability(ref, outputs):
+    """Localization stability of one image under the noise views ``outputs``, as in ls_c_train.get_uncertainty."""
+    boxes, prob_max = ref['boxes'], ref['prob_max']
+    if len(boxes) == 0:
+        return 0.0
+    if len(boxes) > 30:
+        inds = torch.topk(prob_max, 30)[1]
+        boxes, prob_max = boxes[inds], prob_max[inds]
+    stability = torch.zeros_like(prob_max)
+    for output in outputs:
+        if len(output['boxes']) > 0:
+            stability += pairwise_iou(boxes, output['boxes']).max(1)[0]
+    stability = stability / len(outputs)
+    return ((prob_max * stability).sum() / prob_max.sum() - (1 - prob_max).max()).item()
+
+
+def localization_tightness(outputs, quality_xi=None):
+    """
+    Uncertainty of every image of a batch of frcnn_la outputs, as in lt_c_train.get_uncertainty: the least
+    |IoU(box, proposal) + prob_max - 1| over the detections of the image, or with ``quality_xi`` the least
+    |1 - prob_max ** xi * IoU ** (1 - xi)|, capped at 1.0 (the value of images without detections).
+    """
+    counts = torch.as_tensor([len(o['boxes']) for o in outputs])
+    if counts.sum() == 0:
+        return torch.ones(len(outputs))
+    boxes = torch.cat([o['boxes'] for o in outputs])
+    props = torch.cat([o['props'] for o in outputs])
+    prob_max = torch.cat([o['prob_max'] for o in outputs])
+    # paired IoU with the conventions of calcu_iou
+    width = torch.min(boxes[:, 2], props[:, 2]) - torch.max(boxes[:, 0], props[:, 0]) + 1
+    height = torch.min(boxes[:, 3], props[:, 3]) - torch.max(boxes[:, 1], props[:, 1]) + 1
+    area1 = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1] + 1)
+    area2 = (props[:, 2] - props[:, 0]) * (props[:, 3] - props[:, 1] + 1)
+    inter = width * height
+    iou = torch.where((width > 0) & (height > 0), inter / (area1 + area2 - inter), torch.zeros_like(inter))
+    if quality_xi is None:
+        u = torch.abs(iou + prob_max - 1)
+    else:
+        u = torch.abs(1.0 - torch.pow(prob_max, quality_xi) * torch.pow(iou, 1. - quality_xi))
+    # per-image min over a (images, detections) matrix padded with 1.0
+    counts = counts.to(u.device)
+    image = torch.repeat_interleave(torch.arange(len(outputs), device=u.device), counts)
+    position = torch.arange(len(u), device=u.device) - (torch.cumsum(counts, 0) - counts)[image]
+    padded = u.new_ones((len(outputs), int(counts.max())))
+    padded[image, position] = u
+    return padded.min(1)[0].clamp(max=1.0)
+
+
+def box_proposal_uncertainty(ref):
+    """Least |IoU(box, proposal) + prob_max - 1| over the detections, as in lt_c_train.get_uncertainty."""
+    return localization_tightness([ref])[0].item()
+
+
+def k_center_greedy(embeddings, budget, centers=None):
+    """Core-set selection: repeatedly takes the embedding farthest from everything selected (or in ``centers``)."""
+    if centers is not None and len(centers):
+        min_dist = torch.cdist(embeddings, centers).min(1)[0]
+        selected = []
+    else:
+        min_dist = torch.cdist(embeddings, embeddings[:1])[:, 0]
+        selected = [0]
+    while len(selected) < min(budget, len(embeddings)):
+        ind = torch.argmax(min_dist).item()
+        selected.append(ind)
+        min_dist = torch.min(min_dist, torch.cdist(embeddings, embeddings[ind:ind + 1])[:, 0])
+    return selected
+
+
+def class_balanced_select(labeled_counts, cls_corrs, budget, uniform=False):
+    """
+    Class distribution matching of cald_train.cls_kldiv: positions in ``cls_corrs`` (class scores of the
+    candidates) whose classes diverge most (JS divergence) from ``labeled_counts``, the mean class counts of the
+    labeled images, or with ``uniform`` that bring them closest to uniform. Candidates without any class score
+    are taken first.
+    """
+    cls_corrs = torch.as_tensor(np.asarray(cls_corrs))
+    labeled = torch.as_tensor(np.asarray(labeled_counts, dtype=np.float64)).unsqueeze(0)
+    kl_div = torch.nn.KLDivLoss(reduction='none')
+    if uniform:
+        p = torch.nn.functional.softmax(labeled + cls_corrs, -1)
+        q = torch.nn.functional.softmax(torch.ones(labeled.shape) / len(labeled), -1)
+    else:
+        p = torch.nn.functional.softmax(labeled, -1)
+        q = torch.nn.functional.softmax(cls_corrs, -1)
+    log_mean = ((p + q) / 2).log()
+    jsdiv = (torch.sum(kl_div(log_mean, p), dim=1) / 2 + torch.sum(kl_div(log_mean, q), dim=1) / 2).numpy()
+    selected = np.where(cls_corrs.sum(1).numpy() == 0)[0].tolist()
+    empty = set(selected)
+    # the divergence does not depend on what is already taken, the loop of cls_kldiv is a sort
+    for ind in np.argsort(jsdiv if uniform else -jsdiv, kind='stable').tolist():
+        if len(selected) >= budget:
+            break
+        if ind not in empty:
+            selected.append(ind)
+    return selected
+
+
+def pooled_fpn_features(features):
+    """Image embeddings for diversity_select: the four FPN levels LossNet reads, average pooled and concatenated."""
+    return torch.cat([f.mean((2, 3)) for f in loss_features(features).values()], 1)
+
+
+def diversity_select(fetchsize, embeddings, block_size, uncertainty, ids=None):
+    """
+    Uncertainty-weighted diversity selection of xuyang_lt_c_train. The pool is cut into blocks of about
+    ``block_size`` images; in every block the image of highest priority exp(-uncertainty) is taken and it and
+    its neighbours (cosine distance under the mean k-NN distance of the block) are suppressed, until the
+    block's share of ``fetchsize`` is taken. Returns positions in ``embeddings``, or the matching ``ids``.
+    """
+    embeddings = torch.nn.functional.normalize(torch.as_tensor(embeddings).float(), dim=1)
+    uncertainty = torch.as_tensor(uncertainty, device=embeddings.device).float()
+    num_blocks = min(max(1, int(round(len(embeddings) / float(block_size)))), max(1, fetchsize))
+    bounds = np.linspace(0, len(embeddings), num_blocks + 1).round().astype(np.int64)
+    shares = [len(c) for c in np.array_split(np.arange(fetchsize), num_blocks)]
+    selected = []
+    for start, end, share in zip(bounds[:-1], bounds[1:], shares):
+        share = min(share, end - start)
+        if share == 0:
+            continue
+        block = embeddings[start:end]
+        interd = 1 - block.mm(block.t())
+        num_nei = min(max(1, int(round(len(block) / float(share)))), len(block))
+        dth = interd.topk(num_nei, dim=1, largest=False)[0].mean()
+        priority = torch.exp(-uncertainty[start:end])
+        taken = torch.zeros(len(block), dtype=torch.bool, device=block.device)
+        picks = torch.empty(share, dtype=torch.long, device=block.device)
+        for i in range(share):
+            top = torch.argmax(priority.masked_fill(taken, -1)).view(1)
+            picks[i:i + 1] = top
+            taken[top] = True
+            neighbours = (interd[top][0] <= dth).float()
+            priority[top] = priority[top] / (1 + 20 * (priority * neighbours).sum())
+            priority = priority / (1 + 20 * (priority * neighbours).sum() * neighbours)
+        selected.append(picks + int(start))
+    selected = torch.cat(selected).cpu()
+    if ids is not None:
+        return torch.as_tensor(ids)[selected].tolist()
+    return selected.tolist()
+
+
+class AcquisitionSweep(object):
+    """
+    Scores an unlabeled pool for several acquisition strategies with one forward sweep: every image goes
+    through the detector once together with its box-independent augmented views, then once more for the
+    views that depend on the reference boxes. The backbone features of the reference pass feed the loss
+    prediction module and the embeddings, so no strategy needs a pass of its own. Identical views (e.g.
+    CALD's 'ga' and the noise views of localization stability) are computed once.
+
+    Per-image scores are kept, the detections themselves are dropped once an image is scored.
+
+    Arguments:
+        task_model: a detector returning 'scores_cls' and 'prob_max' (frcnn_la, retinanet_cal); 'lt_c' also
+            needs the 'props' of frcnn_la and is skipped without them.
+        num_cls (int): number of classes including the background.
+        augs (list[str]): CALD augmentations, see AUG_VIEWS.
+        bp (float): CALD base point.
+        ll_model: LossNet trained with ``task_model``, 'll' is skipped without it.
+        strategies (list[str]): subset of STRATEGIES to score.
+    """
+
+    def __init__(self, task_model, num_cls, augs, bp=1.3, ll_model=None, strategies=STRATEGIES):
+        self.task_model = task_model
+        self.num_cls = num_cls
+        self.bp = bp
+        self.ll_model = ll_model
+        self.strategies = [s for s in strategies if s != 'll' or ll_model is not None]
+        self.cald_views = [v for aug in augs for v in AUG_VIEWS[aug]] if 'cald' in self.strategies else []
+        views = self.cald_views + (STABILITY_VIEWS if 'ls_c' in self.strategies else [])
+        self.views = list(dict.fromkeys(views))
+        self.scores = {s: [] for s in self.strategies if s not in ('diversity', 'random')}
+        self.cls_corrs = []
+        self.embeddings = []
+        self.num_images = 0
+
+    @torch.no_grad()
+    def run(self, loader):
+        """Scores every image of ``loader`` (PIL images, e.g. a dataset without transforms), in loader order."""
+        self.task_model.eval()
+        if self.ll_model is not None:
+            self.ll_model.eval()
+        device = next(self.task_model.parameters()).device
+        features = []
+
+        def keep_reference_features(module, inputs, output):
+            # the reference image is the first one through the backbone
+            if not features:
+                features.append(output)
+
+        handle = self.task_model.backbone.register_forward_hook(keep_reference_features)
+        try:
+            for images, _ in loader:
+                for image in images:
+                    del features[:]
+                    self._score(image, device, features)
+                    self.num_images += 1
+        finally:
+            handle.remove()
+        return self
+
+    def _score(self, image, device, features):
+        independent = [v for v in self.views if v[0] not in BOX_VIEWS]
+        images = [F.to_tensor(image).to(device)]
+        images += [make_view(v, image, None, None)[0].to(device) for v in independent]
+        outputs = detect(self.task_model, images)
+        ref, outputs = outputs[0], dict(zip(independent, outputs[1:]))
+
+        if 'll' in self.strategies or 'diversity' in self.strategies:
+            levels = loss_features(features[0])
+            levels = {k: f[:1] for k, f in levels.items()}
+            if 'll' in self.strategies:
+                self.scores['ll'].append(self.ll_model(levels).item())
+            if 'diversity' in self.strategies:
+                self.embeddings.append(pooled_fpn_features(levels)[0])
+        if 'lt_c' in self.strategies:
+            if 'props' in ref:
+                self.scores['lt_c'].append(box_proposal_uncertainty(ref))
+            else:
+                self.strategies.remove('lt_c')
+                del self.scores['lt_c']
+        if 'ls_c' in self.strategies:
+            self.scores['ls_c'].append(localization_stability(ref, [outputs[v] for v in STABILITY_VIEWS]))
+        if 'cald' in self.strategies:
+            self._score_cald(image, device, ref, outputs)
+
+    def _score_cald(self, image, device, ref, outputs):
+        ref = {k: ref[k] for k in ('boxes', 'labels', 'scores', 'scores_cls', 'prob_max')}
+        if len(ref['scores']) > 40:
+            inds = torch.as_tensor(np.round(np.linspace(0, len(ref['scores']) - 1, 50)).astype(int),
+                                   device=device)
+            ref = {k: v[inds] for k, v in ref.items()}
+        if len(ref['boxes']) == 0:
+            self.scores['cald'].append(0.0)
+            self.cls_corrs.append(np.zeros(self.num_cls - 1))
+            return
+        box_views = [v for v in dict.fromkeys(self.cald_views) if v[0] in BOX_VIEWS]
+        images, view_boxes = [], {}
+        for view in box_views:
+            view_image, view_boxes[view] = make_view(view, image, ref['boxes'], ref['labels'])
+            images.append(view_image.to(device))
+        outputs = dict(outputs, **dict(zip(box_views, detect(self.task_model, images))))
+        views = [(outputs[v], view_boxes.get(v, ref['boxes'])) for v in self.cald_views]
+        consistency, cls_corr = cald_consistency(ref, views, self.num_cls, self.bp)
+        self.scores['cald'].append(consistency)
+        self.cls_corrs.append(cls_corr)
+
+    def selections(self, budget, labeled_embeddings=None):
+        """Positions in the pool each strategy acquires, in the direction the training scripts select."""
+        selections = {}
+        for strategy in ('cald', 'ls_c', 'lt_c'):
+            if strategy in self.scores:
+                selections[strategy] = np.argsort(self.scores[strategy])[:budget].tolist()
+        if 'll' in self.scores:
+            selections['ll'] = np.argsort(self.scores['ll'])[::-1][:budget].tolist()
+        if 'diversity' in self.strategies and self.embeddings:
+            selections['diversity'] = k_center_greedy(torch.stack(self.embeddings), budget, labeled_embeddings)
+        if 'random' in self.strategies:
+            # the pool is shuffled by the training scripts already
+            selections['random'] = list(range(min(budget, self.num_images)))
+        return selections
+
+    def save(self, path, pool, budget, **extra):
+        """Writes the scores and the selections (as dataset indices of ``pool``) of every strategy as json."""
+        selections = {k: [int(pool[i]) for i in v] for k, v in self.selections(budget).items()}
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(dict(extra, pool=[int(i) for i in pool], scores=self.scores, selections=selections), f)
+        return selections
@@ -4,6 +4,7 @@ import tempfile
 import numpy as np
 import copy
 import time
+import weakref
 import torch
 import torch._six
 
@@ -19,7 +20,8 @@ from . import utils
 class CocoEvaluator(object):
     def __init__(self, coco_gt, iou_types):
         assert isinstance(iou_types, (list, tuple))
-        coco_gt = copy.deepcopy(coco_gt)
+        # the ground truth is shared between evaluations (get_coco_api_from_dataset); COCOeval only adds the
+        # same derived fields ('ignore', RLE segmentations) to its annotations every time, so it is not copied
         self.coco_gt = coco_gt
 
         self.iou_types = iou_types
@@ -165,12 +167,13 @@ def convert_to_xywh(boxes):
 
 
 def merge(img_ids, eval_imgs):
-    all_img_ids = utils.all_gather(img_ids)
+    all_img_ids = utils.all_gather_tensor(np.asarray(img_ids, dtype=np.int64))
+    # evalImgs are dicts per image, they still need pickling
     all_eval_imgs = utils.all_gather(eval_imgs)
 
     merged_img_ids = []
     for p in all_img_ids:
-        merged_img_ids.extend(p)
+        merged_img_ids.extend(p.tolist())
 
     merged_eval_imgs = []
     for p in all_eval_imgs:
@@ -196,6 +199,281 @@ def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
     coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
 
 
+class CocoBboxEvaluator(object):
+    """
+    Drop-in replacement of CocoEvaluator for bbox-only models. ``update`` only appends the detections to
+    flat arrays; IoUs, greedy matching and the precision/recall tables are computed for all images and
+    categories at once in ``accumulate``, reproducing COCOeval.evaluate/accumulate. ``coco_eval['bbox']``
+    is a regular COCOeval whose ``eval`` (and, after ``summarize``, ``stats``) is filled in.
+    """
+
+    def __init__(self, coco_gt, iou_types=("bbox",)):
+        assert list(iou_types) == ["bbox"], "CocoBboxEvaluator only supports bbox evaluation"
+        self.coco_gt = coco_gt
+        self.iou_types = ["bbox"]
+        self.coco_eval = {"bbox": COCOeval(coco_gt, iouType="bbox")}
+
+        self.img_ids = []
+        self._seen = set()
+        self._dets = defaultdict(list)
+
+    def update(self, predictions):
+        for image_id, prediction in predictions.items():
+            # like np.unique in merge, only the first evaluation of an image counts
+            if image_id in self._seen:
+                continue
+            self._seen.add(image_id)
+            self.img_ids.append(image_id)
+
+            boxes = convert_to_xywh(prediction["boxes"]).numpy()
+            self._dets["image_id"].append(np.full(len(boxes), image_id, dtype=np.int64))
+            self._dets["category_id"].append(prediction["labels"].numpy().astype(np.int64))
+            self._dets["bbox"].append(boxes.astype(np.float64).reshape(-1, 4))
+            self._dets["score"].append(prediction["scores"].numpy().astype(np.float64))
+
+    def _flat_dets(self):
+        dets = {"image_id": np.zeros(0, dtype=np.int64), "category_id": np.zeros(0, dtype=np.int64),
+                "bbox": np.zeros((0, 4)), "score": np.zeros(0)}
+        for k, v in self._dets.items():
+            dets[k] = np.concatenate(v)
+        return dets
+
+    def synchronize_between_processes(self):
+        if utils.get_world_size() == 1:
+            return
+        dets = self._flat_dets()
+        all_img_ids = utils.all_gather_tensor(np.asarray(self.img_ids, dtype=np.int64))
+        all_dets = [dict(zip(dets, v)) for v in zip(*[utils.all_gather_tensor(dets[k]) for k in dets])]
+
+        # keep the detections of an image only from the first process that evaluated it
+        img_ids, owner = np.unique(np.concatenate(all_img_ids), return_index=True)
+        owner = np.searchsorted(np.cumsum([len(p) for p in all_img_ids]), owner, side='right')
+        keep = [owner[np.searchsorted(img_ids, d["image_id"])] == rank for rank, d in enumerate(all_dets)]
+        self.img_ids = list(img_ids)
+        self._seen = set(self.img_ids)
+        self._dets = {k: [d[k][m] for d, m in zip(all_dets, keep)] for k in dets}
+
+    def accumulate(self):
+        coco_eval = self.coco_eval["bbox"]
+        p = coco_eval.params
+        p.imgIds = list(np.unique(self.img_ids))
+        p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        gts = cached_gt_bbox_arrays(self.coco_gt)
+        coco_eval.eval = evaluate_bbox(gts, self._flat_dets(), p)
+        coco_eval._paramsEval = copy.deepcopy(p)
+
+    def summarize(self):
+        print("IoU metric: bbox")
+        self.coco_eval["bbox"].summarize()
+
+
+def gt_bbox_arrays(coco_gt):
+    anns = coco_gt.dataset.get('annotations', [])
+    return {
+        "image_id": np.array([a['image_id'] for a in anns], dtype=np.int64),
+        "category_id": np.array([a['category_id'] for a in anns], dtype=np.int64),
+        "bbox": np.array([a['bbox'] for a in anns], dtype=np.float64).reshape(-1, 4),
+        "area": np.array([a['area'] for a in anns], dtype=np.float64),
+        "iscrowd": np.array([bool(a.get('iscrowd', 0)) for a in anns], dtype=bool),
+    }
+
+
+_gt_bbox_arrays = weakref.WeakKeyDictionary()
+
+
+def cached_gt_bbox_arrays(coco_gt):
+    """gt_bbox_arrays of ``coco_gt``, built once per process and returned read-only."""
+    if coco_gt not in _gt_bbox_arrays:
+        gts = gt_bbox_arrays(coco_gt)
+        for v in gts.values():
+            v.flags.writeable = False
+        _gt_bbox_arrays[coco_gt] = gts
+    return _gt_bbox_arrays[coco_gt]
+
+
+def bbox_iou(dt, gt, iscrowd):
+    # same as pycocotools.mask.iou for boxes: xywh boxes, crowd gts are divided by the detection area only
+    dx1, dy1 = dt[..., :, None, 0], dt[..., :, None, 1]
+    gx1, gy1 = gt[..., None, :, 0], gt[..., None, :, 1]
+    w = np.minimum(dx1 + dt[..., :, None, 2], gx1 + gt[..., None, :, 2]) - np.maximum(dx1, gx1)
+    h = np.minimum(dy1 + dt[..., :, None, 3], gy1 + gt[..., None, :, 3]) - np.maximum(dy1, gy1)
+    inter = np.where((w > 0) & (h > 0), w * h, 0)
+    dt_area = (dt[..., 2] * dt[..., 3])[..., :, None]
+    gt_area = (gt[..., 2] * gt[..., 3])[..., None, :]
+    union = np.where(iscrowd[..., None, :], dt_area, dt_area + gt_area - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(inter > 0, inter / union, 0)
+
+
+def _last_argmax(x):
+    # COCOeval keeps the last of equally good matches
+    return x.shape[-1] - 1 - np.argmax(x[..., ::-1], axis=-1)
+
+
+def _ceil_pow2(x):
+    return 1 << int(np.ceil(np.log2(max(int(x), 1))))
+
+
+def _match_bucket(gts, dts, g_start, g_count, d_start, d_count, p):
+    """
+    Greedy matching of a set of (image, category) pairs padded to the same number of gts and detections,
+    for all area ranges and IoU thresholds at once. Returns the per detection matched/ignored flags
+    (A, T, P, D) and the number of not ignored gts per pair and area range (P, A).
+    """
+    area_rng = np.asarray(p.areaRng, dtype=np.float64)
+    thrs = np.minimum(np.asarray(p.iouThrs), 1 - 1e-10)
+    G, D = max(g_count.max(), 1), max(d_count.max(), 1)
+    g_valid = np.arange(G)[None] < g_count[:, None]
+    d_valid = np.arange(D)[None] < d_count[:, None]
+    g_idx = np.where(g_valid, g_start[:, None] + np.arange(G)[None], 0)
+    d_idx = np.where(d_valid, d_start[:, None] + np.arange(D)[None], 0)
+
+    g_box, g_area = gts["bbox"][g_idx], gts["area"][g_idx]
+    g_crowd = gts["iscrowd"][g_idx] & g_valid
+    d_box = dts["bbox"][d_idx]
+    d_area = d_box[..., 2] * d_box[..., 3]
+    ious = np.where(d_valid[:, :, None] & g_valid[:, None, :], bbox_iou(d_box, g_box, g_crowd), -1.0)
+
+    # gts ignored per area range, sorted ignored last (stable, as in evaluateImg), padding at the very end
+    lo, hi = area_rng[None, :, 0, None], area_rng[None, :, 1, None]
+    g_ignore = g_crowd[:, None] | (g_area[:, None] < lo) | (g_area[:, None] > hi)
+    g_order = np.argsort(np.where(g_valid[:, None], g_ignore, 2), axis=-1, kind='mergesort')
+    g_ignore = np.take_along_axis(g_ignore, g_order, -1)
+    g_crowd = np.take_along_axis(np.broadcast_to(g_crowd[:, None], g_order.shape), g_order, -1)
+    ious = np.take_along_axis(np.broadcast_to(ious[:, None], g_order.shape[:2] + ious.shape[1:]),
+                              g_order[:, :, None, :], -1)
+    num_gt = (np.take_along_axis(np.broadcast_to(g_valid[:, None], g_order.shape), g_order, -1) &
+              ~g_ignore).sum(-1)
+
+    P, A, T = len(g_count), len(area_rng), len(thrs)
+    gt_matched = np.zeros((P, A, T, G), dtype=bool)
+    dt_matched = np.zeros((P, A, T, D), dtype=bool)
+    dt_ignore = np.zeros((P, A, T, D), dtype=bool)
+    g_ignore, g_crowd = g_ignore[:, :, None], g_crowd[:, :, None]
+    for d in range(int(d_count.max())):
+        iou = ious[:, :, None, d]
+        ok = (iou >= thrs[None, None, :, None]) & ~(gt_matched & ~g_crowd)
+        # regular gts are preferred, ignored gts are only looked at if no regular gt can be matched
+        regular = np.where(ok & ~g_ignore, iou, -1.0)
+        ignored = np.where(ok & g_ignore, iou, -1.0)
+        m_regular, m_ignored = _last_argmax(regular), _last_argmax(ignored)
+        has_regular = np.take_along_axis(regular, m_regular[..., None], -1)[..., 0] >= 0
+        has_ignored = np.take_along_axis(ignored, m_ignored[..., None], -1)[..., 0] >= 0
+        m = np.where(has_regular, m_regular, m_ignored)[..., None]
+        matched = has_regular | has_ignored
+        dt_matched[..., d] = matched
+        dt_ignore[..., d] = matched & ~has_regular
+        np.put_along_axis(gt_matched, m, np.take_along_axis(gt_matched, m, -1) | matched[..., None], -1)
+
+    # unmatched detections outside of the area range are ignored
+    d_outside = (d_area[:, None] < lo) | (d_area[:, None] > hi)
+    dt_ignore |= ~dt_matched & d_outside[:, :, None]
+
+    dt_matched = dt_matched.transpose(1, 2, 0, 3)[:, :, d_valid]
+    dt_ignore = dt_ignore.transpose(1, 2, 0, 3)[:, :, d_valid]
+    return d_idx[d_valid], dt_matched, dt_ignore, num_gt
+
+
+def evaluate_bbox(gts, dts, p):
+    """
+    Vectorized COCOeval.evaluate + accumulate for bbox detections given as flat arrays. ``gts`` holds
+    image_id, category_id, bbox (xywh), area and iscrowd in annotation order, ``dts`` image_id,
+    category_id, bbox and score in result order. Returns the ``eval`` dict of COCOeval.accumulate.
+    """
+    img_ids, cat_ids = np.asarray(p.imgIds, dtype=np.int64), np.asarray(p.catIds, dtype=np.int64)
+    T, R, K, A, M = len(p.iouThrs), len(p.recThrs), len(cat_ids), len(p.areaRng), len(p.maxDets)
+    precision = -np.ones((T, R, K, A, M))
+    recall = -np.ones((T, K, A, M))
+    scores = -np.ones((T, R, K, A, M))
+
+    def pair_key(arrays):
+        i = np.searchsorted(img_ids, arrays["image_id"]).clip(max=max(len(img_ids) - 1, 0))
+        k = np.searchsorted(cat_ids, arrays["category_id"]).clip(max=max(K - 1, 0))
+        keep = (img_ids[i] == arrays["image_id"]) & (cat_ids[k] == arrays["category_id"])
+        return i * K + k, keep
+
+    if len(img_ids) == 0 or K == 0:
+        return {'params': p, 'counts': [T, R, K, A, M], 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'precision': precision, 'recall': recall, 'scores': scores}
+
+    # gts grouped by (image, category) keeping the annotation order inside a group
+    g_key, keep = pair_key(gts)
+    order = np.nonzero(keep)[0]
+    order = order[np.argsort(g_key[order], kind='mergesort')]
+    gts = {k: v[order] for k, v in gts.items()}
+    g_key = g_key[order]
+
+    # detections grouped the same way, highest score first, at most maxDets[-1] per group
+    d_key, keep = pair_key(dts)
+    order = np.nonzero(keep)[0]
+    order = order[np.lexsort((order, -dts["score"][order], d_key[order]))]
+    d_key = d_key[order]
+    rank = np.arange(len(d_key)) - np.searchsorted(d_key, d_key, side='left')
+    order, d_key, rank = order[rank < p.maxDets[-1]], d_key[rank < p.maxDets[-1]], rank[rank < p.maxDets[-1]]
+    dts = {k: v[order] for k, v in dts.items()}
+
+    pairs = np.union1d(g_key, d_key)
+    g_start = np.searchsorted(g_key, pairs, side='left')
+    g_count = np.searchsorted(g_key, pairs, side='right') - g_start
+    d_start = np.searchsorted(d_key, pairs, side='left')
+    d_count = np.searchsorted(d_key, pairs, side='right') - d_start
+    if len(gts["bbox"]) == 0:
+        gts = {k: np.zeros((1,) + v.shape[1:], dtype=v.dtype) for k, v in gts.items()}
+    if len(dts["bbox"]) == 0:
+        dts = {k: np.zeros((1,) + v.shape[1:], dtype=v.dtype) for k, v in dts.items()}
+
+    # pairs are padded to the number of gts / detections of their size bucket
+    dt_matched = np.zeros((A, T, len(d_key)), dtype=bool)
+    dt_ignore = np.zeros((A, T, len(d_key)), dtype=bool)
+    num_gt = np.zeros((len(pairs), A), dtype=np.int64)
+    bucket = np.array([_ceil_pow2(g) for g in g_count]) * 1024 + np.array([_ceil_pow2(d) for d in d_count])
+    for b in np.unique(bucket):
+        sel = np.nonzero(bucket == b)[0]
+        d_idx, matched, ignore, n = _match_bucket(gts, dts, g_start[sel], g_count[sel], d_start[sel],
+                                                  d_count[sel], p)
+        dt_matched[:, :, d_idx] = matched
+        dt_ignore[:, :, d_idx] = ignore
+        num_gt[sel] = n
+
+    num_gt = np.stack([np.bincount(pairs % K, weights=num_gt[:, a], minlength=K) for a in range(A)], 1)
+    d_cat = d_key % K
+    rec_thrs = np.asarray(p.recThrs)
+    for k in range(K):
+        in_cat = np.nonzero(d_cat == k)[0]
+        for a in range(A):
+            npig = num_gt[k, a]
+            if npig == 0:
+                continue
+            for m, max_det in enumerate(p.maxDets):
+                sel = in_cat[rank[in_cat] < max_det]
+                inds = np.argsort(-dts["score"][sel], kind='mergesort')
+                sel = sel[inds]
+                dt_scores = dts["score"][sel]
+                tps = dt_matched[a][:, sel] & ~dt_ignore[a][:, sel]
+                fps = ~dt_matched[a][:, sel] & ~dt_ignore[a][:, sel]
+                tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
+                nd = len(sel)
+                rc = tp_sum / npig
+                pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                recall[:, k, a, m] = rc[:, -1] if nd else 0
+                if nd == 0:
+                    precision[:, :, k, a, m] = 0
+                    scores[:, :, k, a, m] = 0
+                    continue
+                # precision envelope
+                pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                for t in range(T):
+                    inds = np.searchsorted(rc[t], rec_thrs, side='left')
+                    valid = inds < nd
+                    precision[t, :, k, a, m] = np.where(valid, pr[t, inds.clip(max=nd - 1)], 0)
+                    scores[t, :, k, a, m] = np.where(valid, dt_scores[inds.clip(max=nd - 1)], 0)
+
+    return {'params': p, 'counts': [T, R, K, A, M], 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'precision': precision, 'recall': recall, 'scores': scores}
+
+
 #################################################################
 # From pycocotools, just removed the prints and fixed
 # a Python3 bug about unicode not defined
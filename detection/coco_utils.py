@@ -1,5 +1,7 @@
 import copy
 import os
+import weakref
+import xml.etree.ElementTree as ET
 from PIL import Image
 
 import torch
@@ -10,6 +12,8 @@ from pycocotools import mask as coco_mask
 from pycocotools.coco import COCO
 
 from . import transforms as T
+from .image_index import image_size_index
+from .voc_utils import ConvertVOCtoCOCO
 
 
 class FilterAndRemapCocoCategories(object):
@@ -143,8 +147,38 @@ def _coco_remove_images_without_annotations(dataset, cat_list=None):
     return dataset
 
 
+class _ImageSize(object):
+    """Stands for the image in ConvertCocoPolysToMask, which only reads its size."""
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+
+
+def _get_target(ds, idx):
+    """The converted target of ``idx`` read from the annotations, without decoding the image."""
+    if isinstance(ds, torch.utils.data.Subset):
+        return _get_target(ds.dataset, ds.indices[idx])
+    if hasattr(ds, "get_target"):
+        return ds.get_target(idx)
+    if isinstance(ds, torchvision.datasets.CocoDetection):
+        image_id = ds.ids[idx]
+        info = ds.coco.imgs[image_id]
+        anno = ds.coco.loadAnns(ds.coco.getAnnIds(imgIds=image_id))
+        return ConvertCocoPolysToMask()(_ImageSize(info['width'], info['height']),
+                                        dict(image_id=image_id, annotations=anno))[1]
+    if isinstance(ds, torchvision.datasets.VOCDetection):
+        records = getattr(ds, 'records', None)
+        if records is not None:
+            return records.target(idx)
+        anno = ds.parse_voc_xml(ET.parse(ds.annotations[idx]).getroot())['annotation']
+        return ConvertVOCtoCOCO()(None, dict(image_id=idx, annotations=anno))[1]
+    return ds[idx][1]
+
+
 def convert_to_coco_api(ds):
     coco_ds = COCO()
+    # image sizes from the annotations and targets without decoding images, where the dataset allows it
+    sizes = image_size_index(ds)
     # annotation IDs need to start at 1, not 0, see torchvision issue #1530
     ann_id = 1
     dataset = {'images': [], 'categories': [], 'annotations': []}
@@ -152,12 +186,17 @@ def convert_to_coco_api(ds):
     for img_idx in range(len(ds)):
         # find better way to get target
         # targets = ds.get_annotations(img_idx)
-        img, targets = ds[img_idx]
+        if sizes is not None:
+            targets = _get_target(ds, img_idx)
+            height, width = int(sizes[img_idx, 0]), int(sizes[img_idx, 1])
+        else:
+            img, targets = ds[img_idx]
+            height, width = img.shape[-2:]
         image_id = targets["image_id"].item()
         img_dict = {}
         img_dict['id'] = image_id
-        img_dict['height'] = img.shape[-2]
-        img_dict['width'] = img.shape[-1]
+        img_dict['height'] = height
+        img_dict['width'] = width
         dataset['images'].append(img_dict)
         bboxes = targets["boxes"]
         bboxes[:, 2:] -= bboxes[:, :2]
@@ -195,7 +234,16 @@ def convert_to_coco_api(ds):
     return coco_ds
 
 
+# ground truth converted from datasets without a COCO api, built once per process and dataset
+_converted_coco_apis = weakref.WeakKeyDictionary()
+
+
 def get_coco_api_from_dataset(dataset):
+    """
+    The ground truth COCO object of ``dataset``. Evaluations share it and must only read it, so it is built
+    (converted, for datasets that are not CocoDetection) once per process and not copied. A packed COCO dataset
+    reads the original annotations saved by packed_store.pack, since its targets lack the crowd regions.
+    """
     for _ in range(10):
         if isinstance(dataset, torchvision.datasets.CocoDetection):
             break
@@ -203,12 +251,18 @@ def get_coco_api_from_dataset(dataset):
             dataset = dataset.dataset
     if isinstance(dataset, torchvision.datasets.CocoDetection):
         return dataset.coco
-    return convert_to_coco_api(dataset)
+    if dataset not in _converted_coco_apis:
+        if getattr(dataset, 'coco_gt', None):
+            _converted_coco_apis[dataset] = COCO(dataset.coco_gt)
+        else:
+            _converted_coco_apis[dataset] = convert_to_coco_api(dataset)
+    return _converted_coco_apis[dataset]
 
 
 class CocoDetection(torchvision.datasets.CocoDetection):
     def __init__(self, img_folder, ann_file, transforms):
         super(CocoDetection, self).__init__(img_folder, ann_file)
+        self.ann_file = ann_file
         self._transforms = transforms
 
     def __getitem__(self, idx):
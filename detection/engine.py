@@ -3,22 +3,20 @@ import sys
 import time
 import torch
 import itertools
-from terminaltables import AsciiTable
 import numpy as np
-import cv2
-from mmcv.utils import print_log
 
 import torchvision.models.detection.mask_rcnn
 
 from .coco_utils import get_coco_api_from_dataset
-from .coco_eval import CocoEvaluator
+from .coco_eval import CocoEvaluator, CocoBboxEvaluator
 from . import utils
-from .voc_eval import _write_voc_results_file, _do_python_eval
+from .voc_eval import _write_voc_results_file, _do_python_eval, voc_devkit
+from .train_step import TrainStep
 
 
-def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq):
+def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, train_step=None):
     model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
 
@@ -29,33 +27,19 @@ def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq):
 
         lr_scheduler = utils.warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor)
 
+    if train_step is None:
+        train_step = TrainStep(optimizer, device)
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
+        images = utils.images_to_device(images, device)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        loss_dict = model(images, targets)
-
-        losses = sum(loss for loss in loss_dict.values())
-
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        losses_reduced = sum(loss for loss in loss_dict_reduced.values())
-
-        loss_value = losses_reduced.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
-
-        optimizer.zero_grad()
-        losses.backward()
-        optimizer.step()
-
-        if lr_scheduler is not None:
-            lr_scheduler.step()
+        with train_step.autocast():
+            loss_dict = model(images, targets)
+            losses = sum(loss for loss in loss_dict.values())
 
-        metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(losses, loss=losses, **loss_dict)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
     return metric_logger
@@ -83,8 +67,8 @@ VOC_CLASSES = (
 
 
 @torch.no_grad()
-def voc_evaluate(model, data_loader, year, feature=False, path='results'):
-    device = 'cuda'
+def voc_evaluate(model, data_loader, year, feature=False, path='results', device='cuda'):
+    device = torch.device(device)
     n_threads = torch.get_num_threads()
     torch.set_num_threads(1)
     cpu_device = torch.device("cpu")
@@ -92,29 +76,33 @@ def voc_evaluate(model, data_loader, year, feature=False, path='results'):
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Test:'
 
-    all_boxes = [[] for i in range(21)]
-    image_index = []
+    # detections are kept as flat tensors (boxes + score, label, image) so they can be gathered without pickling
+    det_boxes, det_labels, det_images = [], [], []
+    name_codes, name_lengths = [], []
     c = 0
     for image, targets in metric_logger.log_every(data_loader, 5000, header):
         image = list(img.to(device) for img in image)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        torch.cuda.synchronize()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
         if feature:
             _, outputs = model(image)
         else:
             outputs = model(image)
-        name = ''.join([chr(i) for i in targets[0]['name'].tolist()])
-        image_index.append(name)
         for output in outputs:
             if 'features' in output.keys():
                 del output['features']
         outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
 
-        image_boxes = [[] for i in range(21)]
-        for o in outputs:
-            for i in range(o['boxes'].shape[0]):
-                image_boxes[o['labels'][i]].extend([torch.cat([o['boxes'][i], o['scores'][i].unsqueeze(0)], dim=0)])
+        # batches may hold several images (e.g. from a SizeBucketedBatchSampler)
+        for t, o in zip(targets, outputs):
+            name = t['name'].to(cpu_device, torch.uint8)
+            name_codes.append(name)
+            name_lengths.append(len(name))
+            det_boxes.append(torch.cat([o['boxes'], o['scores'].unsqueeze(1)], dim=1))
+            det_labels.append(o['labels'])
+            det_images.append(torch.full_like(o['labels'], len(name_lengths) - 1))
         # if cycle == 0:
         #     for img, label, out in zip(image, targets, outputs):
         #         img = (img * 255).permute(1, 2, 0).type(torch.uint8).cpu().numpy()
@@ -131,31 +119,37 @@ def voc_evaluate(model, data_loader, year, feature=False, path='results'):
         #                             thickness=1)
         #     cv2.imwrite('/data/yuweiping/vis_voc_cycle_1/{}.jpg'.format(i), img)
         #     c += 1
-        # makes sure that the all_boxes is filled with empty array when
-        # there are no boxes in image_boxes
-        for i in range(21):
-            if image_boxes[i] != []:
-                all_boxes[i].append([torch.stack(image_boxes[i])])
-            else:
-                all_boxes[i].append([])
+
+    # gather the stats from all processes
     metric_logger.synchronize_between_processes()
 
-    all_boxes_gathered = utils.all_gather(all_boxes)
-    image_index_gathered = utils.all_gather(image_index)
+    flat = (torch.cat(det_boxes) if det_boxes else torch.zeros((0, 5)),
+            torch.cat(det_labels) if det_labels else torch.zeros((0,), dtype=torch.int64),
+            torch.cat(det_images) if det_images else torch.zeros((0,), dtype=torch.int64),
+            torch.cat(name_codes) if name_codes else torch.zeros((0,), dtype=torch.uint8),
+            torch.tensor(name_lengths, dtype=torch.int64))
+    gathered = [utils.all_gather_tensor(t) for t in flat]
 
     # results from all processes are gathered here
+    ap = None
     if utils.is_main_process():
         all_boxes = [[] for i in range(21)]
-        for abgs in all_boxes_gathered:
-            for ab, abg in zip(all_boxes, abgs):
-                ab += abg
         image_index = []
-        for iig in image_index_gathered:
-            image_index += iig
-        _write_voc_results_file(all_boxes, image_index, path,
-                                data_loader.dataset._transforms.transforms[0].CLASSES)
-        _do_python_eval(data_loader, year, path)
+        for boxes, labels, images, codes, lengths in zip(*gathered):
+            image_index += [''.join(chr(i) for i in n.tolist()) for n in torch.split(codes, lengths.tolist())]
+            # one [boxes] entry (or [] when there are none) per image and class
+            key = images * 21 + labels
+            order = torch.from_numpy(np.argsort(key.numpy(), kind='stable'))
+            counts = torch.bincount(key, minlength=len(lengths) * 21).tolist()
+            per_image = torch.split(boxes[order], counts)
+            for j in range(len(lengths)):
+                for i in range(21):
+                    b = per_image[j * 21 + i]
+                    all_boxes[i].append([b] if len(b) else [])
+        _write_voc_results_file(all_boxes, image_index, path, voc_devkit(data_loader.dataset)[2])
+        ap = _do_python_eval(data_loader, year, path)
     torch.set_num_threads(n_threads)
+    return ap
 
 
 COCO_CLASSES = ('person', 'bicycle', 'car', 'motorcycle', 'airplane', 'bus',
@@ -187,7 +181,10 @@ def coco_evaluate(model, data_loader, classwise=True, feature=False):
 
     coco = get_coco_api_from_dataset(data_loader.dataset)
     iou_types = _get_iou_types(model)
-    coco_evaluator = CocoEvaluator(coco, iou_types)
+    if iou_types == ["bbox"]:
+        coco_evaluator = CocoBboxEvaluator(coco, iou_types)
+    else:
+        coco_evaluator = CocoEvaluator(coco, iou_types)
     for images, targets in metric_logger.log_every(data_loader, 1000, header):
         images = list(img.to(device) for img in images)
         torch.cuda.synchronize()
@@ -219,6 +216,10 @@ def coco_evaluate(model, data_loader, classwise=True, feature=False):
     coco_evaluator.summarize()
 
     if classwise:  # Compute per-category AP
+        # only needed for the per-category table
+        from mmcv.utils import print_log
+        from terminaltables import AsciiTable
+
         cat_ids = coco.get_cat_ids(cat_names=COCO_CLASSES)
         # Compute per-category AP
         # from https://github.com/facebookresearch/detectron2/
@@ -20,6 +20,8 @@ from torchvision.ops import boxes as box_ops
 from torchvision.models.utils import load_state_dict_from_url
 import torch
 
+from .ssm_utils import judge_y, class_major_order
+
 model_urls = {
     'fasterrcnn_resnet50_fpn_coco':
         'https://download.pytorch.org/models/fasterrcnn_resnet50_fpn_coco-258fb6c6.pth',
@@ -64,19 +66,6 @@ def _fastrcnn_loss(class_logits, box_regression, labels, regression_targets):
     return classification_loss, box_loss
 
 
-def judge_y(score):
-    '''return :
-    y:np.array len(score)
-    '''
-    y = []
-    for s in score:
-        if s == 1 or torch.log(s) > torch.log(1 - s):
-            y.append(1)
-        else:
-            y.append(-1)
-    return y
-
-
 class RoIHeads(_RoIHeads):
 
     def ssm_postprocess_detections(self, class_logits, box_regression, proposals, image_shapes):
@@ -91,52 +80,40 @@ class RoIHeads(_RoIHeads):
         # split boxes and scores per image
         pred_boxes = pred_boxes.split(boxes_per_image, 0)
         pred_scores = pred_scores.split(boxes_per_image, 0)
-        al_idx = 0
-        all_boxes = torch.empty([0, 4]).cuda()
-        all_scores = torch.tensor([]).cuda()
+        all_boxes = []
+        all_scores = []
         all_labels = []
+        all_al = []
         CONF_THRESH = 0.5  # bigger leads more active learning samples
         for boxes, scores, image_shape in zip(pred_boxes, pred_scores, image_shapes):
             boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
-            # create labels for each prediction
-            labels = torch.arange(num_classes, device=device)
-            labels = labels.view(1, -1).expand_as(scores)
 
             # remove predictions with the background label
             boxes = boxes[:, 1:]
             scores = scores[:, 1:]
-            labels = labels[:, 1:]
             if torch.max(scores) < CONF_THRESH:
-                al_idx = 1
+                all_boxes.append(boxes.new_zeros((0, 4)))
+                all_scores.append(scores.new_zeros((0, num_classes - 1)))
+                all_labels.append(torch.zeros((0, num_classes - 1), dtype=torch.int64, device=device))
+                all_al.append(1)
                 continue
-            for cls_ind in range(num_classes - 1):
-                cls_boxes = boxes[:, cls_ind]
-                cls_scores = scores[:, cls_ind]
-                cls_labels = labels[:, cls_ind]
-                # batch everything, by making every class prediction be a separate instance
-                cls_boxes = cls_boxes.reshape(-1, 4)
-                cls_scores = cls_scores.flatten()
-                cls_labels = cls_labels.flatten()
-
-                # remove low scoring boxes
-
-                # non-maximum suppression, independently done per class
-                keep = box_ops.batched_nms(cls_boxes, cls_scores, cls_labels, self.nms_thresh)
-                # keep only topk scoring predictions
-                keep = keep[:self.detections_per_img]
-                cls_boxes, cls_scores, cls_labels = cls_boxes[keep], cls_scores[keep], cls_labels[keep]
-                inds = torch.nonzero(cls_scores > self.score_thresh).squeeze(1)
-                if len(inds) == 0:
-                    continue
-                for j in inds:
-                    # boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
-
-                    all_boxes = torch.cat((all_boxes, cls_boxes[j].unsqueeze(0)), 0)
-                    k = keep[j]
-                    all_scores = torch.cat((all_scores, scores[k].unsqueeze(0)), 0)
-                    all_labels.append(judge_y(scores[k]))
-        # all_scores = [torch.cat(all_scores, 1)]
-        return [all_boxes], [all_scores], [all_labels], al_idx
+            # batch everything, by making every class prediction be a separate instance
+            cls_inds = torch.arange(num_classes - 1, device=device).repeat(len(scores))
+            prop_inds = torch.arange(len(scores), device=device).repeat_interleave(num_classes - 1)
+            cls_boxes = boxes.reshape(-1, 4)
+            cls_scores = scores.flatten()
+
+            # non-maximum suppression, independently done per class
+            keep = box_ops.batched_nms(cls_boxes, cls_scores, cls_inds, self.nms_thresh)
+            # keep only topk scoring predictions of every class, then remove low scoring boxes
+            order, rank = class_major_order(keep, cls_inds[keep])
+            keep = keep[order]
+            keep = keep[(rank < self.detections_per_img) & (cls_scores[keep] > self.score_thresh)]
+            all_boxes.append(cls_boxes[keep])
+            all_scores.append(scores[prop_inds[keep]])
+            all_labels.append(judge_y(all_scores[-1]))
+            all_al.append(0)
+        return all_boxes, all_scores, all_labels, all_al
 
     def forward(self, features, proposals, image_shapes, ssm, targets=None):
         # type: (Dict[str, Tensor], List[Tensor], List[Tuple[int, int]], Optional[List[Dict[str, Tensor]]])
@@ -185,7 +162,7 @@ class RoIHeads(_RoIHeads):
                             "boxes": boxes[i],
                             "labels": labels[i],
                             "scores": scores[i],
-                            'al': al,
+                            'al': al[i],
                         }
                     )
             else:
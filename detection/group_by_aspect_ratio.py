@@ -1,23 +1,27 @@
 import bisect
-from collections import defaultdict
 import copy
-from itertools import repeat, chain
-import math
 import numpy as np
 
 import torch
 import torch.utils.data
-from torch.utils.data.sampler import BatchSampler, Sampler
+from torch.utils.data.sampler import BatchSampler, Sampler, SubsetRandomSampler
 from torch.utils.model_zoo import tqdm
 import torchvision
 
 from PIL import Image
 
+from .image_index import image_size_index
 
-def _repeat_to_at_least(iterable, n):
-    repeat_times = math.ceil(n / len(iterable))
-    repeated = chain.from_iterable(repeat(iterable, repeat_times))
-    return list(repeated)
+
+def sampler_indices(sampler):
+    """The indices of one pass over ``sampler`` as an array, drawn without a Python loop when possible."""
+    if hasattr(sampler, "index_array"):
+        return sampler.index_array()
+    if isinstance(sampler, SubsetRandomSampler):
+        # same draw as SubsetRandomSampler.__iter__
+        perm = torch.randperm(len(sampler.indices), generator=getattr(sampler, "generator", None))
+        return np.asarray(sampler.indices, dtype=np.int64)[perm.numpy()]
+    return np.fromiter(iter(sampler), dtype=np.int64)
 
 
 class GroupedBatchSampler(BatchSampler):
@@ -42,48 +46,132 @@ class GroupedBatchSampler(BatchSampler):
             )
         self.sampler = sampler
         self.group_ids = group_ids
+        self._group_ids = np.asarray(group_ids, dtype=np.int64)
         self.batch_size = batch_size
 
     def __iter__(self):
-        buffer_per_group = defaultdict(list)
-        samples_per_group = defaultdict(list)
-
-        num_batches = 0
-        for idx in self.sampler:
-            group_id = self.group_ids[idx]
-            buffer_per_group[group_id].append(idx)
-            samples_per_group[group_id].append(idx)
-            if len(buffer_per_group[group_id]) == self.batch_size:
-                yield buffer_per_group[group_id]
-                num_batches += 1
-                del buffer_per_group[group_id]
-            assert len(buffer_per_group[group_id]) < self.batch_size
+        # batches are assigned with array operations over the whole epoch: a batch of a group is
+        # complete when its batch_size-th sample (in sampler order) arrives, batches are yielded in
+        # that order
+        indices = sampler_indices(self.sampler)
+        groups = self._group_ids[indices]
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        _, group_start, group_count = np.unique(sorted_groups, return_index=True, return_counts=True)
+        rank = np.arange(len(indices)) - np.repeat(group_start, group_count)
+
+        batch_ends = np.nonzero(rank % self.batch_size == self.batch_size - 1)[0]
+        batch_ends = batch_ends[np.argsort(order[batch_ends], kind='stable')]
+        for end in batch_ends:
+            yield indices[order[end - self.batch_size + 1:end + 1]].tolist()
 
         # now we have run out of elements that satisfy
         # the group criteria, let's return the remaining
         # elements so that the size of the sampler is
         # deterministic
-        expected_num_batches = len(self)
-        num_remaining = expected_num_batches - num_batches
+        num_remaining = len(self) - len(batch_ends)
         if num_remaining > 0:
-            # for the remaining batches, take first the buffers with largest number
-            # of elements
-            for group_id, _ in sorted(buffer_per_group.items(),
-                                      key=lambda x: len(x[1]), reverse=True):
-                remaining = self.batch_size - len(buffer_per_group[group_id])
-                samples_from_group_id = _repeat_to_at_least(samples_per_group[group_id], remaining)
-                buffer_per_group[group_id].extend(samples_from_group_id[:remaining])
-                assert len(buffer_per_group[group_id]) == self.batch_size
-                yield buffer_per_group[group_id]
+            # for the remaining batches, take first the groups with largest number of leftover elements;
+            # ties go to the group whose last full batch (or first sample, if it had none) came first
+            num_full = group_count // self.batch_size
+            leftover = group_count - num_full * self.batch_size
+            last_event = order[np.where(num_full > 0, group_start + num_full * self.batch_size - 1, group_start)]
+            candidates = np.nonzero(leftover > 0)[0]
+            candidates = candidates[np.lexsort((last_event[candidates], -leftover[candidates]))]
+            for g in candidates[:num_remaining]:
+                samples = indices[order[group_start[g]:group_start[g] + group_count[g]]]
+                buffer = samples[num_full[g] * self.batch_size:]
+                # fill up by repeating the samples of the group from the start
+                fill = np.resize(samples, self.batch_size - len(buffer))
+                yield np.concatenate([buffer, fill]).tolist()
                 num_remaining -= 1
-                if num_remaining == 0:
-                    break
         assert num_remaining == 0
 
     def __len__(self):
         return len(self.sampler) // self.batch_size
 
 
+class SizeBucketedBatchSampler(BatchSampler):
+    """
+    Wraps another sampler to yield inference mini-batches of images that have the same (or a close)
+    shape after the resize and padding of GeneralizedRCNNTransform, so that little compute is spent on
+    padding. The indices of the wrapped sampler are ordered by padded shape and cut into batches;
+    ``restore_order`` puts per-image results computed in batch order back into the order of the
+    wrapped sampler (e.g. a SubsetSequentialSampler).
+    Arguments:
+        sampler (Sampler): Base sampler.
+        image_sizes (list[tuple[int, int]]): (height, width) of every sample of the dataset.
+        batch_size (int): Size of mini-batch.
+        min_size (int), max_size (int): resize parameters of the model's GeneralizedRCNNTransform.
+        size_divisible (int): padding of the batched images.
+    """
+    def __init__(self, sampler, image_sizes, batch_size, min_size=800, max_size=1333, size_divisible=32):
+        if not isinstance(sampler, Sampler):
+            raise ValueError(
+                "sampler should be an instance of "
+                "torch.utils.data.Sampler, but got sampler={}".format(sampler)
+            )
+        self.sampler = sampler
+        self.batch_size = batch_size
+        sizes = np.asarray(image_sizes, dtype=np.float64).reshape(-1, 2)
+        self.shapes = resized_shape(sizes[:, 0], sizes[:, 1], min_size, max_size, size_divisible)
+        self.order = None
+
+    def __iter__(self):
+        indices = sampler_indices(self.sampler)
+        heights, widths = self.shapes[0][indices], self.shapes[1][indices]
+        # stable, so images of the same shape keep the order of the base sampler
+        self.order = np.lexsort((np.arange(len(indices)), widths, heights))
+        indices = indices[self.order]
+        for start in range(0, len(indices), self.batch_size):
+            yield indices[start:start + self.batch_size].tolist()
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def restore_order(self, results):
+        """Reorders per-image ``results`` (tensor, array or list) from batch order to sampler order."""
+        inverse = np.empty_like(self.order)
+        inverse[self.order] = np.arange(len(self.order))
+        if isinstance(results, torch.Tensor):
+            return results[torch.from_numpy(inverse).to(results.device)]
+        if isinstance(results, np.ndarray):
+            return results[inverse]
+        return [results[i] for i in inverse]
+
+
+def resized_shape(height, width, min_size, max_size, size_divisible=32):
+    """Padded (height, width) of images after GeneralizedRCNNTransform, works on arrays."""
+    height, width = np.asarray(height, dtype=np.float64), np.asarray(width, dtype=np.float64)
+    scale = np.minimum(min_size / np.minimum(height, width), max_size / np.maximum(height, width))
+    height, width = np.floor(height * scale), np.floor(width * scale)
+    height = (np.ceil(height / size_divisible) * size_divisible).astype(np.int64)
+    width = (np.ceil(width / size_divisible) * size_divisible).astype(np.int64)
+    return height, width
+
+
+def compute_image_sizes(dataset, indices=None):
+    """(height, width) of the images of a dataset, from image_size_index or the fast paths of compute_aspect_ratios."""
+    index = image_size_index(dataset)
+    if index is not None:
+        if indices is not None:
+            index = index[np.asarray(indices, dtype=np.int64)]
+        return [tuple(size) for size in index[:, :2].tolist()]
+    if indices is None:
+        indices = range(len(dataset))
+    if hasattr(dataset, "get_height_and_width"):
+        return [tuple(dataset.get_height_and_width(i)) for i in indices]
+    if isinstance(dataset, torchvision.datasets.CocoDetection):
+        infos = [dataset.coco.imgs[dataset.ids[i]] for i in indices]
+        return [(info["height"], info["width"]) for info in infos]
+    if isinstance(dataset, torchvision.datasets.VOCDetection):
+        # this doesn't load the data into memory, because PIL loads it lazily
+        return [Image.open(dataset.images[i]).size[::-1] for i in indices]
+    if isinstance(dataset, torch.utils.data.Subset):
+        return compute_image_sizes(dataset.dataset, [dataset.indices[i] for i in indices])
+    return [tuple(dataset[i][0].shape[-2:]) for i in indices]
+
+
 def _compute_aspect_ratios_slow(dataset, indices=None):
     print("Your dataset doesn't support the fast path for "
           "computing the aspect ratios, so will iterate over "
@@ -140,15 +228,11 @@ def _compute_aspect_ratios_coco_dataset(dataset, indices=None):
 
 
 def _compute_aspect_ratios_voc_dataset(dataset, indices=None):
-    if indices is None:
-        indices = range(len(dataset))
-    aspect_ratios = []
-    for i in indices:
-        # this doesn't load the data into memory, because PIL loads it lazily
-        width, height = Image.open(dataset.images[i]).size
-        aspect_ratio = float(width) / float(height)
-        aspect_ratios.append(aspect_ratio)
-    return aspect_ratios
+    # sizes come from the <size> elements of the annotations, no image is opened
+    index = image_size_index(dataset)
+    if indices is not None:
+        index = index[np.asarray(indices, dtype=np.int64)]
+    return (index[:, 1].astype(np.float64) / index[:, 0]).tolist()
 
 
 def _compute_aspect_ratios_subset_dataset(dataset, indices=None):
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision
+from PIL import Image
+
+from .packed_store import PackedDetection, HEIGHT, WIDTH, IMAGE_BYTES
+
+# columns of an image size index
+INDEX_HEIGHT, INDEX_WIDTH, INDEX_BYTES = range(3)
+
+
+def read_voc_size(annotation):
+    """(height, width) from the <size> element of a VOC annotation, without parsing the objects."""
+    with open(annotation, 'rb') as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == 'size':
+                return int(float(elem.find('height').text)), int(float(elem.find('width').text))
+    return 0, 0
+
+
+def ids_digest(ids):
+    """Short hash of an ordered list of image ids, which names the caches built for exactly that image set."""
+    h = hashlib.sha1()
+    for i in ids:
+        h.update(str(i).encode('utf-8') + b'\n')
+    return h.hexdigest()[:16]
+
+
+def _file_bytes(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def _build_voc_index(dataset):
+    records = getattr(dataset, 'records', None)
+    if records is not None:
+        sizes = [tuple(s) for s in np.asarray(records.sizes)]
+    else:
+        sizes = [read_voc_size(a) for a in dataset.annotations]
+    index = np.zeros((len(sizes), 3), dtype=np.int64)
+    for i, (path, (height, width)) in enumerate(zip(dataset.images, sizes)):
+        if height <= 0 or width <= 0:
+            # a few annotations carry no size, fall back to the image header
+            width, height = Image.open(path).size
+        index[i] = height, width, _file_bytes(path)
+    return index
+
+
+def _build_coco_index(dataset):
+    infos = [dataset.coco.imgs[i] for i in dataset.ids]
+    return np.array([(info['height'], info['width'], _file_bytes(os.path.join(dataset.root, info['file_name'])))
+                     for info in infos], dtype=np.int64).reshape(-1, 3)
+
+
+def _cache_path(dataset):
+    if isinstance(dataset, torchvision.datasets.VOCDetection) and len(dataset.annotations):
+        digest = ids_digest(os.path.basename(a) for a in dataset.annotations)
+        return os.path.join(os.path.dirname(os.path.dirname(dataset.annotations[0])), 'AnnotationCache',
+                            getattr(dataset, 'image_set', ''), 'image_sizes-{}.npy'.format(digest))
+    if isinstance(dataset, torchvision.datasets.CocoDetection) and getattr(dataset, 'ann_file', None):
+        return os.path.splitext(dataset.ann_file)[0] + '_image_sizes-{}.npy'.format(ids_digest(dataset.ids))
+    return None
+
+
+def image_size_index(dataset):
+    """
+    (height, width, file bytes) of every image of ``dataset`` as an (N, 3) int64 array, read from the VOC xml
+    <size> elements, the COCO json or a packed index instead of the images. VOC and COCO indexes are saved
+    next to the annotations under a hash of the image ids, and loaded on later runs over the same images in the
+    same order. Returns None for datasets without such metadata.
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        index = image_size_index(dataset.dataset)
+        return None if index is None else index[np.asarray(dataset.indices, dtype=np.int64)]
+    index = getattr(dataset, '_image_size_index', None)
+    if index is not None:
+        return index
+    if isinstance(dataset, PackedDetection):
+        index = np.asarray(dataset.index[:, [HEIGHT, WIDTH, IMAGE_BYTES]])
+    elif isinstance(dataset, (torchvision.datasets.VOCDetection, torchvision.datasets.CocoDetection)):
+        path = _cache_path(dataset)
+        if path is not None and os.path.exists(path):
+            index = np.load(path)
+            if len(index) != len(dataset):
+                index = None
+        if index is None:
+            if isinstance(dataset, torchvision.datasets.VOCDetection):
+                index = _build_voc_index(dataset)
+            else:
+                index = _build_coco_index(dataset)
+            if path is not None:
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    np.save(path, index)
+                except OSError:
+                    # read-only dataset tree, keep the in-memory index
+                    pass
+    else:
+        return None
+    dataset._image_size_index = index
+    return index
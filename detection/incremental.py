@@ -0,0 +1,119 @@
+import json
+import os
+
+import torch
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
+
+
+class WeightedSubsetRandomSampler(Sampler):
+    r"""Samples elements from a given list of indices with replacement, using per-index weights.
+
+    Arguments:
+        indices (sequence): a sequence of dataset indices
+        weights (sequence): a sampling weight for every element of ``indices``
+        num_samples (int): number of indices drawn per epoch, defaults to ``len(indices)``
+    """
+
+    def __init__(self, indices, weights, num_samples=None):
+        self.indices = torch.as_tensor(indices, dtype=torch.int64)
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.num_samples = len(indices) if num_samples is None else num_samples
+
+    def __iter__(self):
+        inds = torch.multinomial(self.weights, self.num_samples, replacement=True)
+        return iter(self.indices[inds].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class WarmStart(object):
+    """
+    Carries model weights from one active learning cycle to the next. When enabled, every cycle after the
+    first one starts from the weights of the previous cycle and is fine-tuned for ``epochs`` epochs with
+    the images acquired since then drawn ``new_weight`` times more often than the already trained ones.
+    When disabled it reproduces the from-scratch behaviour of the training scripts.
+    """
+
+    def __init__(self, enabled=False, epochs=5, lr_steps=(4,), new_weight=3.0):
+        self.enabled = enabled
+        self.epochs = epochs
+        self.lr_steps = list(lr_steps)
+        self.new_weight = new_weight
+        self.state_dicts = None
+        self.trained_set = set()
+
+    @property
+    def active(self):
+        return self.enabled and self.state_dicts is not None
+
+    def total_epochs(self, total_epochs):
+        return self.epochs if self.active else total_epochs
+
+    def milestones(self, lr_steps):
+        return self.lr_steps if self.active else lr_steps
+
+    def sampler(self, labeled_set):
+        if not self.active:
+            return SubsetRandomSampler(labeled_set)
+        weights = [1.0 if i in self.trained_set else self.new_weight for i in labeled_set]
+        return WeightedSubsetRandomSampler(labeled_set, weights)
+
+    def load(self, *models):
+        if not self.active:
+            return
+        for model, state_dict in zip(models, self.state_dicts):
+            model.load_state_dict(state_dict)
+
+    def save(self, labeled_set, *models):
+        if not self.enabled:
+            return
+        self.state_dicts = [{k: v.detach().cpu().clone() for k, v in model.state_dict().items()} for model in models]
+        self.trained_set = set(labeled_set)
+
+    def state_dict(self):
+        return {'state_dicts': self.state_dicts, 'trained_set': sorted(self.trained_set)}
+
+    def load_state_dict(self, state):
+        self.state_dicts = state['state_dicts']
+        self.trained_set = set(state['trained_set'])
+
+
+class CycleReport(object):
+    """
+    Collects the mAP and training time of every active learning cycle, optionally writes them as json to
+    ``path`` and prints them next to a previously written report (e.g. of a from-scratch run).
+    """
+
+    def __init__(self, path=None, baseline_path=None):
+        self.path = path
+        self.cycles = []
+        self.baseline = {}
+        if baseline_path:
+            with open(baseline_path) as f:
+                self.baseline = {c['cycle']: c for c in json.load(f)['cycles']}
+
+    def state_dict(self):
+        return {'cycles': list(self.cycles)}
+
+    def load_state_dict(self, state):
+        """Cycles of an interrupted run, written again with those of the following cycles."""
+        self.cycles = list(state['cycles'])
+
+    def update(self, cycle, num_labeled, ap, train_time, incremental=False):
+        if ap is None:
+            return
+        self.cycles.append(dict(cycle=cycle, num_labeled=num_labeled, map=float(ap), train_time=train_time,
+                                incremental=incremental))
+        line = 'Cycle:[{}] labeled: {} mAP: {:.4f} train time: {:.0f}s'.format(cycle, num_labeled, ap, train_time)
+        if cycle in self.baseline:
+            base = self.baseline[cycle]
+            line += ' | baseline mAP: {:.4f} (delta {:+.4f}) train time: {:.0f}s ({:.2f}x)'.format(
+                base['map'], ap - base['map'], base['train_time'], base['train_time'] / max(train_time, 1e-6))
+        print(line)
+        if self.path:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump({'cycles': self.cycles}, f, indent=2)
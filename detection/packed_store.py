@@ -0,0 +1,233 @@
+r"""Packs a detection dataset into a few large shard files, read back by PackedDetection.
+
+Every sample is stored as its encoded image file followed by its pickled, already converted target
+(ConvertVOCtoCOCO / ConvertCocoPolysToMask output), one after the other in ``shard-XXXXX.bin`` files of about
+``--shard-size`` bytes. ``index.npy`` holds, per dataset index, the shard, the byte offset, the two lengths and
+the image (height, width). Reading a sample is one positioned read from an already open file, instead of an
+open of the image and (for VOC) the annotation xml on the network filesystem. For VOC, ``meta.json`` also keeps
+the classes, year, image set and devkit root, from which voc_evaluate reads the annotations. For COCO, the original
+annotations of the packed images (crowd regions included) are written to ``coco_gt.json``, the ground truth of
+coco_evaluate::
+
+    python -m detection.packed_store --dataset voc2007 -p /data/VOCdevkit/ --image-sets trainval test \
+        --out /data/voc2007_packed
+
+and train with ``--dataset voc2007_packed -p /data/voc2007_packed``.
+"""
+import io
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision
+from PIL import Image
+
+# columns of index.npy
+SHARD, OFFSET, IMAGE_BYTES, TARGET_BYTES, HEIGHT, WIDTH = range(6)
+
+
+def image_path(dataset, idx):
+    if isinstance(dataset, torch.utils.data.Subset):
+        return image_path(dataset.dataset, dataset.indices[idx])
+    if isinstance(dataset, torchvision.datasets.CocoDetection):
+        return os.path.join(dataset.root, dataset.coco.loadImgs(dataset.ids[idx])[0]['file_name'])
+    return dataset.images[idx]
+
+
+class _PackSource(torch.utils.data.Dataset):
+    """Encoded image bytes and pickled target of every sample of a dataset built without transforms."""
+
+    def __init__(self, dataset, drop_keys):
+        self.dataset = dataset
+        self.drop_keys = drop_keys
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        with open(image_path(self.dataset, idx), 'rb') as f:
+            data = f.read()
+        width, height = Image.open(io.BytesIO(data)).size
+        target = {k: v for k, v in self.dataset[idx][1].items() if k not in self.drop_keys}
+        return data, pickle.dumps(target, protocol=pickle.HIGHEST_PROTOCOL), height, width
+
+
+def _first(batch):
+    return batch[0]
+
+
+def _coco_ground_truth(dataset, out_dir):
+    indices = list(range(len(dataset)))
+    while isinstance(dataset, torch.utils.data.Subset):
+        indices = [dataset.indices[i] for i in indices]
+        dataset = dataset.dataset
+    if not isinstance(dataset, torchvision.datasets.CocoDetection):
+        return {}
+    coco = dataset.coco
+    img_ids = [dataset.ids[i] for i in indices]
+    with open(os.path.join(out_dir, 'coco_gt.json'), 'w') as f:
+        json.dump(dict(images=coco.loadImgs(img_ids), annotations=coco.loadAnns(coco.getAnnIds(imgIds=img_ids)),
+                       categories=coco.dataset.get('categories', [])), f)
+    return dict(coco_gt='coco_gt.json')
+
+
+def _voc_meta(dataset):
+    if not isinstance(dataset, torchvision.datasets.VOCDetection):
+        return {}
+    from .voc_utils import ConvertVOCtoCOCO
+    return dict(classes=list(ConvertVOCtoCOCO.CLASSES), year=dataset.year, image_set=dataset.image_set,
+                voc_root=os.path.abspath(dataset.root))
+
+
+def pack(dataset, out_dir, shard_size=1 << 30, num_workers=8, drop_keys=('masks',)):
+    """
+    Writes ``dataset`` (built with transforms=None, e.g. get_dataset(name, image_set, None, path)) to
+    ``out_dir``. ``drop_keys`` are target entries not stored, the instance masks of COCO by default.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    loader = torch.utils.data.DataLoader(_PackSource(dataset, drop_keys), batch_size=1, num_workers=num_workers,
+                                         collate_fn=_first)
+    index = np.zeros((len(dataset), 6), dtype=np.int64)
+    shards = []
+    f = None
+    try:
+        for i, (data, target, height, width) in enumerate(loader):
+            if f is None or f.tell() >= shard_size:
+                if f is not None:
+                    f.close()
+                shards.append('shard-{:05d}.bin'.format(len(shards)))
+                f = open(os.path.join(out_dir, shards[-1]), 'wb')
+            index[i] = len(shards) - 1, f.tell(), len(data), len(target), height, width
+            f.write(data)
+            f.write(target)
+            if i % 1000 == 0:
+                print('packed {}/{}'.format(i, len(dataset)))
+    finally:
+        if f is not None:
+            f.close()
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(num_samples=len(dataset), shards=shards, drop_keys=list(drop_keys), **_voc_meta(dataset),
+                       **_coco_ground_truth(dataset, out_dir)), f, indent=2)
+    return index
+
+
+class PackedDetection(torch.utils.data.Dataset):
+    """
+    Dataset over a directory written by ``pack``: random access by dataset index with ``__getitem__`` and
+    streaming in file order with ``stream``. Shards are opened once per process (data loader workers reopen
+    them after the fork). ``classes``, ``year``, ``image_set`` and ``voc_root`` are those of the packed VOC
+    dataset, None for COCO, and ``coco_gt`` the path of the original COCO annotations, None for VOC.
+    """
+
+    def __init__(self, root, transforms=None):
+        self.root = root
+        self._transforms = transforms
+        with open(os.path.join(root, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shards = meta['shards']
+        self.classes = meta.get('classes')
+        self.year = meta.get('year')
+        self.image_set = meta.get('image_set')
+        self.voc_root = meta.get('voc_root')
+        self.coco_gt = os.path.join(root, meta['coco_gt']) if meta.get('coco_gt') else None
+        self.index = np.load(os.path.join(root, 'index.npy'), mmap_mode='r')
+        self._files = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_height_and_width(self, idx):
+        return int(self.index[idx, HEIGHT]), int(self.index[idx, WIDTH])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_pid'] = None
+        return state
+
+    def _read(self, shard, offset, size):
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if shard not in self._files:
+            self._files[shard] = open(os.path.join(self.root, self.shards[shard]), 'rb', buffering=0)
+        f = self._files[shard]
+        if hasattr(os, 'pread'):
+            return os.pread(f.fileno(), size, offset)
+        f.seek(offset)
+        return f.read(size)
+
+    def _decode(self, data, image_bytes):
+        img = Image.open(io.BytesIO(data[:image_bytes])).convert('RGB')
+        target = pickle.loads(data[image_bytes:])
+        if self._transforms is not None:
+            img, target = self._transforms(img, target)
+        return img, target
+
+    def __getitem__(self, idx):
+        shard, offset, image_bytes, target_bytes = (int(v) for v in self.index[idx, :HEIGHT])
+        return self._decode(self._read(shard, offset, image_bytes + target_bytes), image_bytes)
+
+    def get_target(self, idx):
+        """The stored target of ``idx``, read without the image and without the transforms."""
+        shard, offset, image_bytes, target_bytes = (int(v) for v in self.index[idx, :HEIGHT])
+        return pickle.loads(self._read(shard, offset + image_bytes, target_bytes))
+
+    def stream(self, indices=None, chunk_size=64 << 20):
+        """
+        Yields (idx, image, target) for ``indices`` (all samples by default) in file order, reading every shard
+        front to back in reads of about ``chunk_size`` bytes.
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype=np.int64)
+        rows = np.asarray(self.index[indices])
+        order = np.lexsort((rows[:, OFFSET], rows[:, SHARD]))
+        start = 0
+        while start < len(order):
+            first = rows[order[start]]
+            end = start + 1
+            while end < len(order) and rows[order[end], SHARD] == first[SHARD]:
+                row = rows[order[end]]
+                if row[OFFSET] + row[IMAGE_BYTES] + row[TARGET_BYTES] - first[OFFSET] > chunk_size:
+                    break
+                end += 1
+            last = rows[order[end - 1]]
+            chunk = self._read(int(first[SHARD]), int(first[OFFSET]),
+                               int(last[OFFSET] + last[IMAGE_BYTES] + last[TARGET_BYTES] - first[OFFSET]))
+            for j in order[start:end]:
+                begin = int(rows[j, OFFSET] - first[OFFSET])
+                data = chunk[begin:begin + int(rows[j, IMAGE_BYTES] + rows[j, TARGET_BYTES])]
+                yield (int(indices[j]),) + self._decode(data, int(rows[j, IMAGE_BYTES]))
+            start = end
+
+
+def get_packed(root, image_set, transforms):
+    return PackedDetection(os.path.join(root, image_set), transforms=transforms)
+
+
+def main(args):
+    from .train import get_dataset
+
+    for image_set in args.image_sets:
+        dataset, _ = get_dataset(args.dataset, image_set, None, args.data_path)
+        print('packing {} {} ({} images)'.format(args.dataset, image_set, len(dataset)))
+        pack(dataset, os.path.join(args.out, image_set), args.shard_size << 20, args.workers)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--data-path', default='/data/yuweiping/coco/', help='dataset path')
+    parser.add_argument('--dataset', default='voc2007', help='dataset')
+    parser.add_argument('--image-sets', default=['trainval', 'test'], nargs='+', help='image sets to pack')
+    parser.add_argument('--out', required=True, help='directory of the packed dataset')
+    parser.add_argument('--shard-size', default=1024, type=int, help='shard size in MB')
+    parser.add_argument('-j', '--workers', default=8, type=int, help='number of data loading workers')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,97 @@
+import torch
+import torch.utils.data
+from torch.utils.data.sampler import BatchSampler, Sampler
+
+from . import utils
+from .group_by_aspect_ratio import GroupedBatchSampler, SizeBucketedBatchSampler, compute_image_sizes, \
+    create_aspect_ratio_groups, sampler_indices
+
+
+class SwappableSampler(Sampler):
+    r"""Forwards iteration to ``self.sampler``, which can be replaced between epochs.
+
+    Arguments:
+        sampler (Sampler): the sampler to start with
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def __iter__(self):
+        return iter(self.sampler)
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def index_array(self):
+        return sampler_indices(self.sampler)
+
+
+class PersistentLoaders(object):
+    """
+    Keeps one DataLoader per (dataset, role, batch size, pin_memory) alive for the whole active learning run.
+    The loaders use persistent workers, so worker processes and their dataset handles are started once; when
+    the labeled/unlabeled sets change only the sampler inside the batch sampler is swapped. Aspect ratio groups
+    are computed once per dataset as well.
+
+    A loader should be iterated to the end (or not at all) before it is requested again with a new sampler; a
+    loader left after a ``break`` is reset by DataLoader when iterated again, dropping its prefetched batches.
+    """
+
+    def __init__(self, num_workers, collate_fn=utils.collate_fn):
+        self.num_workers = num_workers
+        self.collate_fn = collate_fn
+        self._loaders = {}
+        self._group_ids = {}
+        self._image_sizes = {}
+
+    def _get(self, key, dataset, sampler, make_batch_sampler, pin_memory):
+        if key in self._loaders:
+            loader, swappable = self._loaders[key]
+            swappable.sampler = sampler
+            return loader
+        swappable = SwappableSampler(sampler)
+        loader = torch.utils.data.DataLoader(dataset, batch_sampler=make_batch_sampler(swappable),
+                                             num_workers=self.num_workers, collate_fn=self.collate_fn,
+                                             pin_memory=pin_memory, persistent_workers=self.num_workers > 0)
+        self._loaders[key] = (loader, swappable)
+        return loader
+
+    def group_ids(self, dataset, k):
+        key = (id(dataset), k)
+        if key not in self._group_ids:
+            self._group_ids[key] = create_aspect_ratio_groups(dataset, k=k)
+        return self._group_ids[key]
+
+    def image_sizes(self, dataset):
+        if id(dataset) not in self._image_sizes:
+            self._image_sizes[id(dataset)] = compute_image_sizes(dataset)
+        return self._image_sizes[id(dataset)]
+
+    def train(self, dataset, sampler, batch_size, aspect_ratio_group_factor=-1, pin_memory=False, role='train'):
+        """Training loader; a different ``role`` (e.g. 'unlabeled') keeps a second loader over the same dataset."""
+        if aspect_ratio_group_factor >= 0:
+            group_ids = self.group_ids(dataset, aspect_ratio_group_factor)
+
+            def make_batch_sampler(s):
+                return GroupedBatchSampler(s, group_ids, batch_size)
+        else:
+            def make_batch_sampler(s):
+                return BatchSampler(s, batch_size, drop_last=True)
+        key = (id(dataset), role, batch_size, aspect_ratio_group_factor, pin_memory)
+        return self._get(key, dataset, sampler, make_batch_sampler, pin_memory)
+
+    def sequential(self, dataset, sampler, batch_size=1, pin_memory=False, role='sequential'):
+        key = (id(dataset), role, batch_size, pin_memory)
+        return self._get(key, dataset, sampler, lambda s: BatchSampler(s, batch_size, drop_last=False), pin_memory)
+
+    def bucketed(self, dataset, sampler, batch_size, min_size=800, max_size=1333, pin_memory=False):
+        """
+        Inference loader batching images of similar resized shape, see SizeBucketedBatchSampler. Per-image
+        results go back to the order of ``sampler`` with ``loader.batch_sampler.restore_order``.
+        """
+        image_sizes = self.image_sizes(dataset)
+        key = (id(dataset), 'bucketed', batch_size, min_size, max_size, pin_memory)
+        return self._get(key, dataset, sampler,
+                         lambda s: SizeBucketedBatchSampler(s, image_sizes, batch_size, min_size, max_size),
+                         pin_memory)
@@ -17,6 +17,8 @@ from torchvision.ops.feature_pyramid_network import LastLevelP6P7
 from torchvision.ops import sigmoid_focal_loss
 from torchvision.ops import boxes as box_ops
 
+from .ssm_utils import judge_y, class_major_order
+
 __all__ = [
     "RetinaNet", "retinanet_resnet50_fpn",
 ]
@@ -237,19 +239,6 @@ class RetinaNetRegressionHead(nn.Module):
         return torch.cat(all_bbox_regression, dim=1)
 
 
-def judge_y(score):
-    '''return :
-    y:np.array len(score)
-    '''
-    y = []
-    for s in score:
-        if s == 1 or torch.log(s) > torch.log(1 - s):
-            y.append(1)
-        else:
-            y.append(-1)
-    return y
-
-
 class RetinaNet(nn.Module):
     """
     Implements RetinaNet.
@@ -490,96 +479,58 @@ class RetinaNet(nn.Module):
 
         class_logits = head_outputs.pop('cls_logits')
         box_regression = head_outputs.pop('bbox_regression')
-        other_outputs = head_outputs
 
         device = class_logits.device
         num_classes = class_logits.shape[-1]
 
         scores = torch.sigmoid(class_logits)
 
-        # create labels for each score
-        labels = torch.arange(num_classes, device=device)
-        labels = labels.view(1, -1).expand_as(scores)
-
         detections = torch.jit.annotate(List[Dict[str, Tensor]], [])
-        al_idx = 0
-        all_boxes = torch.empty([0, 4]).cuda()
-        all_scores = torch.tensor([]).cuda()
-        all_labels = []
         CONF_THRESH = 0.5  # bigger leads more active learning samples
-        for index, (box_regression_per_image, scores_per_image, labels_per_image, anchors_per_image, image_shape) in \
-                enumerate(zip(box_regression, scores, labels, anchors, image_shapes)):
+        for box_regression_per_image, scores_per_image, anchors_per_image, image_shape in \
+                zip(box_regression, scores, anchors, image_shapes):
             if torch.max(scores_per_image) < CONF_THRESH:
                 # print(scores)
-                al_idx = 1
                 detections.append({
-                    "boxes": all_boxes,
-                    "labels": all_labels,
-                    "scores": all_scores,
-                    'al': al_idx,
+                    "boxes": scores_per_image.new_zeros((0, 4)),
+                    "labels": torch.zeros((0, num_classes - 1), dtype=torch.int64, device=device),
+                    "scores": scores_per_image.new_zeros((0,)),
+                    'al': 1,
                 })
                 continue
             boxes_per_image = self.box_coder.decode_single(box_regression_per_image, anchors_per_image)
             boxes_per_image = box_ops.clip_boxes_to_image(boxes_per_image, image_shape)
 
-            other_outputs_per_image = [(k, v[index]) for k, v in other_outputs.items()]
-
-            image_boxes = []
-            image_scores = []
-            image_labels = []
-            image_other_outputs = torch.jit.annotate(Dict[str, List[Tensor]], {})
-
-            for class_index in range(num_classes):
-                # remove low scoring boxes
-                inds = torch.gt(scores_per_image[:, class_index], self.score_thresh)
-                boxes_per_class, scores_per_class, scores_all_class, labels_per_class = \
-                    boxes_per_image[inds], scores_per_image[inds, class_index], scores_per_image[inds], \
-                    labels_per_image[inds, class_index]
-                other_outputs_per_class = [(k, v[inds]) for k, v in other_outputs_per_image]
-
-                keep = [i for i in range(len(boxes_per_class))]
-                random.shuffle(keep)
-                keep = keep[:500]
-                boxes_per_class, scores_per_class, scores_all_class, labels_per_class = \
-                    boxes_per_class[keep], scores_per_class[keep], scores_all_class[keep], labels_per_class[keep]
-                other_outputs_per_class = [(k, v[keep]) for k, v in other_outputs_per_class]
+            # remove low scoring boxes, every (anchor, class) pair is a separate instance
+            anchor_inds, cls_inds = torch.nonzero(scores_per_image > self.score_thresh, as_tuple=True)
 
-                # remove empty boxes
-                keep = box_ops.remove_small_boxes(boxes_per_class, min_size=1e-2)
-                boxes_per_class, scores_per_class, scores_all_class, labels_per_class = \
-                    boxes_per_class[keep], scores_per_class[keep], scores_all_class[keep], labels_per_class[keep]
-                other_outputs_per_class = [(k, v[keep]) for k, v in other_outputs_per_class]
+            # keep a random subset of at most 500 boxes per class: the boxes of a class with the smallest random keys
+            generator = torch.Generator().manual_seed(random.getrandbits(63))
+            keys = torch.rand(len(anchor_inds), generator=generator, dtype=torch.float64).to(device)
+            order = torch.argsort(cls_inds.double() + keys)
+            anchor_inds, cls_inds = anchor_inds[order], cls_inds[order]
+            counts = torch.bincount(cls_inds, minlength=num_classes)
+            rank = torch.arange(len(cls_inds), device=device) - (torch.cumsum(counts, 0) - counts)[cls_inds]
+            anchor_inds, cls_inds = anchor_inds[rank < 500], cls_inds[rank < 500]
+            boxes_per_class, scores_per_class = boxes_per_image[anchor_inds], scores_per_image[anchor_inds, cls_inds]
 
-                # non-maximum suppression, independently done per class
-                keep = box_ops.nms(boxes_per_class, scores_per_class, self.nms_thresh)
+            # remove empty boxes
+            keep = box_ops.remove_small_boxes(boxes_per_class, min_size=1e-2)
 
-                # keep only topk scoring predictions
-                keep = keep[:self.detections_per_img]
-                boxes_per_class, scores_per_class, scores_all_class, labels_per_class = \
-                    boxes_per_class[keep], scores_per_class[keep], scores_all_class[keep], labels_per_class[keep]
-                other_outputs_per_class = [(k, v[keep]) for k, v in other_outputs_per_class]
+            # non-maximum suppression, independently done per class
+            keep = keep[box_ops.batched_nms(boxes_per_class[keep], scores_per_class[keep], cls_inds[keep],
+                                            self.nms_thresh)]
 
-                image_boxes.append(boxes_per_class)
-                image_scores.append(scores_per_class)
-                image_labels.append(labels_per_class)
-
-                for k, v in other_outputs_per_class:
-                    if k not in image_other_outputs:
-                        image_other_outputs[k] = []
-                    image_other_outputs[k].append(v)
+            # keep only topk scoring predictions
+            order, rank = class_major_order(keep, cls_inds[keep])
+            keep = keep[order][rank < self.detections_per_img]
 
-                for i in range(len(boxes_per_class)):
-                    all_boxes = torch.cat((all_boxes, boxes_per_class[i].unsqueeze(0)), 0)
-                    all_scores = torch.cat((all_scores, scores_per_class[i].unsqueeze(0)), 0)
-                    all_labels.append(judge_y(scores_all_class[i][1:]))
             detections.append({
-                "boxes": all_boxes,
-                "labels": all_labels,
-                "scores": all_scores,
-                'al': al_idx,
+                "boxes": boxes_per_class[keep],
+                "labels": judge_y(scores_per_image[anchor_inds[keep], 1:]),
+                "scores": scores_per_class[keep],
+                'al': 0,
             })
-            for k, v in image_other_outputs.items():
-                detections[-1].update({k: torch.cat(v, dim=0)})
 
         return detections
 
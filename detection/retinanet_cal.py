@@ -281,6 +281,7 @@ class RetinaNet(nn.Module):
         score_thresh (float): Score threshold used for postprocessing the detections.
         nms_thresh (float): NMS threshold used for postprocessing the detections.
         detections_per_img (int): Number of best detections to keep after NMS.
+        topk_candidates (int): Number of best scoring boxes per class to keep before NMS, all if None.
         fg_iou_thresh (float): minimum IoU between the anchor and the GT box so that they can be
             considered as positive during training.
         bg_iou_thresh (float): maximum IoU between the anchor and the GT box so that they can be
@@ -331,7 +332,8 @@ class RetinaNet(nn.Module):
                  score_thresh=0.05,
                  nms_thresh=0.5,
                  detections_per_img=300,
-                 fg_iou_thresh=0.5, bg_iou_thresh=0.4):
+                 fg_iou_thresh=0.5, bg_iou_thresh=0.4,
+                 topk_candidates=None):
         super().__init__()
 
         if not hasattr(backbone, "out_channels"):
@@ -374,6 +376,7 @@ class RetinaNet(nn.Module):
         self.score_thresh = score_thresh
         self.nms_thresh = nms_thresh
         self.detections_per_img = detections_per_img
+        self.topk_candidates = topk_candidates
 
         # used only on torchscript mode
         self._has_warned = False
@@ -438,7 +441,7 @@ class RetinaNet(nn.Module):
                 # remove low scoring boxes
                 inds = torch.gt(scores_per_image[:, class_index], self.score_thresh)
                 if not True in inds:
-                    prob_max = torch.Tensor([]).cuda()
+                    prob_max = torch.Tensor([]).to(boxes_per_image.device)
                     boxes_per_class, scores_per_class, scores_all_class, labels_per_class = \
                         boxes_per_image[inds], scores_per_image[inds, class_index], scores_per_image[inds], \
                         labels_per_image[inds, class_index]
@@ -449,6 +452,13 @@ class RetinaNet(nn.Module):
                 # print(boxes_per_class.shape, scores_all_class.shape)
                 other_outputs_per_class = [(k, v[inds]) for k, v in other_outputs_per_image]
 
+                if self.topk_candidates is not None and len(scores_per_class) > self.topk_candidates:
+                    keep = scores_per_class.topk(self.topk_candidates)[1]
+                    boxes_per_class, scores_per_class, scores_all_class, prob_max, labels_per_class, = \
+                        boxes_per_class[keep], scores_per_class[keep], scores_all_class[keep], \
+                        prob_max[keep], labels_per_class[keep]
+                    other_outputs_per_class = [(k, v[keep]) for k, v in other_outputs_per_class]
+
                 # remove empty boxes
                 keep = box_ops.remove_small_boxes(boxes_per_class, min_size=1e-2)
                 boxes_per_class, scores_per_class, scores_all_class, prob_max, labels_per_class, = \
@@ -0,0 +1,17 @@
+import torch
+
+
+def judge_y(score):
+    '''return :
+    y: 1 where the class is predicted and -1 elsewhere, same shape as score (one row per box)
+    '''
+    return ((score == 1) | (torch.log(score) > torch.log(1 - score))).long() * 2 - 1
+
+
+def class_major_order(keep, classes):
+    '''positions of ``keep`` (sorted by decreasing score) ordered by class, and their rank within their class'''
+    order = torch.argsort(classes * len(keep) + torch.arange(len(keep), device=keep.device))
+    classes = classes[order]
+    counts = torch.bincount(classes, minlength=int(classes.max()) + 1 if len(classes) else 0)
+    starts = torch.cumsum(counts, 0) - counts
+    return order, torch.arange(len(order), device=keep.device) - starts[classes]
@@ -0,0 +1,134 @@
+import numpy as np
+import torch
+
+from ll4al.data.sampler import SubsetSequentialSampler
+
+from .acquisition import SCORING_PROFILE, AcquisitionSweep, class_balanced_select, inference_profile, \
+    k_center_greedy
+
+# letters of the CALD augmentations, as in cald_train's --augs
+AUG_LETTERS = (('F', 'flip'), ('C', 'cut_out'), ('D', 'smaller_resize'), ('R', 'rotation'), ('G', 'ga'), ('S', 'sp'))
+
+STRATEGIES = {}
+
+
+def register(name):
+    """Class decorator adding a strategy to STRATEGIES under ``name``."""
+    def wrap(cls):
+        cls.name = name
+        STRATEGIES[name] = cls
+        return cls
+    return wrap
+
+
+def get_strategy(name):
+    if name not in STRATEGIES:
+        raise ValueError('unknown strategy {}, choose from {}'.format(name, ', '.join(sorted(STRATEGIES))))
+    return STRATEGIES[name]
+
+
+class Strategy(object):
+    """
+    Acquisition strategy of al_train. ``score`` maps a loader over the pool (PIL images of the dataset without
+    transforms when ``pil_pool``, else training-transformed tensors) to one score per image in loader order,
+    ``select`` maps those scores to the positions in the pool to acquire. Lower scores are acquired first
+    unless ``ascending`` is False. ``prepare`` is called with the labeled set before every scoring.
+    """
+    name = None
+    ascending = True
+    pil_pool = True
+
+    def __init__(self, args, num_classes):
+        self.args = args
+        self.num_classes = num_classes
+
+    def prepare(self, loaders, dataset, labeled_set):
+        pass
+
+    def score(self, task_model, loader):
+        raise NotImplementedError
+
+    def select(self, scores, budget):
+        order = np.argsort(np.asarray(scores), kind='stable')
+        if not self.ascending:
+            order = order[::-1]
+        return order[:budget].tolist()
+
+
+class SweepStrategy(Strategy):
+    """Strategy scored by detection.acquisition.AcquisitionSweep, under SCORING_PROFILE with --scoring-profile."""
+
+    def augs(self):
+        return [aug for letter, aug in AUG_LETTERS if letter in self.args.augs]
+
+    def sweep(self, task_model, loader):
+        sweep = AcquisitionSweep(task_model, self.num_classes, self.augs(), self.args.bp, strategies=(self.name,))
+        with inference_profile(task_model, **(SCORING_PROFILE if self.args.scoring_profile else {})):
+            return sweep.run(loader)
+
+    def score(self, task_model, loader):
+        sweep = self.sweep(task_model, loader)
+        if self.name not in sweep.scores:
+            raise ValueError('{} cannot be scored with {}'.format(self.name, self.args.model))
+        return sweep.scores[self.name]
+
+
+@register('cald')
+class CALD(SweepStrategy):
+    """
+    Least consistent images over the augmented views. As in cald_train, the --mr x budget least consistent ones
+    are balanced against the classes of the labeled set (class_balanced_select) unless --no-mutual. The scores
+    are the consistency followed by the class scores of every image.
+    """
+
+    def prepare(self, loaders, dataset, labeled_set):
+        counts = np.zeros((len(labeled_set), self.num_classes - 1))
+        loader = loaders.sequential(dataset, SubsetSequentialSampler(labeled_set), role='labeled')
+        i = 0
+        for _, targets in loader:
+            for target in targets:
+                np.add.at(counts[i], np.asarray(target['labels']) - 1, 1)
+                i += 1
+        self.labeled_counts = counts.mean(0)
+
+    def score(self, task_model, loader):
+        sweep = self.sweep(task_model, loader)
+        return np.column_stack([sweep.scores['cald'], np.stack(sweep.cls_corrs)])
+
+    def select(self, scores, budget):
+        order = np.argsort(scores[:, 0], kind='stable')
+        if self.args.no_mutual:
+            return order[:budget].tolist()
+        candidates = order[:int(self.args.mr * budget)]
+        return candidates[class_balanced_select(self.labeled_counts, scores[candidates, 1:], budget,
+                                                self.args.uniform)].tolist()
+
+
+@register('ls_c')
+class LocalizationStability(SweepStrategy):
+    """Least stable boxes under Gaussian noise."""
+
+
+@register('lt_c')
+class LocalizationTightness(SweepStrategy):
+    """Least tight box/proposal pairs, Faster R-CNN only."""
+
+
+@register('diversity')
+class Diversity(SweepStrategy):
+    """Core-set selection over pooled backbone features; the scores are the embeddings."""
+
+    def score(self, task_model, loader):
+        return torch.stack(self.sweep(task_model, loader).embeddings).cpu().numpy()
+
+    def select(self, scores, budget):
+        return k_center_greedy(torch.from_numpy(np.asarray(scores)), budget)
+
+
+@register('random')
+class Random(Strategy):
+    """Uniformly random images; nothing is run through the model."""
+    pil_pool = False
+
+    def score(self, task_model, loader):
+        return np.random.rand(len(loader.batch_sampler.sampler))
@@ -29,9 +29,11 @@ import torchvision.models.detection
 import torchvision.models.detection.mask_rcnn
 
 from .coco_utils import get_coco, get_coco_kp
-from .voc_utils import get_voc2007, get_voc2012
+from .voc_utils import get_voc2007, get_voc2012, get_voc2007_cached, get_voc2012_cached
+from .packed_store import get_packed
 from .group_by_aspect_ratio import GroupedBatchSampler, create_aspect_ratio_groups
 from .engine import train_one_epoch
+from .train_step import TrainStep
 from .engine import coco_evaluate as evaluate
 
 from . import utils
@@ -43,7 +45,13 @@ def get_dataset(name, image_set, transform, data_path):
         "coco": (data_path, get_coco, 91),
         "coco_kp": (data_path, get_coco_kp, 2),
         "voc2007": (data_path, get_voc2007, 21),
-        "voc2012": (data_path, get_voc2012, 21)
+        "voc2012": (data_path, get_voc2012, 21),
+        "voc2007_cached": (data_path, get_voc2007_cached, 21),
+        "voc2012_cached": (data_path, get_voc2012_cached, 21),
+        # directories written by detection.packed_store
+        "coco_packed": (data_path, get_packed, 91),
+        "voc2007_packed": (data_path, get_packed, 21),
+        "voc2012_packed": (data_path, get_packed, 21)
     }
     p, ds_fn, num_classes = paths[name]
 
@@ -51,9 +59,10 @@ def get_dataset(name, image_set, transform, data_path):
     return ds, num_classes
 
 
-def get_transform(train):
+def get_transform(train, uint8=False):
     transforms = []
-    transforms.append(T.ToTensor())
+    # uint8 images are converted to float on the device by utils.images_to_device
+    transforms.append(T.PILToTensor() if uint8 else T.ToTensor())
     if train:
         transforms.append(T.RandomHorizontalFlip(0.5))
     return T.Compose(transforms)
@@ -68,7 +77,8 @@ def main(args):
     # Data loading code
     print("Loading data")
 
-    dataset, num_classes = get_dataset(args.dataset, "train", get_transform(train=True), args.data_path)
+    dataset, num_classes = get_dataset(args.dataset, "train", get_transform(True, args.uint8_images),
+                                       args.data_path)
     dataset_test, _ = get_dataset(args.dataset, "val", get_transform(train=False), args.data_path)
 
     print("Creating data loaders")
@@ -88,7 +98,7 @@ def main(args):
 
     data_loader = torch.utils.data.DataLoader(
         dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-        collate_fn=utils.collate_fn)
+        collate_fn=utils.collate_fn, pin_memory=args.uint8_images)
 
     data_loader_test = torch.utils.data.DataLoader(
         dataset_test, batch_size=1,
@@ -110,6 +120,7 @@ def main(args):
 
     # lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_step_size, gamma=args.lr_gamma)
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_steps, gamma=args.lr_gamma)
+    train_step = TrainStep(optimizer, device, args.amp, args.accumulation_steps)
 
     if args.resume:
         checkpoint = torch.load(args.resume, map_location='cpu')
@@ -127,7 +138,7 @@ def main(args):
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
-        train_one_epoch(model, optimizer, data_loader, device, epoch, args.print_freq)
+        train_one_epoch(model, optimizer, data_loader, device, epoch, args.print_freq, train_step)
         lr_scheduler.step()
         if args.output_dir:
             utils.save_on_master({
@@ -174,6 +185,12 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 22], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=20, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--uint8-images', action='store_true',
+                        help='keep training images uint8 up to the device, where they are converted to float')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
     parser.add_argument('--output-dir', default='.', help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--start_epoch', default=0, type=int, help='start epoch')
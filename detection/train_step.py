@@ -0,0 +1,108 @@
+import contextlib
+import math
+import sys
+
+import torch
+import torch.distributed as dist
+
+from . import utils
+
+
+class TrainStep(object):
+    """
+    Backward and optimizer step shared by the train_one_epoch functions of the training scripts.
+
+    With ``amp`` the forward pass runs under autocast (fp16 with a GradScaler on CUDA, bf16 on CPU from torch
+    1.10) and gradients are accumulated over ``accumulation_steps`` iterations before the optimizers step, a
+    shorter last group of the epoch being averaged over its own length. The logged losses of every iteration stay
+    on the device and are only reduced over processes, checked for finiteness and handed to the MetricLogger, one
+    update per iteration, on the iterations where ``log_every`` prints, so other iterations do not wait for the
+    device while the meters still smooth over iterations.
+    The lr schedulers passed to ``start_epoch`` are stepped every iteration, like before.
+    """
+
+    def __init__(self, optimizers, device, amp=False, accumulation_steps=1):
+        if not isinstance(optimizers, (list, tuple)):
+            optimizers = [optimizers]
+        self.optimizers = list(optimizers)
+        self.device = torch.device(device)
+        self.amp = amp
+        self.accumulation_steps = max(accumulation_steps, 1)
+        self.scaler = torch.cuda.amp.GradScaler() if amp and self.device.type == 'cuda' else None
+        self.start_epoch(None, 1, 0)
+
+    def start_epoch(self, metric_logger, print_freq, num_iters, lr_schedulers=()):
+        self.metric_logger = metric_logger
+        self.print_freq = print_freq
+        self.num_iters = num_iters
+        self.lr_schedulers = [s for s in lr_schedulers if s is not None]
+        self.iteration = 0
+        self._values = []
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def autocast(self):
+        if not self.amp:
+            return contextlib.nullcontext()
+        if self.device.type == 'cuda':
+            return torch.cuda.amp.autocast()
+        if hasattr(torch, 'cpu') and hasattr(torch.cpu, 'amp'):
+            return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+        # no CPU autocast before torch 1.10
+        return contextlib.nullcontext()
+
+    def __call__(self, losses, **meters):
+        """Backpropagates ``losses`` and records the scalar tensors in ``meters`` for logging."""
+        group_size = self.accumulation_steps
+        tail = self.num_iters % self.accumulation_steps
+        if tail and self.iteration >= self.num_iters - tail:
+            # the last, shorter group of the epoch
+            group_size = tail
+        losses = losses / group_size
+        if self.scaler is not None:
+            self.scaler.scale(losses).backward()
+        else:
+            losses.backward()
+        self.iteration += 1
+
+        if self.iteration % self.accumulation_steps == 0 or self.iteration == self.num_iters:
+            for optimizer in self.optimizers:
+                if self.scaler is not None:
+                    self.scaler.step(optimizer)
+                else:
+                    optimizer.step()
+            if self.scaler is not None:
+                self.scaler.update()
+            for optimizer in self.optimizers:
+                optimizer.zero_grad()
+        for lr_scheduler in self.lr_schedulers:
+            lr_scheduler.step()
+
+        if meters:
+            self._values.append({name: value.detach().float() for name, value in meters.items()})
+
+        # same condition log_every prints on
+        i = self.iteration - 1
+        if i % self.print_freq == 0 or self.iteration == self.num_iters:
+            self.flush()
+
+    def flush(self):
+        if not self._values:
+            return
+        names = list(self._values[0])
+        # one row per iteration, materialized with a single copy
+        values = torch.stack([torch.stack([row[name] for name in names]) for row in self._values])
+        world_size = utils.get_world_size()
+        if world_size > 1:
+            dist.all_reduce(values)
+            values /= world_size
+        rows = [dict(zip(names, row)) for row in values.tolist()]
+        self._values = []
+
+        for meters in rows:
+            if not all(math.isfinite(v) for v in meters.values()):
+                print("Loss is {}, stopping training".format(meters))
+                sys.exit(1)
+        if self.metric_logger is not None:
+            for meters in rows:
+                self.metric_logger.update(**meters)
@@ -1,4 +1,6 @@
 import random
+
+import numpy as np
 import torch
 
 from torchvision.transforms import functional as F
@@ -48,3 +50,15 @@ class ToTensor(object):
     def __call__(self, image, target):
         image = F.to_tensor(image)
         return image, target
+
+
+class PILToTensor(object):
+    """
+    Keeps the decoded bytes as a uint8 CHW tensor, a quarter of the float32 image of ToTensor through the worker
+    queues and the host to device copy. utils.images_to_device makes it float on the device.
+    """
+    def __call__(self, image, target):
+        image = np.array(image, dtype=np.uint8, copy=True)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        return torch.from_numpy(image).permute(2, 0, 1).contiguous(), target
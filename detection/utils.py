@@ -3,6 +3,7 @@ import datetime
 import pickle
 import time
 
+import numpy as np
 import torch
 import torch.distributed as dist
 
@@ -43,13 +44,13 @@ class SmoothedValue(object):
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        # lower median, like torch.median
+        d = sorted(self.deque)
+        return d[(len(d) - 1) // 2]
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return sum(self.deque) / len(self.deque)
 
     @property
     def global_avg(self):
@@ -115,6 +116,48 @@ def all_gather(data):
     return data_list
 
 
+def all_gather_tensor(data):
+    """
+    Run all_gather on a numeric tensor or numpy array without pickling. The first dimension may differ
+    between ranks: the sizes are gathered first, then the payload padded to the largest size. Uses CUDA
+    tensors with the nccl backend and CPU tensors otherwise (e.g. gloo).
+    Args:
+        data: torch.Tensor or np.ndarray
+    Returns:
+        list[data]: list of tensors (arrays for numpy input) gathered from each rank
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [data]
+
+    is_numpy = isinstance(data, np.ndarray)
+    tensor = torch.from_numpy(np.ascontiguousarray(data)) if is_numpy else data
+    out_device, dtype = tensor.device, tensor.dtype
+    device = torch.device("cuda") if dist.get_backend() == "nccl" else torch.device("cpu")
+    tensor = tensor.to(device)
+    if dtype == torch.bool:
+        tensor = tensor.to(torch.uint8)
+
+    local_size = torch.tensor([tensor.shape[0]], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    tensor_list = [torch.empty((max_size,) + tensor.shape[1:], dtype=tensor.dtype, device=device)
+                   for _ in size_list]
+    if tensor.shape[0] != max_size:
+        padding = torch.empty((max_size - tensor.shape[0],) + tensor.shape[1:], dtype=tensor.dtype, device=device)
+        tensor = torch.cat((tensor, padding), dim=0)
+    dist.all_gather(tensor_list, tensor)
+
+    data_list = []
+    for size, tensor in zip(size_list, tensor_list):
+        tensor = tensor[:size].to(dtype)
+        data_list.append(tensor.cpu().numpy() if is_numpy else tensor.to(out_device))
+    return data_list
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -143,9 +186,21 @@ def reduce_dict(input_dict, average=True):
 
 
 class MetricLogger(object):
-    def __init__(self, delimiter="\t"):
+    """
+    With ``deferred=True`` the peak memory is only queried for the final summary and ``log_every`` prints,
+    as ``window img/s``, and records in ``self.throughput`` the images/s of every window between two printed
+    lines: the images yielded in the window over its wall time, not a per-iteration figure. Losses reach
+    ``update`` as one float per iteration from TrainStep.flush, which synchronizes with the device on exactly
+    the printed iterations, so the loss meters keep their per-iteration median/avg while on CUDA a window's time
+    covers the device work of its iterations (the first window also holds the warmup). ``time`` is the host
+    time per iteration and so only averages out to the device time over a window.
+    """
+
+    def __init__(self, delimiter="\t", deferred=False):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.deferred = deferred
+        self.throughput = []
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
@@ -186,56 +241,61 @@ class MetricLogger(object):
         iter_time = SmoothedValue(fmt='{avg:.4f}')
         data_time = SmoothedValue(fmt='{avg:.4f}')
         space_fmt = ':' + str(len(str(len(iterable)))) + 'd'
-        if torch.cuda.is_available():
-            log_msg = self.delimiter.join([
-                header,
-                '[{0' + space_fmt + '}/{1}]',
-                'eta: {eta}',
-                '{meters}',
-                'time: {time}',
-                'data: {data}',
-                'max mem: {memory:.0f}'
-            ])
-        else:
-            log_msg = self.delimiter.join([
-                header,
-                '[{0' + space_fmt + '}/{1}]',
-                'eta: {eta}',
-                '{meters}',
-                'time: {time}',
-                'data: {data}'
-            ])
+        log_memory = torch.cuda.is_available() and not self.deferred
+        parts = [header, '[{0' + space_fmt + '}/{1}]', 'eta: {eta}', '{meters}', 'time: {time}', 'data: {data}']
+        if log_memory:
+            parts.append('max mem: {memory:.0f}')
+        if self.deferred:
+            parts.append('window img/s: {throughput:.1f}')
+        log_msg = self.delimiter.join(parts)
         MB = 1024.0 * 1024.0
+        window_start = time.time()
+        window_images = 0
         for obj in iterable:
             data_time.update(time.time() - end)
             yield obj
             iter_time.update(time.time() - end)
+            window_images += _batch_size(obj)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                if self.deferred:
+                    now = time.time()
+                    self.throughput.append(window_images / max(now - window_start, 1e-9))
+                    window_start, window_images = now, 0
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
-                if torch.cuda.is_available():
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time),
-                        memory=torch.cuda.max_memory_allocated() / MB))
-                else:
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time)))
+                print(log_msg.format(
+                    i, len(iterable), eta=eta_string,
+                    meters=str(self),
+                    time=str(iter_time), data=str(data_time),
+                    memory=torch.cuda.max_memory_allocated() / MB if log_memory else 0,
+                    throughput=self.throughput[-1] if self.throughput else 0))
             i += 1
             end = time.time()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
-        print('{} Total time: {} ({:.4f} s / it)'.format(
-            header, total_time_str, total_time / len(iterable)))
+        summary = '{} Total time: {} ({:.4f} s / it)'.format(header, total_time_str, total_time / len(iterable))
+        if self.deferred and torch.cuda.is_available():
+            summary += ' max mem: {:.0f}'.format(torch.cuda.max_memory_allocated() / MB)
+        print(summary)
+
+
+def _batch_size(obj):
+    # (images, targets) batches from collate_fn; anything else counts as one sample
+    if isinstance(obj, (tuple, list)) and len(obj) and isinstance(obj[0], (tuple, list, torch.Tensor)):
+        return len(obj[0])
+    return 1
 
 
 def collate_fn(batch):
     return tuple(zip(*batch))
 
 
+def images_to_device(images, device):
+    """Moves images to ``device``; uint8 images (T.PILToTensor) become float in [0, 1] there, like F.to_tensor."""
+    images = [image.to(device, non_blocking=True) for image in images]
+    return [image.float().div_(255) if image.dtype == torch.uint8 else image for image in images]
+
+
 def warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor):
 
     def f(x):
@@ -108,7 +108,7 @@ def voc_eval(classname,
     for imagename in imagenames:
         R = [obj for obj in recs[imagename] if obj['name'] == classname]
         bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
+        difficult = np.array([x['difficult'] for x in R]).astype(bool)
         det = [False] * len(R)
         npos = npos + sum(~difficult)
         class_recs[imagename] = {'bbox': bbox,
@@ -222,19 +222,24 @@ def _write_voc_results_file(all_boxes, image_index, path, classes):
                                    dets[k, 2] + 1, dets[k, 3] + 1))
 
 
+def voc_devkit(dataset):
+    '''(devkit root, image set, classes) of a VOC dataset, read from meta.json for a packed one'''
+    if hasattr(dataset, 'voc_root'):
+        if dataset.voc_root is None:
+            raise ValueError('{} was packed without its VOC devkit, pack it again'.format(dataset.root))
+        return dataset.voc_root, dataset.image_set, dataset.classes
+    return dataset.root, dataset.image_set, dataset._transforms.transforms[0].CLASSES
+
+
 def _do_python_eval(data_loader, year, path):
+    root, image_set, classes = voc_devkit(data_loader.dataset)
     if '2012' in year:
-        imagesetfile = os.path.join(data_loader.dataset.root,
-                                    'VOCdevkit/VOC2012/ImageSets/Main/' + data_loader.dataset.image_set + '.txt')
-        annopath = os.path.join(data_loader.dataset.root,
-                                'VOCdevkit/VOC2012/Annotations/{:s}.xml')
+        imagesetfile = os.path.join(root, 'VOCdevkit/VOC2012/ImageSets/Main/' + image_set + '.txt')
+        annopath = os.path.join(root, 'VOCdevkit/VOC2012/Annotations/{:s}.xml')
     if '2007' in year:
-        imagesetfile = os.path.join(data_loader.dataset.root,
-                                    'VOCdevkit/VOC2007/ImageSets/Main/' + data_loader.dataset.image_set + '.txt')
-        annopath = os.path.join(data_loader.dataset.root,
-                                'VOCdevkit/VOC2007/Annotations/{:s}.xml')
+        imagesetfile = os.path.join(root, 'VOCdevkit/VOC2007/ImageSets/Main/' + image_set + '.txt')
+        annopath = os.path.join(root, 'VOCdevkit/VOC2007/Annotations/{:s}.xml')
 
-    classes = data_loader.dataset._transforms.transforms[0].CLASSES
     ap_cls = []
     rec_cls = []
     ap_75 = []
@@ -264,3 +269,4 @@ def _do_python_eval(data_loader, year, path):
         print('{}|'.format(round(ap * 100, 1)), end='')
     print('')
     print('=====================================================================================================')
+    return np.mean(ap_50)
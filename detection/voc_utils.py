@@ -1,7 +1,16 @@
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision
+from PIL import Image
 
 from . import transforms as T
+from . import utils
+from .image_index import ids_digest
 
 
 class ConvertVOCtoCOCO(object):
@@ -15,6 +24,9 @@ class ConvertVOCtoCOCO(object):
 
     def __call__(self, image, target):
         # return image, target
+        if 'annotations' not in target:
+            # already converted, e.g. by VOCDetectionCached
+            return image, target
         anno = target['annotations']
         filename = anno["filename"].split('.')[0]
         h, w = anno['size']['height'], anno['size']['width']
@@ -58,6 +70,125 @@ class VOCDetection(torchvision.datasets.VOCDetection):
         return img, target
 
 
+class VOCAnnotationRecords(object):
+    """
+    All annotations of a VOC image set parsed once into flat arrays. The objects of image ``i`` are
+    ``boxes[offsets[i]:offsets[i + 1]]`` (likewise ``labels`` and ``difficult``), ``names[i, :name_lengths[i]]``
+    is its file name as int8 character codes and ``sizes[i]`` its (height, width).
+    When ``cache_dir`` is given the arrays are saved there as .npy files named after a hash of the annotation
+    file names and memory-mapped on later runs over the same annotations, so data loader workers share the same
+    pages instead of parsing xml. Each file is written under a temporary name and moved into place, and under
+    distributed training only the main process builds the cache while the others wait for it.
+    """
+    FIELDS = ('boxes', 'labels', 'difficult', 'offsets', 'names', 'name_lengths', 'sizes')
+
+    def __init__(self, arrays):
+        for k in self.FIELDS:
+            setattr(self, k, arrays[k])
+
+    @classmethod
+    def from_files(cls, annotations, classes):
+        boxes, labels, difficult, offsets, names, sizes = [], [], [], [0], [], []
+        for path in annotations:
+            root = ET.parse(path).getroot()
+            names.append(os.path.splitext(root.find('filename').text)[0])
+            size = root.find('size')
+            sizes.append([int(size.find('height').text), int(size.find('width').text)])
+            for obj in root.iter('object'):
+                bbox = obj.find('bndbox')
+                boxes.append([int(float(bbox.find(n).text)) - 1 for n in ['xmin', 'ymin', 'xmax', 'ymax']])
+                labels.append(classes.index(obj.find('name').text.strip()))
+                ishard = obj.find('difficult')
+                difficult.append(int(ishard.text) if ishard is not None else 0)
+            offsets.append(len(boxes))
+        name_lengths = np.array([len(n) for n in names], dtype=np.int64)
+        name_codes = np.zeros((len(names), max(name_lengths.max(initial=0), 1)), dtype=np.int8)
+        for i, n in enumerate(names):
+            name_codes[i, :len(n)] = [ord(c) for c in n]
+        return cls(dict(boxes=np.array(boxes, dtype=np.float32).reshape(-1, 4),
+                        labels=np.array(labels, dtype=np.int64),
+                        difficult=np.array(difficult, dtype=np.int64),
+                        offsets=np.array(offsets, dtype=np.int64),
+                        names=name_codes, name_lengths=name_lengths,
+                        sizes=np.array(sizes, dtype=np.int64).reshape(-1, 2)))
+
+    @classmethod
+    def load(cls, annotations, classes, cache_dir=None):
+        if cache_dir is None or not utils.is_dist_avail_and_initialized():
+            return cls._load(annotations, classes, cache_dir)
+        if utils.is_main_process():
+            records = cls._load(annotations, classes, cache_dir)
+        dist.barrier()
+        if not utils.is_main_process():
+            records = cls._load(annotations, classes, cache_dir)
+        return records
+
+    @classmethod
+    def _load(cls, annotations, classes, cache_dir):
+        if cache_dir is not None:
+            digest = ids_digest(os.path.basename(a) for a in annotations)
+            paths = {k: os.path.join(cache_dir, '{}-{}.npy'.format(k, digest)) for k in cls.FIELDS}
+            if all(os.path.exists(p) for p in paths.values()):
+                arrays = {k: np.load(p, mmap_mode='r') for k, p in paths.items()}
+                if len(arrays['offsets']) == len(annotations) + 1:
+                    return cls(arrays)
+        records = cls.from_files(annotations, classes)
+        if cache_dir is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                for k, p in paths.items():
+                    fd, tmp = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+                    try:
+                        with os.fdopen(fd, 'wb') as f:
+                            np.save(f, getattr(records, k))
+                        os.replace(tmp, p)
+                    except BaseException:
+                        os.remove(tmp)
+                        raise
+            except OSError:
+                # read-only dataset tree, keep the in-memory records
+                pass
+        return records
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def target(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        target = {}
+        target["boxes"] = torch.from_numpy(np.array(self.boxes[start:end]))
+        target["labels"] = torch.from_numpy(np.array(self.labels[start:end]))
+        target["ishard"] = torch.from_numpy(np.array(self.difficult[start:end]))
+        target['name'] = torch.from_numpy(np.array(self.names[idx, :self.name_lengths[idx]]))
+        return target
+
+
+class VOCDetectionCached(torchvision.datasets.VOCDetection):
+    """
+    Drop-in replacement of VOCDetection whose targets are sliced from VOCAnnotationRecords instead of
+    parsing the annotation xml on every access.
+    """
+
+    def __init__(self, img_folder, year, image_set, transforms, cache_dir=None):
+        super(VOCDetectionCached, self).__init__(img_folder, year, image_set)
+        self._transforms = transforms
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.dirname(self.annotations[0])), 'AnnotationCache',
+                                     image_set)
+        self.records = VOCAnnotationRecords.load(self.annotations, ConvertVOCtoCOCO.CLASSES, cache_dir)
+
+    def get_height_and_width(self, idx):
+        height, width = self.records.sizes[idx]
+        return int(height), int(width)
+
+    def __getitem__(self, idx):
+        img = Image.open(self.images[idx]).convert('RGB')
+        target = self.records.target(idx)
+        if self._transforms is not None:
+            img, target = self._transforms(img, target)
+        return img, target
+
+
 def get_voc2012(root, image_set, transforms):
     t = [ConvertVOCtoCOCO()]
 
@@ -80,3 +211,27 @@ def get_voc2007(root, image_set, transforms):
     dataset = VOCDetection(img_folder=root, year='2007', image_set=image_set, transforms=transforms)
 
     return dataset
+
+
+def get_voc2012_cached(root, image_set, transforms):
+    t = [ConvertVOCtoCOCO()]
+
+    if transforms is not None:
+        t.append(transforms)
+    transforms = T.Compose(t)
+
+    dataset = VOCDetectionCached(img_folder=root, year='2012', image_set=image_set, transforms=transforms)
+
+    return dataset
+
+
+def get_voc2007_cached(root, image_set, transforms):
+    t = [ConvertVOCtoCOCO()]
+
+    if transforms is not None:
+        t.append(transforms)
+    transforms = T.Compose(t)
+
+    dataset = VOCDetectionCached(img_folder=root, year='2007', image_set=image_set, transforms=transforms)
+
+    return dataset
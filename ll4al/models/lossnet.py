@@ -8,6 +8,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def loss_features(features):
+    """The four FPN levels LossNet reads, keyed '0'..'3' as it expects, without copying the tensors."""
+    if isinstance(features, dict):
+        # Faster R-CNN: '0'..'3' and 'pool'; RetinaNet: '0', '1', '2', 'p6', 'p7'
+        features = list(features.values())
+    return {str(i): f for i, f in enumerate(features[:4])}
+
+
 class _LossNet(nn.Module):
     def __init__(self, num_channels=[256, 256, 256, 256], interm_dim=128):
         super(_LossNet, self).__init__()
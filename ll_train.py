@@ -44,6 +44,9 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.persistent_loader import PersistentLoaders
+from detection.incremental import WarmStart, CycleReport
 
 import ll4al.models.resnet as resnet
 import ll4al.models.lossnet as lossnet
@@ -52,10 +55,11 @@ from ll4al.data.sampler import SubsetSequentialSampler
 from ll4al.main import *
 
 
-def train_one_epoch(task_model, task_optimizer, ll_model, ll_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, ll_model, ll_optimizer, data_loader, device, cycle, epoch, print_freq,
+                    train_step):
     task_model.train()
     ll_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     metric_logger.add_meter('ll_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
@@ -70,100 +74,84 @@ def train_one_epoch(task_model, task_optimizer, ll_model, ll_optimizer, data_loa
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
         ll_lr_scheduler = utils.warmup_lr_scheduler(ll_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler, ll_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
+        images = utils.images_to_device(images, device)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        features, task_loss_dict = task_model(images, targets)
-        if 'faster' in args.model:
-            _task_losses = sum(loss for loss in task_loss_dict.values())
-            # print(_task_losses)
-            task_loss_dict['loss_objectness'] = torch.mean(task_loss_dict['loss_objectness'])
-            task_loss_dict['loss_rpn_box_reg'] = torch.mean(task_loss_dict['loss_rpn_box_reg'])
-            task_loss_dict['loss_classifier'] = torch.mean(task_loss_dict['loss_classifier'])
-            task_loss_dict['loss_box_reg'] = torch.mean(task_loss_dict['loss_box_reg'])
-            task_losses = sum(loss for loss in task_loss_dict.values())
-            # reduce losses over all GPUs for logging purposes
-            task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-            task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-            task_loss_value = task_losses_reduced.item()
-            if epoch >= args.task_epochs:
-                # After EPOCHL epochs, stop the gradient from the loss prediction module propagated to the target model.
-                features['0'] = features['0'].detach()
-                features['1'] = features['1'].detach()
-                features['2'] = features['2'].detach()
-                features['3'] = features['3'].detach()
-            ll_pred = ll_model(features).cuda()
-        elif 'retina' in args.model:
-            _task_losses = sum(torch.stack(loss[1]) for loss in task_loss_dict.values())
-            task_loss_dict['classification'] = task_loss_dict['classification'][0]
-            task_loss_dict['bbox_regression'] = task_loss_dict['bbox_regression'][0]
-            # for loss in task_loss_dict.values():
-            #     print(loss)
-            task_losses = sum(loss for loss in task_loss_dict.values())
-            task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-            task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-            task_loss_value = task_losses_reduced.item()
-            if epoch >= args.task_epochs:
-                # After EPOCHL epochs, stop the gradient from the loss prediction module propagated to the target model.
-                _features = dict()
-                _features['0'] = features[0].detach()
-                _features['1'] = features[1].detach()
-                _features['2'] = features[2].detach()
-                _features['3'] = features[3].detach()
-            else:
-                _features = dict()
-                _features['0'] = features[0]
-                _features['1'] = features[1]
-                _features['2'] = features[2]
-                _features['3'] = features[3]
-            ll_pred = ll_model(_features).cuda()
-        ll_pred = ll_pred.view(ll_pred.size(0))
-        ll_loss = args.ll_weight * LossPredLoss(ll_pred, _task_losses, margin=MARGIN)
-        losses = task_losses + ll_loss
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        ll_optimizer.zero_grad()
-        losses.backward()
-        task_optimizer.step()
-        ll_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        if ll_lr_scheduler is not None:
-            ll_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            features, task_loss_dict = task_model(images, targets)
+            if 'faster' in args.model:
+                _task_losses = sum(loss for loss in task_loss_dict.values())
+                # print(_task_losses)
+                task_loss_dict['loss_objectness'] = torch.mean(task_loss_dict['loss_objectness'])
+                task_loss_dict['loss_rpn_box_reg'] = torch.mean(task_loss_dict['loss_rpn_box_reg'])
+                task_loss_dict['loss_classifier'] = torch.mean(task_loss_dict['loss_classifier'])
+                task_loss_dict['loss_box_reg'] = torch.mean(task_loss_dict['loss_box_reg'])
+                task_losses = sum(loss for loss in task_loss_dict.values())
+                if epoch >= args.task_epochs:
+                    # After EPOCHL epochs, stop the gradient from the loss prediction module propagated to the
+                    # target model.
+                    features['0'] = features['0'].detach()
+                    features['1'] = features['1'].detach()
+                    features['2'] = features['2'].detach()
+                    features['3'] = features['3'].detach()
+                ll_pred = ll_model(features).cuda()
+            elif 'retina' in args.model:
+                _task_losses = sum(torch.stack(loss[1]) for loss in task_loss_dict.values())
+                task_loss_dict['classification'] = task_loss_dict['classification'][0]
+                task_loss_dict['bbox_regression'] = task_loss_dict['bbox_regression'][0]
+                # for loss in task_loss_dict.values():
+                #     print(loss)
+                task_losses = sum(loss for loss in task_loss_dict.values())
+                if epoch >= args.task_epochs:
+                    # After EPOCHL epochs, stop the gradient from the loss prediction module propagated to the
+                    # target model.
+                    _features = dict()
+                    _features['0'] = features[0].detach()
+                    _features['1'] = features[1].detach()
+                    _features['2'] = features[2].detach()
+                    _features['3'] = features[3].detach()
+                else:
+                    _features = dict()
+                    _features['0'] = features[0]
+                    _features['1'] = features[1]
+                    _features['2'] = features[2]
+                    _features['3'] = features[3]
+                ll_pred = ll_model(_features).cuda()
+            ll_pred = ll_pred.view(ll_pred.size(0))
+            ll_loss = args.ll_weight * LossPredLoss(ll_pred, _task_losses, margin=MARGIN)
+            losses = task_losses + ll_loss
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(losses, task_loss=task_losses, ll_loss=ll_loss)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
-        metric_logger.update(ll_loss=ll_loss.item())
         metric_logger.update(ll_lr=ll_optimizer.param_groups[0]["lr"])
     return metric_logger
 
 
 def get_uncertainty(task_model, ll_model, unlabeled_loader):
+    """
+    Predicted loss of every image of ``unlabeled_loader``, in batch order. Only the transform and the
+    backbone of the detector run, the heads and the post-processing do not contribute to the prediction.
+    """
     task_model.eval()
     ll_model.eval()
-    uncertainty = torch.tensor([]).cuda()
+    device = next(ll_model.parameters()).device
+    batch_sampler = unlabeled_loader.batch_sampler
+    num_images = len(batch_sampler.sampler) if batch_sampler is not None else len(unlabeled_loader.dataset)
+    uncertainty = torch.empty(num_images, device=device)
 
+    start = 0
     with torch.no_grad():
         for images, labels in unlabeled_loader:
-            images = list(img.cuda() for img in images)
-            torch.cuda.synchronize()
-            features, _ = task_model(images)
-            if 'retina' in args.model:
-                _features = dict()
-                _features['0'] = features[0].detach()
-                _features['1'] = features[0].detach()
-                _features['2'] = features[0].detach()
-                _features['3'] = features[0].detach()
-                ll_pred = ll_model(_features)  # pred_loss = criterion(scores, labels) # ground truth loss
-            else:
-                ll_pred = ll_model(features)  # pred_loss = criterion(scores, labels) # ground truth loss
+            images = utils.images_to_device(images, device)
+            images, _ = task_model.transform(images)
+            features = task_model.backbone(images.tensors)
+            ll_pred = ll_model(lossnet.loss_features(features))
             ll_pred = ll_pred.view(ll_pred.size(0))
-            uncertainty = torch.cat((uncertainty, ll_pred), 0)
-    return uncertainty.cpu()
+            uncertainty[start:start + ll_pred.size(0)] = ll_pred
+            start += ll_pred.size(0)
+    return uncertainty[:start].cpu()
 
 
 def main(args):
@@ -180,10 +168,12 @@ def main(args):
     print("Loading data")
 
     if 'voc2007' in args.dataset:
-        dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(train=True), args.data_path)
+        dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(True, args.uint8_images),
+                                           args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "test", get_transform(train=False), args.data_path)
     else:
-        dataset, num_classes = get_dataset(args.dataset, "train", get_transform(train=True), args.data_path)
+        dataset, num_classes = get_dataset(args.dataset, "train", get_transform(True, args.uint8_images),
+                                           args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "val", get_transform(train=False), args.data_path)
     if 'voc' in args.dataset:
         init_num = 500
@@ -202,17 +192,18 @@ def main(args):
     unlabeled_set = list(set(indices) - set(labeled_set))
     train_sampler = SubsetRandomSampler(labeled_set)
     test_sampler = torch.utils.data.SequentialSampler(dataset_test)
-    data_loader_test = DataLoader(dataset_test, batch_size=1, sampler=test_sampler, num_workers=args.workers,
-                                  collate_fn=utils.collate_fn)
+    loaders = PersistentLoaders(args.workers)
+    if args.test_batch_size > 1:
+        # evaluation does not depend on the order of the images
+        min_size, max_size = (600, 1000) if 'voc' in args.dataset else (800, 1333)
+        data_loader_test = loaders.bucketed(dataset_test, test_sampler, args.test_batch_size, min_size, max_size)
+    else:
+        data_loader_test = loaders.sequential(dataset_test, test_sampler)
+    warm_start = WarmStart(args.incremental, args.incremental_epochs, args.incremental_lr_steps, args.new_weight)
+    report = CycleReport(args.cycle_report, args.baseline_report)
     for cycle in range(args.cycles):
-        if args.aspect_ratio_group_factor >= 0:
-            group_ids = create_aspect_ratio_groups(dataset, k=args.aspect_ratio_group_factor)
-            train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
-        else:
-            train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.batch_size, drop_last=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-                                                  collate_fn=utils.collate_fn)
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor,
+                                    pin_memory=args.uint8_images)
 
         print("Creating model")
         if 'voc' in args.dataset:
@@ -229,14 +220,18 @@ def main(args):
 
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-        task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
+        task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer,
+                                                                 milestones=warm_start.milestones(args.lr_steps),
                                                                  gamma=args.lr_gamma)
         ll_model = lossnet.LossNet()
         ll_model.to(device)
+        warm_start.load(task_model, ll_model)
         params_ll = [p for p in ll_model.parameters() if p.requires_grad]
         ll_optimizer = torch.optim.SGD(params_ll, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-        ll_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(ll_optimizer, milestones=args.lr_steps,
+        ll_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(ll_optimizer,
+                                                               milestones=warm_start.milestones(args.lr_steps),
                                                                gamma=args.lr_gamma)
+        train_step = TrainStep([task_optimizer, ll_optimizer], device, args.amp, args.accumulation_steps)
         # Start active learning cycles training
         if args.test_only:
             if 'coco' in args.dataset:
@@ -246,32 +241,34 @@ def main(args):
             return
         print("Start training")
         start_time = time.time()
-        for epoch in range(args.start_epoch, args.total_epochs):
+        total_epochs = warm_start.total_epochs(args.total_epochs)
+        for epoch in range(args.start_epoch, total_epochs):
             train_one_epoch(task_model, task_optimizer, ll_model, ll_optimizer, data_loader, device, cycle, epoch,
-                            args.print_freq)
+                            args.print_freq, train_step)
             task_lr_scheduler.step()
             ll_lr_scheduler.step()
             # evaluate after pre-set epoch
-            if (epoch + 1) == args.total_epochs:
+            if (epoch + 1) == total_epochs:
                 if 'coco' in args.dataset:
-                    coco_evaluate(task_model, data_loader_test, feature=True)
+                    ap = coco_evaluate(task_model, data_loader_test, feature=True).coco_eval['bbox'].stats[0]
                 elif 'voc' in args.dataset:
-                    voc_evaluate(task_model, data_loader_test, args.dataset, True, path=args.results_path)
+                    ap = voc_evaluate(task_model, data_loader_test, args.dataset, True, path=args.results_path)
+                report.update(cycle, len(labeled_set), ap, time.time() - start_time, warm_start.active)
+        warm_start.save(labeled_set, task_model, ll_model)
         random.shuffle(unlabeled_set)
         if 'coco' in args.dataset:
             subset = unlabeled_set[:10000]
         else:
             subset = unlabeled_set
-        unlabeled_loader = DataLoader(dataset, batch_size=args.batch_size,
-                                      sampler=SubsetSequentialSampler(subset), num_workers=args.workers,
-                                      # more convenient if we maintain the order of subset
-                                      pin_memory=True, collate_fn=utils.collate_fn)
-        uncertainty = get_uncertainty(task_model, ll_model, unlabeled_loader)
-        labeled_loader = DataLoader(dataset, batch_size=args.batch_size,
-                                    sampler=SubsetSequentialSampler(labeled_set), num_workers=args.workers,
-                                    # more convenient if we maintain the order of subset
-                                    pin_memory=True, collate_fn=utils.collate_fn)
-        u = get_uncertainty(task_model, ll_model, labeled_loader)
+        # images are batched by resized shape, the scores are put back in the order of subset
+        min_size, max_size = task_model.transform.min_size[-1], task_model.transform.max_size
+        unlabeled_loader = loaders.bucketed(dataset, SubsetSequentialSampler(subset), args.batch_size, min_size,
+                                            max_size, pin_memory=True)
+        uncertainty = unlabeled_loader.batch_sampler.restore_order(
+            get_uncertainty(task_model, ll_model, unlabeled_loader))
+        labeled_loader = loaders.bucketed(dataset, SubsetSequentialSampler(labeled_set), args.batch_size, min_size,
+                                          max_size, pin_memory=True)
+        u = labeled_loader.batch_sampler.restore_order(get_uncertainty(task_model, ll_model, labeled_loader))
         # with open("vis/ll_labeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
         #           "wb") as fp:  # Pickling
         #     pickle.dump(u, fp)
@@ -287,7 +284,7 @@ def main(args):
         unlabeled_set = list(set(indices) - set(labeled_set))
 
         # Create a new dataloader for the updated labeled dataset
-        train_sampler = SubsetRandomSampler(labeled_set)
+        train_sampler = warm_start.sampler(labeled_set)
 
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -312,8 +309,20 @@ if __name__ == "__main__":
                         help='number of total epochs to run')
     parser.add_argument('-e', '--total_epochs', default=20, type=int, metavar='N',
                         help='number of total epochs to run')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='warm-start every cycle from the previous cycle and fine-tune on a short schedule')
+    parser.add_argument('--incremental-epochs', default=5, type=int, help='epochs per cycle in incremental mode')
+    parser.add_argument('--incremental-lr-steps', default=[4], nargs='+', type=int,
+                        help='decrease lr at these epochs in incremental mode')
+    parser.add_argument('--new-weight', default=3.0, type=float,
+                        help='relative sampling weight of newly acquired images in incremental mode')
+    parser.add_argument('--cycle-report', default=None, help='path of a json file to save per-cycle mAP and time')
+    parser.add_argument('--baseline-report', default=None,
+                        help='per-cycle report of a from-scratch run to compare against')
     parser.add_argument('--cycles', default=7, type=int, metavar='N',
                         help='number of cycles epochs to run')
+    parser.add_argument('--test-batch-size', default=1, type=int,
+                        help='images per test batch, batches are formed from images of similar resized shape')
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                         help='number of data loading workers (default: 4)')
     parser.add_argument('--lr', default=0.0025, type=float,
@@ -330,6 +339,12 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--uint8-images', action='store_true',
+                        help='keep training images uint8 up to the device, where they are converted to float')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
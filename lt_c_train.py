@@ -39,7 +39,6 @@ import torch.optim as optim
 from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
 from torch.utils.data.sampler import SubsetRandomSampler
-from torchmetrics.functional import pairwise_cosine_similarity
 from torch._C import device
 import torch.nn as nn
 import torch.nn.functional as F
@@ -53,39 +52,17 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.acquisition import SCORING_PROFILE, inference_profile, localization_tightness
+from detection.persistent_loader import PersistentLoaders
 
 from ll4al.data.sampler import SubsetSequentialSampler
 import pickle
 
 
-# Check MMDetection installation
-import mmdet
-print(mmdet.__version__)
-
-# Check mmcv installation
-from mmcv.ops import get_compiling_cuda_version, get_compiler_version
-print(get_compiling_cuda_version())
-print(get_compiler_version())
-
-
-# import other modules
-import copy
-import submodlib
-from talisman.strategies.active_learning_utils.compute_kernel import compute_imageImage_kernel, compute_queryImage_kernel, compute_queryQuery_kernel
-from talisman.strategies.active_learning_utils.custom_dataset import build_dataset_with_indices, create_custom_dataset, get_class_statistics, prepare_val_file
-from talisman.strategies.active_learning_utils.extract_features import get_query_RoI_features, get_unlabelled_RoI_features, get_unlabelled_top_k_RoI_features
-from talisman.strategies.active_learning_utils.utils import execute
-
-# import mmcv functionalities
-from mmcv import Config
-from mmdet.apis import init_detector
-from mmdet.datasets import build_dataloader, build_dataset
-from mmdet.datasets.dataset_wrappers import RepeatDataset
-
-
-def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq, train_step):
     task_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -97,27 +74,15 @@ def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoc
 
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
         images = list(image.to(device) for image in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        task_losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
     return metric_logger
 
@@ -138,21 +103,18 @@ def calcu_iou(A, B):
 
 def get_uncertainty(task_model, unlabeled_loader):
     task_model.eval()
-    uncertainties = []
+    batch_sampler = unlabeled_loader.batch_sampler
+    num_images = len(batch_sampler.sampler) if batch_sampler is not None else len(unlabeled_loader.dataset)
+    uncertainties = torch.empty(num_images, device=next(task_model.parameters()).device)
 
+    start = 0
     with torch.no_grad():
         for images, labels in unlabeled_loader:
-            images = list(img.cuda() for img in images)
-            torch.cuda.synchronize()
+            images = list(img.cuda(non_blocking=True) for img in images)
             outputs = task_model(images)
-            for output in outputs:
-                uncertainty = 1.0
-                for box, prop, prob_max in zip(output['boxes'], output['props'], output['prob_max']):
-                    iou = calcu_iou(box, prop)
-                    u = torch.abs(iou + prob_max - 1)
-                    uncertainty = min(uncertainty, u.item())
-                uncertainties.append(uncertainty)
-    return uncertainties
+            uncertainties[start:start + len(outputs)] = localization_tightness(outputs)
+            start += len(outputs)
+    return uncertainties[:start].tolist()
 
 
 def main(args):
@@ -164,6 +126,7 @@ def main(args):
     print(args)
 
     device = torch.device(args.device)
+    scoring_profile = SCORING_PROFILE if args.scoring_profile else {}
 
     # Data loading code
     print("Loading data")
@@ -189,17 +152,10 @@ def main(args):
     unlabeled_set = indices[init_num:]
     train_sampler = SubsetRandomSampler(labeled_set)
     test_sampler = torch.utils.data.SequentialSampler(dataset_test)
-    data_loader_test = DataLoader(dataset_test, batch_size=1, sampler=test_sampler, num_workers=args.workers,
-                                  collate_fn=utils.collate_fn)
+    loaders = PersistentLoaders(args.workers)
+    data_loader_test = loaders.sequential(dataset_test, test_sampler)
     for cycle in range(args.cycles):
-        if args.aspect_ratio_group_factor >= 0:
-            group_ids = create_aspect_ratio_groups(dataset, k=args.aspect_ratio_group_factor)
-            train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
-        else:
-            train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.batch_size, drop_last=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-                                                  collate_fn=utils.collate_fn)
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor)
 
         print("Creating model")
         if 'voc' in args.dataset:
@@ -221,17 +177,16 @@ def main(args):
                 subset = unlabeled_set[:10000]
             else:
                 subset = unlabeled_set
-            labeled_loader = DataLoader(dataset, batch_size=1,
-                                        sampler=SubsetSequentialSampler(labeled_set), num_workers=args.workers,
-                                        # more convenient if we maintain the order of subset
-                                        pin_memory=True, collate_fn=utils.collate_fn)
-            u = get_uncertainty(task_model, labeled_loader)
+            # more convenient if we maintain the order of subset
+            labeled_loader = loaders.sequential(dataset, SubsetSequentialSampler(labeled_set), pin_memory=True)
+            with inference_profile(task_model, **scoring_profile):
+                u = get_uncertainty(task_model, labeled_loader)
             with open("vis/ltc_labeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                       "wb") as fp:  # Pickling
                 pickle.dump(u, fp)
-            unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                          num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-            uncertainty = get_uncertainty(task_model, unlabeled_loader)
+            unlabeled_loader = loaders.sequential(dataset, SubsetSequentialSampler(subset), pin_memory=True)
+            with inference_profile(task_model, **scoring_profile):
+                uncertainty = get_uncertainty(task_model, unlabeled_loader)
             arg = np.argsort(uncertainty)
             with open("vis/ltc_unlabeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                       "wb") as fp:  # Pickling
@@ -248,6 +203,7 @@ def main(args):
             continue
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
         task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
                                                                  gamma=args.lr_gamma)
 
@@ -261,7 +217,8 @@ def main(args):
         print("Start training")
         start_time = time.time()
         for epoch in range(args.start_epoch, args.total_epochs):
-            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq)
+            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq,
+                            train_step)
             task_lr_scheduler.step()
             # evaluate after pre-set epoch
             if (epoch + 1) == args.total_epochs:
@@ -278,17 +235,16 @@ def main(args):
             subset = unlabeled_set[:10000]
         else:
             subset = unlabeled_set
-        labeled_loader = DataLoader(dataset, batch_size=1,
-                                    sampler=SubsetSequentialSampler(labeled_set), num_workers=args.workers,
-                                    # more convenient if we maintain the order of subset
-                                    pin_memory=True, collate_fn=utils.collate_fn)
-        u = get_uncertainty(task_model, labeled_loader)
+        # more convenient if we maintain the order of subset
+        labeled_loader = loaders.sequential(dataset, SubsetSequentialSampler(labeled_set), pin_memory=True)
+        with inference_profile(task_model, **scoring_profile):
+            u = get_uncertainty(task_model, labeled_loader)
         with open("vis/ltc_labeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                   "wb") as fp:  # Pickling
             pickle.dump(u, fp)
-        unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                      num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-        uncertainty = get_uncertainty(task_model, unlabeled_loader)
+        unlabeled_loader = loaders.sequential(dataset, SubsetSequentialSampler(subset), pin_memory=True)
+        with inference_profile(task_model, **scoring_profile):
+            uncertainty = get_uncertainty(task_model, unlabeled_loader)
         arg = np.argsort(uncertainty)
         with open("vis/ltc_unlabeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                   "wb") as fp:  # Pickling
@@ -342,6 +298,13 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 22], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
+    parser.add_argument('--scoring-profile', dest='scoring_profile', action='store_true',
+                        help='score the pool with fewer proposals and detections per image '
+                             '(detection.acquisition.SCORING_PROFILE)')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
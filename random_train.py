@@ -41,15 +41,18 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.persistent_loader import PersistentLoaders
+from detection.incremental import WarmStart, CycleReport
 from torchvision.models.detection.faster_rcnn import fasterrcnn_resnet50_fpn
 from torchvision.models.detection.retinanet import retinanet_resnet50_fpn
 # from detection.retinanet_cal import retinanet_mobilenet, retinanet_resnet50_fpn_cal
 import pickle
 
 
-def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq, train_step):
     task_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -60,27 +63,15 @@ def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoc
         warmup_iters = min(1000, len(data_loader) - 1)
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
+        images = utils.images_to_device(images, device)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        losses = task_losses
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
     return metric_logger
 
@@ -100,10 +91,12 @@ def main(args):
     print("Loading data")
 
     if 'voc2007' in args.dataset:
-        dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(train=True), args.data_path)
+        dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(True, args.uint8_images),
+                                           args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "test", get_transform(train=False), args.data_path)
     else:
-        dataset, num_classes = get_dataset(args.dataset, "train", get_transform(train=True), args.data_path)
+        dataset, num_classes = get_dataset(args.dataset, "train", get_transform(True, args.uint8_images),
+                                           args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "val", get_transform(train=False), args.data_path)
     print("Creating data loaders")
     num_images = len(dataset)
@@ -122,17 +115,13 @@ def main(args):
     unlabeled_set = indices[init_num:]
     train_sampler = SubsetRandomSampler(labeled_set)
     test_sampler = torch.utils.data.SequentialSampler(dataset_test)
-    data_loader_test = DataLoader(dataset_test, batch_size=1, sampler=test_sampler, num_workers=args.workers,
-                                  collate_fn=utils.collate_fn)
+    loaders = PersistentLoaders(args.workers)
+    data_loader_test = loaders.sequential(dataset_test, test_sampler)
+    warm_start = WarmStart(args.incremental, args.incremental_epochs, args.incremental_lr_steps, args.new_weight)
+    report = CycleReport(args.cycle_report, args.baseline_report)
     for cycle in range(args.cycles):
-        if args.aspect_ratio_group_factor >= 0:
-            group_ids = create_aspect_ratio_groups(dataset, k=args.aspect_ratio_group_factor)
-            train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
-        else:
-            train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.batch_size, drop_last=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-                                                  collate_fn=utils.collate_fn)
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor,
+                                    pin_memory=args.uint8_images)
 
         print("Creating model")
         if 'voc' in args.dataset:
@@ -146,6 +135,7 @@ def main(args):
             elif 'retina' in args.model:
                 task_model = retinanet_resnet50_fpn(num_classes=num_classes, min_size=600, max_size=1000)
         task_model.to(device)
+        warm_start.load(task_model)
         if not args.init and cycle == 0 and args.skip:
             if 'faster' in args.model:
                 checkpoint = torch.load(os.path.join(args.first_checkpoint_path,
@@ -154,6 +144,7 @@ def main(args):
                 checkpoint = torch.load(os.path.join(args.first_checkpoint_path,
                                                      '{}_retinanet_1st.pth'.format(args.dataset)), map_location='cpu')
             task_model.load_state_dict(checkpoint['model'])
+            warm_start.save(labeled_set, task_model)
             # if 'coco' in args.dataset:
             #     coco_evaluate(task_model, data_loader_test)
             # elif 'voc' in args.dataset:
@@ -172,11 +163,13 @@ def main(args):
             unlabeled_set = list(set(indices) - set(labeled_set))
 
             # Create a new dataloader for the updated labeled dataset
-            train_sampler = SubsetRandomSampler(labeled_set)
+            train_sampler = warm_start.sampler(labeled_set)
             continue
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-        task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
+        task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer,
+                                                                 milestones=warm_start.milestones(args.lr_steps),
                                                                  gamma=args.lr_gamma)
         # Start active learning cycles training
         if args.test_only:
@@ -187,15 +180,19 @@ def main(args):
             return
         print("Start training")
         start_time = time.time()
-        for epoch in range(args.start_epoch, args.total_epochs):
-            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq)
+        total_epochs = warm_start.total_epochs(args.total_epochs)
+        for epoch in range(args.start_epoch, total_epochs):
+            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq,
+                            train_step)
             task_lr_scheduler.step()
             # evaluate after pre-set epoch
-            if (epoch + 1) == args.total_epochs:
+            if (epoch + 1) == total_epochs:
                 if 'coco' in args.dataset:
-                    coco_evaluate(task_model, data_loader_test)
+                    ap = coco_evaluate(task_model, data_loader_test).coco_eval['bbox'].stats[0]
                 elif 'voc' in args.dataset:
-                    voc_evaluate(task_model, data_loader_test, args.dataset, path=args.results_path)
+                    ap = voc_evaluate(task_model, data_loader_test, args.dataset, path=args.results_path)
+                report.update(cycle, len(labeled_set), ap, time.time() - start_time, warm_start.active)
+        warm_start.save(labeled_set, task_model)
         if not args.skip and cycle == 0:
             if 'faster' in args.model:
                 utils.save_on_master({
@@ -211,7 +208,7 @@ def main(args):
         labeled_set = list(set(labeled_set))
         unlabeled_set = unlabeled_set[budget_num:]
         # Create a new dataloader for the updated labeled dataset
-        train_sampler = SubsetRandomSampler(labeled_set)
+        train_sampler = warm_start.sampler(labeled_set)
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('Training time {}'.format(total_time_str))
@@ -235,6 +232,16 @@ if __name__ == "__main__":
                         help='number of total epochs to run')
     parser.add_argument('-e', '--total_epochs', default=20, type=int, metavar='N',
                         help='number of total epochs to run')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='warm-start every cycle from the previous cycle and fine-tune on a short schedule')
+    parser.add_argument('--incremental-epochs', default=5, type=int, help='epochs per cycle in incremental mode')
+    parser.add_argument('--incremental-lr-steps', default=[4], nargs='+', type=int,
+                        help='decrease lr at these epochs in incremental mode')
+    parser.add_argument('--new-weight', default=3.0, type=float,
+                        help='relative sampling weight of newly acquired images in incremental mode')
+    parser.add_argument('--cycle-report', default=None, help='path of a json file to save per-cycle mAP and time')
+    parser.add_argument('--baseline-report', default=None,
+                        help='per-cycle report of a from-scratch run to compare against')
     parser.add_argument('--cycles', default=7, type=int, metavar='N',
                         help='number of cycles epochs to run')
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
@@ -253,6 +260,12 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--uint8-images', action='store_true',
+                        help='keep training images uint8 up to the device, where they are converted to float')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
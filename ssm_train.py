@@ -43,6 +43,8 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.persistent_loader import PersistentLoaders
 from detection.retina_ssm import retinanet_resnet50_fpn_ssm
 
 from ll4al.data.sampler import SubsetSequentialSampler
@@ -55,9 +57,9 @@ from torchvision.models.detection.faster_rcnn import fasterrcnn_resnet50_fpn
 warnings.filterwarnings("ignore")
 
 
-def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq, train_step):
     task_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -68,26 +70,15 @@ def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoc
         warmup_iters = min(1000, len(data_loader) - 1)
 
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
         images = list(image.to(device) for image in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        losses = task_losses
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
     return metric_logger
 
@@ -134,22 +125,15 @@ def main(args):
     unlabeled_set = list(set(indices) - set(labeled_set))
     train_sampler = SubsetRandomSampler(labeled_set)
     test_sampler = torch.utils.data.SequentialSampler(dataset_test)
-    data_loader_test = DataLoader(dataset_test, batch_size=1, sampler=test_sampler, num_workers=args.workers,
-                                  collate_fn=utils.collate_fn)
+    loaders = PersistentLoaders(args.workers)
+    data_loader_test = loaders.sequential(dataset_test, test_sampler)
 
     # SSM parameters
     gamma = 0.15
     clslambda = np.array([-np.log(0.9)] * (num_classes - 1))
     # Start active learning cycles training
     for cycle in range(args.cycles):
-        if args.aspect_ratio_group_factor >= 0:
-            group_ids = create_aspect_ratio_groups(dataset, k=args.aspect_ratio_group_factor)
-            train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
-        else:
-            train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.batch_size, drop_last=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-                                                  collate_fn=utils.collate_fn)
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor)
 
         print("Creating model")
         if 'voc' in args.dataset:
@@ -189,10 +173,8 @@ def main(args):
                 subset = unlabeled_set[:10000]
             else:
                 subset = unlabeled_set
-            unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                          num_workers=args.workers,
-                                          # more convenient if we maintain the order of subset
-                                          pin_memory=True, collate_fn=utils.collate_fn)
+            # more convenient if we maintain the order of subset
+            unlabeled_loader = loaders.sequential(dataset, SubsetSequentialSampler(subset), pin_memory=True)
             print("Getting detections from unlabeled set")
             allScore, allBox, allY, al_idx = get_uncertainty(task_model, unlabeled_loader)
             al_idx = [subset[i] for i in al_idx]
@@ -224,7 +206,7 @@ def main(args):
                     if len(al_idx) >= budget_num:
                         break
                     score = allScore[i][j]
-                    label = torch.tensor(allY[i][j]).cuda()
+                    label = torch.as_tensor(allY[i][j]).cuda()
                     loss = -((1 + label.cpu().numpy()) / 2 * np.log(score.cpu().numpy()) + (
                             1 - label.cpu().numpy()) / 2 * np.log(1 - score.cpu().numpy() + 1e-30))
                     cls_loss_sum += loss
@@ -237,13 +219,10 @@ def main(args):
                             pre_box = box
                             curr_ind = [subset[i]]
                             curr_sampler = SubsetSequentialSampler(curr_ind)
-                            curr_loader = DataLoader(dataset, batch_size=1, sampler=curr_sampler,
-                                                     num_workers=args.workers, pin_memory=True,
-                                                     collate_fn=utils.collate_fn)
+                            curr_loader = loaders.sequential(dataset, curr_sampler, pin_memory=True)
                             labeled_sampler = SubsetRandomSampler(labeled_set)
-                            labeled_loader = DataLoader(dataset, batch_size=1, sampler=labeled_sampler,
-                                                        num_workers=args.workers, pin_memory=True,
-                                                        collate_fn=utils.collate_fn)
+                            labeled_loader = loaders.sequential(dataset, labeled_sampler, pin_memory=True,
+                                                                role='cross_validation')
                             cross_validate, _ = image_cross_validation(
                                 task_model, curr_loader, labeled_loader, pre_box, pre_cls)
                             if not cross_validate:
@@ -275,13 +254,15 @@ def main(args):
 
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
         task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
                                                                  gamma=args.lr_gamma)
 
         print("Start training")
         start_time = time.time()
         for epoch in range(args.start_epoch, args.total_epochs):
-            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq)
+            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq,
+                            train_step)
             task_lr_scheduler.step()
             # evaluate after pre-set epoch
             if (epoch + 1) == args.total_epochs:
@@ -299,10 +280,8 @@ def main(args):
             subset = unlabeled_set[:10000]
         else:
             subset = unlabeled_set
-        unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                      num_workers=args.workers,
-                                      # more convenient if we maintain the order of subset
-                                      pin_memory=True, collate_fn=utils.collate_fn)
+        # more convenient if we maintain the order of subset
+        unlabeled_loader = loaders.sequential(dataset, SubsetSequentialSampler(subset), pin_memory=True)
         print("Getting detections from unlabeled set")
         allScore, allBox, allY, al_idx = get_uncertainty(task_model, unlabeled_loader)
         al_idx = [subset[i] for i in al_idx]
@@ -333,7 +312,7 @@ def main(args):
                 if len(al_idx) >= budget_num:
                     break
                 score = allScore[i][j]
-                label = torch.tensor(allY[i][j]).cuda()
+                label = torch.as_tensor(allY[i][j]).cuda()
                 loss = -((1 + label.cpu().numpy()) / 2 * np.log(score.cpu().numpy()) + (
                         1 - label.cpu().numpy()) / 2 * np.log(1 - score.cpu().numpy() + 1e-30))
                 cls_loss_sum += loss
@@ -345,12 +324,10 @@ def main(args):
                         pre_box = box
                         curr_ind = [subset[i]]
                         curr_sampler = SubsetSequentialSampler(curr_ind)
-                        curr_loader = DataLoader(dataset, batch_size=1, sampler=curr_sampler,
-                                                 num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
+                        curr_loader = loaders.sequential(dataset, curr_sampler, pin_memory=True)
                         labeled_sampler = SubsetRandomSampler(labeled_set)
-                        labeled_loader = DataLoader(dataset, batch_size=1, sampler=labeled_sampler,
-                                                    num_workers=args.workers, pin_memory=True,
-                                                    collate_fn=utils.collate_fn)
+                        labeled_loader = loaders.sequential(dataset, labeled_sampler, pin_memory=True,
+                                                            role='cross_validation')
                         cross_validate, _ = image_cross_validation(
                             task_model, curr_loader, labeled_loader, pre_box, pre_cls)
                         if not cross_validate:
@@ -415,6 +392,10 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
@@ -1,12 +1,19 @@
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
+import torch.multiprocessing as mp
+import torch.utils.data
 from torchvision import transforms
 import numpy as np
 import random
 import cv2
 
+from detection import utils
+from ll4al.data.sampler import SubsetSequentialSampler
+
 
 class View(nn.Module):
     def __init__(self, size):
@@ -76,11 +83,7 @@ class VAE(nn.Module):
                 kaiming_init(block)
 
     def forward(self, imgs):
-        x = []
-        for img in imgs:
-            img = F.interpolate(img.unsqueeze(0), (256, 256))
-            x.append(img * 255)
-        x = torch.cat(x)
+        x = vae_input(imgs)
         z = self._encode(x)
         mu, logvar = self.fc_mu(z), self.fc_logvar(z)
         z = self.reparameterize(mu, logvar)
@@ -165,15 +168,22 @@ def normal_init(m, mean, std):
             m.bias.data.zero_()
 
 
-mse_loss = nn.MSELoss(reduction='mean')
-
-
-def vae_loss(imgs, recon, mu, logvar, beta):
+def vae_input(imgs):
+    if isinstance(imgs, torch.Tensor) and imgs.dim() == 4 and tuple(imgs.shape[-2:]) == (256, 256):
+        # already resized and stacked on the loader side (see VAALResize / vaal_collate_fn)
+        return imgs * 255
     x = []
     for img in imgs:
         img = F.interpolate(img.unsqueeze(0), (256, 256))
         x.append(img * 255)
-    x = torch.cat(x)
+    return torch.cat(x)
+
+
+mse_loss = nn.MSELoss(reduction='mean')
+
+
+def vae_loss(imgs, recon, mu, logvar, beta):
+    x = vae_input(imgs)
     MSE = mse_loss(recon, x)
     KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
     KLD = KLD * beta
@@ -183,37 +193,258 @@ def vae_loss(imgs, recon, mu, logvar, beta):
 bce_loss = nn.BCELoss()
 
 
+def vaal_adversary_step(vae, vae_optimizer, discriminator, discriminator_optimizer, labeled_imgs, unlabeled_imgs):
+    recon, z, mu, logvar = vae(labeled_imgs)
+    unsup_loss = vae_loss(labeled_imgs, recon, mu, logvar, 1)
+    unlab_recon, unlab_z, unlab_mu, unlab_logvar = vae(unlabeled_imgs)
+    transductive_loss = vae_loss(unlabeled_imgs, unlab_recon, unlab_mu, unlab_logvar, 1)
+
+    labeled_preds = discriminator(mu)
+    unlabeled_preds = discriminator(unlab_mu)
+
+    lab_real_preds = torch.ones(len(labeled_imgs), device=mu.device)
+    unlab_real_preds = torch.ones(len(unlabeled_imgs), device=mu.device)
+
+    if not len(labeled_preds.shape) == len(lab_real_preds.shape):
+        dsc_loss = bce_loss(labeled_preds, lab_real_preds.unsqueeze(1)) + bce_loss(unlabeled_preds,
+                                                                                   unlab_real_preds.unsqueeze(1))
+    else:
+        dsc_loss = bce_loss(labeled_preds, lab_real_preds) + bce_loss(unlabeled_preds, unlab_real_preds)
+    total_vae_loss = unsup_loss + transductive_loss + dsc_loss
+    vae_optimizer.zero_grad()
+    total_vae_loss.backward()
+    vae_optimizer.step()
+
+    # Discriminator step
+    with torch.no_grad():
+        _, _, mu, _ = vae(labeled_imgs)
+        _, _, unlab_mu, _ = vae(unlabeled_imgs)
+
+    labeled_preds = discriminator(mu)
+    unlabeled_preds = discriminator(unlab_mu)
+
+    lab_real_preds = torch.ones(len(labeled_imgs), device=mu.device)
+    unlab_fake_preds = torch.zeros(len(unlabeled_imgs), device=mu.device)
+
+    if not len(labeled_preds.shape) == len(lab_real_preds.shape):
+        dsc_loss = bce_loss(labeled_preds, lab_real_preds.unsqueeze(1)) + bce_loss(unlabeled_preds,
+                                                                                   unlab_fake_preds.unsqueeze(1))
+    else:
+        dsc_loss = bce_loss(labeled_preds, lab_real_preds) + bce_loss(unlabeled_preds, unlab_fake_preds)
+    discriminator_optimizer.zero_grad()
+    dsc_loss.backward()
+    discriminator_optimizer.step()
+    return total_vae_loss, dsc_loss
+
+
+class VAALResize(object):
+    """Resize an image tensor to the VAE input resolution inside the data loader workers."""
+
+    def __init__(self, size=256):
+        self.size = size
+
+    def __call__(self, image, target):
+        image = F.interpolate(image.unsqueeze(0), (self.size, self.size)).squeeze(0)
+        return image, target
+
+
+def vaal_collate_fn(batch):
+    images, targets = tuple(zip(*batch))
+    return torch.stack(images), targets
+
+
+class VAALImageCache(object):
+    """(N, 3, 256, 256) uint8 images in a .npy file, memory-mapped read-only. Only the path is pickled, so the
+    spawned adversary process maps the same file instead of receiving a copy."""
+
+    def __init__(self, path):
+        self.path = path
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        return {'path': self.path, '_images': None}
+
+    def __len__(self):
+        return len(self.images)
+
+    def batch(self, inds):
+        inds = np.asarray(inds, dtype=np.int64)
+        return torch.from_numpy(np.ascontiguousarray(self.images[inds]))
+
+
+def cache_vaal_images(dataset, indices, path, batch_size=64, num_workers=4):
+    """Decode ``indices`` of a dataset returning VAALResize'd images once into the uint8 .npy file ``path`` on
+    disk (not /dev/shm: about 23 GB for COCO train). Nearest resizing keeps the values on the 1/255 grid, so the
+    uint8 copy is lossless."""
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=SubsetSequentialSampler(indices),
+                                         num_workers=num_workers, collate_fn=vaal_collate_fn)
+    cache = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(indices), 3, 256, 256))
+    offset = 0
+    for images, _ in loader:
+        cache[offset:offset + len(images)] = images.mul(255).round_().to(torch.uint8).numpy()
+        offset += len(images)
+    cache.flush()
+    del cache
+    return VAALImageCache(path)
+
+
+class CachedVAALDataset(torch.utils.data.Dataset):
+    def __init__(self, images):
+        self.images = images
+
+    def __getitem__(self, idx):
+        return self.images.batch([idx])[0], idx
+
+    def __len__(self):
+        return len(self.images)
+
+
+def _cached_batch(images, inds, device):
+    return images.batch(inds).to(device, non_blocking=True).float().div_(255)
+
+
+def train_vaal_adversary(vae, discriminator, images, labeled_set, unlabeled_set, epochs, batch_size, lr, momentum,
+                         weight_decay, lr_steps, lr_gamma, device, steps=None):
+    """Train the VAE and discriminator for ``epochs`` epochs of ``steps`` updates (default
+    len(labeled_set) // batch_size) on fixed-shape batches drawn from the cached ``images``, the labeled ones
+    cycling through shuffles of the labeled set. len(labeled_set) // task batch size steps is the number of
+    updates (at the same lr) of the synchronous path in train_one_epoch."""
+    vae.to(device)
+    discriminator.to(device)
+    vae.train()
+    discriminator.train()
+    params = [p for p in vae.parameters() if p.requires_grad]
+    vae_optimizer = torch.optim.SGD(params, lr=lr / 10, momentum=momentum, weight_decay=weight_decay)
+    vae_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(vae_optimizer, milestones=lr_steps, gamma=lr_gamma)
+    params = [p for p in discriminator.parameters() if p.requires_grad]
+    discriminator_optimizer = torch.optim.SGD(params, lr=lr, momentum=momentum, weight_decay=weight_decay)
+    discriminator_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(discriminator_optimizer, milestones=lr_steps,
+                                                                      gamma=lr_gamma)
+    labeled_set = torch.as_tensor(labeled_set)
+    unlabeled_set = torch.as_tensor(unlabeled_set)
+    batch_size = min(batch_size, len(labeled_set), len(unlabeled_set))
+    if steps is None:
+        steps = len(labeled_set) // batch_size
+    passes = (steps * batch_size + len(labeled_set) - 1) // len(labeled_set)
+    for epoch in range(epochs):
+        vae_warmup_scheduler = None
+        discriminator_warmup_scheduler = None
+        if epoch == 0:
+            warmup_factor = 1. / 1000
+            warmup_iters = min(1000, steps - 1)
+            vae_warmup_scheduler = utils.warmup_lr_scheduler(vae_optimizer, warmup_iters, warmup_factor)
+            discriminator_warmup_scheduler = utils.warmup_lr_scheduler(discriminator_optimizer, warmup_iters,
+                                                                       warmup_factor)
+        labeled_perm = torch.cat([labeled_set[torch.randperm(len(labeled_set))] for _ in range(passes)])
+        for i in range(steps):
+            labeled_imgs = _cached_batch(images, labeled_perm[i * batch_size:(i + 1) * batch_size], device)
+            unlabeled_inds = unlabeled_set[torch.randint(len(unlabeled_set), (batch_size,))]
+            unlabeled_imgs = _cached_batch(images, unlabeled_inds, device)
+            total_vae_loss, dsc_loss = vaal_adversary_step(vae, vae_optimizer, discriminator,
+                                                           discriminator_optimizer, labeled_imgs, unlabeled_imgs)
+            if vae_warmup_scheduler is not None:
+                vae_warmup_scheduler.step()
+            if discriminator_warmup_scheduler is not None:
+                discriminator_warmup_scheduler.step()
+        vae_lr_scheduler.step()
+        discriminator_lr_scheduler.step()
+        print('Epoch: [{}] vae_loss: {} dis_loss:{}'.format(epoch, total_vae_loss.item(), dsc_loss.item()))
+    return vae, discriminator
+
+
+def _adversary_worker(queue, seed, images, labeled_set, unlabeled_set, kwargs):
+    torch.manual_seed(seed)
+    vae, discriminator = train_vaal_adversary(VAE(), Discriminator(), images, labeled_set, unlabeled_set, **kwargs)
+    queue.put({'vae': {k: v.cpu() for k, v in vae.state_dict().items()},
+               'discriminator': {k: v.cpu() for k, v in discriminator.state_dict().items()}})
+
+
+class AsyncAdversaryTrainer:
+    """Run train_vaal_adversary in a spawned process so it overlaps with task model training."""
+
+    def __init__(self, images, labeled_set, unlabeled_set, seed=0, **kwargs):
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.SimpleQueue()
+        self.process = ctx.Process(target=_adversary_worker,
+                                   args=(self.queue, seed, images, list(labeled_set), list(unlabeled_set), kwargs))
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def join(self, vae, discriminator):
+        state = self.queue.get()
+        self.process.join()
+        vae.load_state_dict(state['vae'])
+        discriminator.load_state_dict(state['discriminator'])
+        return vae, discriminator
+
+
+def _per_sample_norm(layer, x):
+    return F.instance_norm(x, weight=layer.weight, bias=layer.bias, eps=layer.eps)
+
+
+@contextlib.contextmanager
+def per_sample_batch_norm(module):
+    """
+    Makes the train-mode BatchNorm2d layers of ``module`` normalize every sample of a batch with its own
+    statistics, i.e. give the outputs of one forward pass per sample, without updating the running statistics.
+    """
+    layers = [m for m in module.modules() if isinstance(m, nn.BatchNorm2d) and m.training]
+    for layer in layers:
+        layer.forward = lambda x, layer=layer: _per_sample_norm(layer, x)
+    try:
+        yield
+    finally:
+        for layer in layers:
+            del layer.forward
+
+
 class AdversarySampler:
     def __init__(self, budget):
         self.budget = budget
 
     def sample(self, vae, discriminator, dataloader):
-        all_preds = []
-        all_indices = []
-
-        for i, (images, _) in enumerate(dataloader):
-            images = list(image.cuda() for image in images)
-            x = []
-            for img in images:
-                img = F.interpolate(img.unsqueeze(0), (256, 256))
-                x.append(img)
-            x = torch.cat(x)
-            with torch.no_grad():
+        device = next(vae.parameters()).device
+        num_samples = len(dataloader.batch_sampler.sampler)
+        budget = min(int(self.budget), num_samples)
+
+        # predictions are streamed into a preallocated buffer and merged into a running top-k,
+        # so the selection never has to stack a python list of per-sample tensors
+        all_preds = torch.empty(num_samples, device=device)
+        top_preds = torch.empty(0, device=device)
+        top_indices = torch.empty(0, dtype=torch.long, device=device)
+        offset = 0
+        for images, _ in dataloader:
+            if isinstance(images, torch.Tensor):
+                x = images.to(device, non_blocking=True)
+                if x.dtype == torch.uint8:
+                    x = x.float().div_(255)
+            else:
+                x = torch.cat([F.interpolate(image.to(device).unsqueeze(0), (256, 256)) for image in images])
+            # the models stay in train mode as when the pool was scored one image at a time,
+            # so the BatchNorm layers normalize each image on its own
+            with torch.no_grad(), per_sample_batch_norm(vae), per_sample_batch_norm(discriminator):
                 _, _, mu, _ = vae(x)
-                preds = discriminator(mu)
-            all_preds.extend(preds)
-            all_indices.append(i)
-
-        all_preds = torch.stack(all_preds)
-        all_preds = all_preds.view(-1)
-        # need to multiply by -1 to be able to use torch.topk
-        all_preds *= -1
-
-        # select the points which the discriminator things are the most likely to be unlabeled
-        _, querry_indices = torch.topk(all_preds, int(self.budget))
-        querry_pool_indices = np.asarray(all_indices)[querry_indices.cpu().numpy()]
-
-        return querry_pool_indices
+                preds = discriminator(mu).view(-1)
+            num = preds.shape[0]
+            all_preds[offset:offset + num] = preds
+            # need to multiply by -1 to be able to use torch.topk
+            # select the points which the discriminator things are the most likely to be unlabeled
+            candidates = torch.cat([top_preds, -preds])
+            candidate_indices = torch.cat([top_indices, torch.arange(offset, offset + num, device=device)])
+            top_preds, order = torch.topk(candidates, min(budget, candidates.shape[0]))
+            top_indices = candidate_indices[order]
+            offset += num
+        self.all_preds = all_preds[:offset]
+
+        return top_indices.cpu().numpy()
 
 
 def sample_for_labeling(vae, discriminator, unlabeled_dataloader, budget):
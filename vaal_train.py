@@ -17,10 +17,13 @@ Also, if you train Keypoint R-CNN, the default hyperparameters are
 Because the number of images is smaller in the person keypoint subset of COCO,
 the number of epochs should be adapted so that we have the same number of iterations.
 """
+import atexit
 import datetime
 import os
 import random
+import shutil
 import sys
+import tempfile
 import time
 import numpy as np
 import math
@@ -37,6 +40,8 @@ from detection.coco_utils import get_coco, get_coco_kp
 from detection.engine import coco_evaluate, voc_evaluate
 from detection.group_by_aspect_ratio import GroupedBatchSampler, create_aspect_ratio_groups
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.persistent_loader import PersistentLoaders
 from ll4al.data.sampler import SubsetSequentialSampler
 from torch import nn
 from torch.utils.data import DataLoader
@@ -47,7 +52,8 @@ from vaal.vaal_helper import *
 
 
 def train_one_epoch(task_model, task_optimizer, vae, vae_optimizer, discriminator, discriminator_optimizer,
-                    labeled_dataloader, unlabeled_dataloader, device, cycle, epoch, print_freq):
+                    labeled_dataloader, unlabeled_dataloader, device, cycle, epoch, print_freq, train_step,
+                    train_adversary=True):
     def read_unlabeled_data(dataloader):
         while True:
             for images, _ in dataloader:
@@ -58,7 +64,7 @@ def train_one_epoch(task_model, task_optimizer, vae, vae_optimizer, discriminato
     task_model.train()
     vae.train()
     discriminator.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -73,73 +79,27 @@ def train_one_epoch(task_model, task_optimizer, vae, vae_optimizer, discriminato
         vae_lr_scheduler = utils.warmup_lr_scheduler(vae_optimizer, warmup_iters, warmup_factor)
         discriminator_lr_scheduler = utils.warmup_lr_scheduler(discriminator_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(labeled_dataloader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(labeled_dataloader, print_freq, header):
         images = list(image.to(device) for image in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        losses = task_losses
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-        task_optimizer.zero_grad()
-        losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
 
+    if not train_adversary:
+        # the VAE and discriminator are trained by an AsyncAdversaryTrainer
+        return metric_logger
+
     for i in range(len(labeled_dataloader)):
         unlabeled_imgs = next(unlabeled_data)
         labeled_imgs = next(labeled_data)
-        recon, z, mu, logvar = vae(labeled_imgs)
-        unsup_loss = vae_loss(labeled_imgs, recon, mu, logvar, 1)
-        unlab_recon, unlab_z, unlab_mu, unlab_logvar = vae(unlabeled_imgs)
-        transductive_loss = vae_loss(unlabeled_imgs, unlab_recon, unlab_mu, unlab_logvar, 1)
-
-        labeled_preds = discriminator(mu)
-        unlabeled_preds = discriminator(unlab_mu)
-
-        lab_real_preds = torch.ones(len(labeled_imgs)).cuda()
-        unlab_real_preds = torch.ones(len(unlabeled_imgs)).cuda()
-
-        if not len(labeled_preds.shape) == len(lab_real_preds.shape):
-            dsc_loss = bce_loss(labeled_preds, lab_real_preds.unsqueeze(1)) + bce_loss(unlabeled_preds,
-                                                                                       unlab_real_preds.unsqueeze(1))
-        else:
-            dsc_loss = bce_loss(labeled_preds, lab_real_preds) + bce_loss(unlabeled_preds, unlab_real_preds)
-        total_vae_loss = unsup_loss + transductive_loss + dsc_loss
-        vae_optimizer.zero_grad()
-        total_vae_loss.backward()
-        vae_optimizer.step()
-
-        # Discriminator step
-        with torch.no_grad():
-            _, _, mu, _ = vae(labeled_imgs)
-            _, _, unlab_mu, _ = vae(unlabeled_imgs)
-
-        labeled_preds = discriminator(mu)
-        unlabeled_preds = discriminator(unlab_mu)
-
-        lab_real_preds = torch.ones(len(labeled_imgs)).cuda()
-        unlab_fake_preds = torch.zeros(len(unlabeled_imgs)).cuda()
-
-        if not len(labeled_preds.shape) == len(lab_real_preds.shape):
-            dsc_loss = bce_loss(labeled_preds, lab_real_preds.unsqueeze(1)) + bce_loss(unlabeled_preds,
-                                                                                       unlab_fake_preds.unsqueeze(1))
-        else:
-            dsc_loss = bce_loss(labeled_preds, lab_real_preds) + bce_loss(unlabeled_preds, unlab_fake_preds)
-        discriminator_optimizer.zero_grad()
-        dsc_loss.backward()
-        discriminator_optimizer.step()
-
+        total_vae_loss, dsc_loss = vaal_adversary_step(vae, vae_optimizer, discriminator, discriminator_optimizer,
+                                                       labeled_imgs, unlabeled_imgs)
         if vae_lr_scheduler is not None:
             vae_lr_scheduler.step()
         if discriminator_lr_scheduler is not None:
@@ -164,9 +124,12 @@ def main(args):
     print("Loading data")
     if 'voc2007' in args.dataset:
         dataset, num_classes = get_dataset(args.dataset, "trainval", get_transform(train=True), args.data_path)
+        dataset_vaal, _ = get_dataset(args.dataset, "trainval", T.Compose([T.ToTensor(), VAALResize()]),
+                                      args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "test", get_transform(train=False), args.data_path)
     else:
         dataset, num_classes = get_dataset(args.dataset, "train", get_transform(train=True), args.data_path)
+        dataset_vaal, _ = get_dataset(args.dataset, "train", T.Compose([T.ToTensor(), VAALResize()]), args.data_path)
         dataset_test, _ = get_dataset(args.dataset, "val", get_transform(train=False), args.data_path)
     if 'voc' in args.dataset:
         init_num = 500
@@ -185,22 +148,28 @@ def main(args):
     unlabeled_set = list(set(indices) - set(labeled_set))
     train_sampler = SubsetRandomSampler(labeled_set)
     unlabeled_sampler = SubsetRandomSampler(unlabeled_set)
+    if args.vaal_async:
+        # decode and resize the whole pool once to a file on disk; the VAE/discriminator and the sampler read it
+        if args.vaal_cache:
+            vaal_cache = args.vaal_cache
+        else:
+            cache_dir = tempfile.mkdtemp(prefix='vaal_')
+            atexit.register(shutil.rmtree, cache_dir, True)
+            vaal_cache = os.path.join(cache_dir, '{}_vaal_images.npy'.format(args.dataset))
+        print("Caching VAAL images in {}".format(vaal_cache))
+        pool_images = cache_vaal_images(dataset_vaal, range(num_images), vaal_cache, args.vaal_batch_size,
+                                        args.workers)
     test_sampler = torch.utils.data.SequentialSampler(dataset_test)
-    data_loader_test = DataLoader(dataset_test, batch_size=1, sampler=test_sampler, num_workers=args.workers,
-                                  collate_fn=utils.collate_fn)
+    loaders = PersistentLoaders(args.workers)
+    # the VAAL pool is scored in stacked 256x256 batches
+    vaal_loaders = PersistentLoaders(args.workers, collate_fn=vaal_collate_fn)
+    if args.vaal_async:
+        dataset_vaal = CachedVAALDataset(pool_images)
+    data_loader_test = loaders.sequential(dataset_test, test_sampler)
     for cycle in range(args.cycles):
-        if args.aspect_ratio_group_factor >= 0:
-            group_ids = create_aspect_ratio_groups(dataset, k=args.aspect_ratio_group_factor)
-            train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
-            unlabeled_batch_sampler = GroupedBatchSampler(unlabeled_sampler, group_ids, args.batch_size)
-        else:
-            train_batch_sampler = torch.utils.data.BatchSampler(train_sampler, args.batch_size, drop_last=True)
-            unlabeled_batch_sampler = torch.utils.data.BatchSampler(unlabeled_sampler, args.batch_size, drop_last=True)
-        data_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-                                                  collate_fn=utils.collate_fn)
-        unlabeled_dataloader = torch.utils.data.DataLoader(dataset, batch_sampler=unlabeled_batch_sampler,
-                                                           num_workers=args.workers,
-                                                           collate_fn=utils.collate_fn)
+        data_loader = loaders.train(dataset, train_sampler, args.batch_size, args.aspect_ratio_group_factor)
+        unlabeled_dataloader = loaders.train(dataset, unlabeled_sampler, args.batch_size,
+                                             args.aspect_ratio_group_factor, role='unlabeled')
         print("Creating model")
         if 'voc' in args.dataset:
             if 'faster' in args.model:
@@ -216,6 +185,7 @@ def main(args):
 
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
         task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
                                                                  gamma=args.lr_gamma)
         vae = VAE()
@@ -244,9 +214,18 @@ def main(args):
             return
         print("Start training")
         start_time = time.time()
+        if args.vaal_async:
+            # same lr and number of updates per epoch as the synchronous path, in batches of --vaal-batch-size
+            adversary_trainer = AsyncAdversaryTrainer(
+                pool_images, labeled_set, unlabeled_set, seed=cycle, epochs=args.total_epochs - args.start_epoch,
+                batch_size=args.vaal_batch_size, steps=len(labeled_set) // args.batch_size, lr=args.lr,
+                momentum=args.momentum,
+                weight_decay=args.weight_decay, lr_steps=args.lr_steps, lr_gamma=args.lr_gamma,
+                device=args.device).start()
         for epoch in range(args.start_epoch, args.total_epochs):
             train_one_epoch(task_model, task_optimizer, vae, vae_optimizer, discriminator, discriminator_optimizer,
-                            data_loader, unlabeled_dataloader, device, cycle, epoch, args.print_freq)
+                            data_loader, unlabeled_dataloader, device, cycle, epoch, args.print_freq, train_step,
+                            train_adversary=not args.vaal_async)
             task_lr_scheduler.step()
             vae_lr_scheduler.step()
             discriminator_lr_scheduler.step()
@@ -262,8 +241,12 @@ def main(args):
             subset = unlabeled_set[:10000]
         else:
             subset = unlabeled_set
-        unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
-                                      num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
+        if args.vaal_async:
+            adversary_trainer.join(vae, discriminator)
+        # images are resized to the VAE resolution in the workers (or read from the cache of --vaal-async), so the
+        # pool is scored in large batches
+        unlabeled_loader = vaal_loaders.sequential(dataset_vaal, SubsetSequentialSampler(subset),
+                                                   args.vaal_batch_size, pin_memory=True)
         tobe_labeled_inds = sample_for_labeling(vae, discriminator, unlabeled_loader, budget_num)
         tobe_labeled_set = [subset[i] for i in tobe_labeled_inds]
         labeled_set += tobe_labeled_set
@@ -290,6 +273,15 @@ if __name__ == "__main__":
                         help='images per gpu, the total batch size is $NGPU x batch_size')
     parser.add_argument('-cp', '--first-checkpoint-path', default='/data/yuweiping/coco/',
                         help='path to save checkpoint of first cycle')
+    parser.add_argument('--vaal-batch-size', default=64, type=int,
+                        help='images per batch of the VAE and discriminator: scoring the unlabeled pool, and '
+                             'training them with --vaal-async')
+    parser.add_argument('--vaal-async', dest='vaal_async', action='store_true',
+                        help='train the VAE and discriminator on a cached 256x256 copy of the pool in a separate '
+                             'process, concurrently with the task model (same number of updates)')
+    parser.add_argument('--vaal-cache', default=None,
+                        help='.npy file of the cached 256x256 pool of --vaal-async, 192 KB per image (about 1 GB '
+                             'for voc2007, 22 GB for coco); default: a temporary file deleted at the end of the run')
     parser.add_argument('--task_epochs', default=20, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('-e', '--total_epochs', default=20, type=int, metavar='N',
@@ -312,6 +304,10 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
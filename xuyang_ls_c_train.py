@@ -39,11 +39,9 @@ import torch.optim as optim
 from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
 from torch.utils.data.sampler import SubsetRandomSampler
-from torchmetrics.functional import pairwise_cosine_similarity
 from torch._C import device
 import torch.nn as nn
 import torch.nn.functional as F
-print(torch.__version__, torch.cuda.is_available())
 
 
 from detection.frcnn_la import fasterrcnn_resnet50_fpn_feature
@@ -54,38 +52,14 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
 
 from ll4al.data.sampler import SubsetSequentialSampler
 from cald.cald_helper import *
 
-# Check MMDetection installation
-import mmdet
-print(mmdet.__version__)
-
-# Check mmcv installation
-from mmcv.ops import get_compiling_cuda_version, get_compiler_version
-print(get_compiling_cuda_version())
-print(get_compiler_version())
-
-
-# import other modules
-import copy
-import submodlib
-from talisman.strategies.active_learning_utils.compute_kernel import compute_imageImage_kernel, compute_queryImage_kernel, compute_queryQuery_kernel
-from talisman.strategies.active_learning_utils.custom_dataset import build_dataset_with_indices, create_custom_dataset, get_class_statistics, prepare_val_file
-from talisman.strategies.active_learning_utils.extract_features import get_query_RoI_features, get_unlabelled_RoI_features, get_unlabelled_top_k_RoI_features
-from talisman.strategies.active_learning_utils.utils import execute
-
-# import mmcv functionalities
-from mmcv import Config
-from mmdet.apis import init_detector
-from mmdet.datasets import build_dataloader, build_dataset
-from mmdet.datasets.dataset_wrappers import RepeatDataset
-
-
-def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq, train_step):
     task_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -97,27 +71,15 @@ def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoc
 
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
         images = list(image.to(device) for image in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        task_losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
     return metric_logger
 
@@ -221,6 +183,8 @@ def get_unlabeledset(unlabeled_loader, task_model):
     return unlabeledset_np
 
 def dist_cal(unlabeled_embeddings):
+    # only the diversity selection needs scipy
+    from scipy.spatial.distance import pdist, squareform
     print("size of the unlabeled embeddings before calculating the distance: ", unlabeled_embeddings.shape)
     dist_mat = squareform(pdist(unlabeled_embeddings, metric="cosine"))
     return dist_mat
@@ -259,6 +223,7 @@ def main(args):
     torch.manual_seed(0)
     torch.cuda.manual_seed(0)
     torch.cuda.manual_seed_all(0)
+    print(torch.__version__, torch.cuda.is_available())
     print(args)
 
     device = torch.device(args.device)
@@ -363,6 +328,7 @@ def main(args):
             continue
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
         task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
                                                                  gamma=args.lr_gamma)
 
@@ -376,7 +342,8 @@ def main(args):
         print("Start training")
         start_time = time.time()
         for epoch in range(args.start_epoch, args.total_epochs):
-            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq)
+            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq,
+                            train_step)
             task_lr_scheduler.step()
             # evaluate after pre-set epoch
             if (epoch + 1) == args.total_epochs:
@@ -459,6 +426,10 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 19], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',
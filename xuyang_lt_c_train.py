@@ -39,11 +39,9 @@ import torch.optim as optim
 from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
 from torch.utils.data.sampler import SubsetRandomSampler
-from torchmetrics.functional import pairwise_cosine_similarity
 from torch._C import device
 import torch.nn as nn
 import torch.nn.functional as F
-print(torch.__version__, torch.cuda.is_available())
 
 
 from detection.frcnn_la import fasterrcnn_resnet50_fpn_feature
@@ -54,36 +52,13 @@ from detection.engine import coco_evaluate, voc_evaluate
 from detection import utils
 from detection import transforms as T
 from detection.train import *
+from detection.train_step import TrainStep
+from detection.acquisition import diversity_select, localization_tightness, pooled_fpn_features
 
 from ll4al.data.sampler import SubsetSequentialSampler
 import pickle
 
 
-# Check MMDetection installation
-import mmdet
-print(mmdet.__version__)
-
-# Check mmcv installation
-from mmcv.ops import get_compiling_cuda_version, get_compiler_version
-print(get_compiling_cuda_version())
-print(get_compiler_version())
-
-
-# import other modules
-import copy
-import submodlib
-from talisman.strategies.active_learning_utils.compute_kernel import compute_imageImage_kernel, compute_queryImage_kernel, compute_queryQuery_kernel
-from talisman.strategies.active_learning_utils.custom_dataset import build_dataset_with_indices, create_custom_dataset, get_class_statistics, prepare_val_file
-from talisman.strategies.active_learning_utils.extract_features import get_query_RoI_features, get_unlabelled_RoI_features, get_unlabelled_top_k_RoI_features
-from talisman.strategies.active_learning_utils.utils import execute
-
-# import mmcv functionalities
-from mmcv import Config
-from mmdet.apis import init_detector
-from mmdet.datasets import build_dataloader, build_dataset
-from mmdet.datasets.dataset_wrappers import RepeatDataset
-
-
 def get_dataset(name, image_set, transform, data_path):
     paths = {
         "coco": (data_path, get_coco, 91),
@@ -105,9 +80,9 @@ def get_transform(train):
     return T.Compose(transforms)
     
 
-def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq):
+def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, print_freq, train_step):
     task_model.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", deferred=True)
     metric_logger.add_meter('task_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Cycle:[{}] Epoch: [{}]'.format(cycle, epoch)
 
@@ -119,27 +94,15 @@ def train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoc
 
         task_lr_scheduler = utils.warmup_lr_scheduler(task_optimizer, warmup_iters, warmup_factor)
 
+    train_step.start_epoch(metric_logger, print_freq, len(data_loader), [task_lr_scheduler])
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
         images = list(image.to(device) for image in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        task_loss_dict = task_model(images, targets)
-        task_losses = sum(loss for loss in task_loss_dict.values())
-        # reduce losses over all GPUs for logging purposes
-        task_loss_dict_reduced = utils.reduce_dict(task_loss_dict)
-        task_losses_reduced = sum(loss.cpu() for loss in task_loss_dict_reduced.values())
-        task_loss_value = task_losses_reduced.item()
-        if not math.isfinite(task_loss_value):
-            print("Loss is {}, stopping training".format(task_loss_value))
-            print(task_loss_dict_reduced)
-            sys.exit(1)
-
-        task_optimizer.zero_grad()
-        task_losses.backward()
-        task_optimizer.step()
-        if task_lr_scheduler is not None:
-            task_lr_scheduler.step()
-        metric_logger.update(task_loss=task_losses_reduced)
+        with train_step.autocast():
+            task_loss_dict = task_model(images, targets)
+            task_losses = sum(loss for loss in task_loss_dict.values())
+        # reduction over GPUs and the finiteness check happen every print_freq iterations
+        train_step(task_losses, task_loss=task_losses)
         metric_logger.update(task_lr=task_optimizer.param_groups[0]["lr"])
     return metric_logger
 
@@ -158,61 +121,34 @@ def calcu_iou(A, B):
     return iner_area / (Aarea + Barea - iner_area)
 
 
-def get_uncertainty(task_model, unlabeled_loader):
+def get_uncertainty(task_model, unlabeled_loader, quality_xi=0.5, with_embeddings=False):
+    """Uncertainties as a tensor on the model's device, with ``with_embeddings`` also the image embeddings."""
     task_model.eval()
-    uncertainties = []
-
-    with torch.no_grad():
-        for images, labels in unlabeled_loader:
-            images = list(img.cuda() for img in images)
-            torch.cuda.synchronize()
-            outputs = task_model(images)
-            for output in outputs:
-                uncertainty = 1.0
-                for box, prop, prob_max in zip(output['boxes'], output['props'], output['prob_max']):
-                    iou = calcu_iou(box, prop)
-                    quality = torch.pow(prob_max, quality_xi) * torch.pow(iou, 1. - quality_xi)
-                    u = torch.abs(1.0 - quality)
-                    uncertainty = min(uncertainty, u.item())
-                uncertainties.append(uncertainty)
-    return uncertainties
-
-
-
-def dist_cal(unlabeled_embeddings):
-  # dist_mat = torch.cdist(unlabeled_embeddings,unlabeled_embeddings,p=2)
-  dist_mat = pairwise_cosine_similarity(unlabeled_embeddings,unlabeled_embeddings)
-  return 1-dist_mat
-
-
-def knei_dist(interd,fetch):
-  num_nei = round(interd.shape[0]/fetch)
-  knei_dist = []
-  for i in range(interd.shape[0]):
-    temp_dist = torch.sort(interd[i][:]).values
-    knei_dist.append(torch.mean(temp_dist[:num_nei]))
-  dth = torch.mean(torch.tensor(knei_dist)) 
-  return dth
-
-def diversity_select(fetchsize, embedding_unlabeled, bs, uncertainty_score):
-  # embedding_unlabeled = self.get_embedding(self.unlabeled_dataset)
-  idx = []
-  nb = round(embedding_unlabeled.shape[0]/bs)
-  for b in range(nb):
-    embedding_unlabeled_batch = embedding_unlabeled[b*bs:(b+1)*bs][:]
-    interd = dist_cal(embedding_unlabeled_batch)
-    dth = knei_dist(interd, round(fetchsize/nb))
-    # print(dth)
-    priority = torch.exp(-uncertainty_score)
-    # print(priority)
-    for i in range(round(fetchsize/nb)):
-      top_idx = torch.argmax(priority).item()
-      idx.append(top_idx)
-      neighbordist = interd[top_idx][:]
-      neighboridx = torch.where(neighbordist <= dth)[0]
-      priority[top_idx] = priority[top_idx] / (1 + 20*torch.sum(priority[neighboridx]))  
-      priority[neighboridx] = priority[neighboridx] / (1 + 20*torch.sum(priority[neighboridx]))
-  return idx
+    batch_sampler = unlabeled_loader.batch_sampler
+    num_images = len(batch_sampler.sampler) if batch_sampler is not None else len(unlabeled_loader.dataset)
+    device = next(task_model.parameters()).device
+    uncertainties = torch.empty(num_images, device=device)
+    embeddings = []
+
+    def keep_embeddings(module, inputs, output):
+        embeddings.append(pooled_fpn_features(output))
+
+    handle = task_model.backbone.register_forward_hook(keep_embeddings) if with_embeddings else None
+    start = 0
+    try:
+        with torch.no_grad():
+            for images, labels in unlabeled_loader:
+                images = list(img.cuda(non_blocking=True) for img in images)
+                outputs = task_model(images)
+                uncertainties[start:start + len(outputs)] = localization_tightness(outputs, quality_xi)
+                start += len(outputs)
+    finally:
+        if handle is not None:
+            handle.remove()
+    if with_embeddings:
+        return uncertainties[:start], torch.cat(embeddings)
+    return uncertainties[:start]
+
 
 def main(args):
     torch.cuda.set_device(0)
@@ -220,6 +156,7 @@ def main(args):
     torch.manual_seed(0)
     torch.cuda.manual_seed(0)
     torch.cuda.manual_seed_all(0)
+    print(torch.__version__, torch.cuda.is_available())
     print(args)
 
     device = torch.device(args.device)
@@ -284,24 +221,24 @@ def main(args):
                                         sampler=SubsetSequentialSampler(labeled_set), num_workers=args.workers,
                                         # more convenient if we maintain the order of subset
                                         pin_memory=True, collate_fn=utils.collate_fn)
-            u = get_uncertainty(task_model, labeled_loader)
+            u = get_uncertainty(task_model, labeled_loader, args.quality_xi)
             with open("vis/ltc_labeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                       "wb") as fp:  # Pickling
-                pickle.dump(u, fp)
+                pickle.dump(u.tolist(), fp)
             unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
                                           num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-            uncertainty = get_uncertainty(task_model, unlabeled_loader)
-            arg = np.argsort(uncertainty)
+            uncertainty, embeddings = get_uncertainty(task_model, unlabeled_loader, args.quality_xi, True)
+            arg = np.argsort(uncertainty.cpu().numpy())
             with open("vis/ltc_unlabeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                       "wb") as fp:  # Pickling
-                pickle.dump(torch.tensor(uncertainty)[arg][:budget_num].numpy(), fp)
+                pickle.dump(uncertainty.cpu()[arg][:budget_num].numpy(), fp)
             
             # Diversity Exploration Computation
             batch_size = 500
-            query_idx = diversity_select(budget_num, subset, batch_size, uncertainty)
+            query_idx = diversity_select(budget_num, embeddings, batch_size, uncertainty, ids=subset)
             
             # Update the labeled dataset and the unlabeled dataset, respectively
-            labeled_set += list(torch.tensor(subset)[query_idx].numpy())
+            labeled_set += query_idx
 
             # labeled_set += list(torch.tensor(subset)[arg][:budget_num].numpy())
             
@@ -315,6 +252,7 @@ def main(args):
             continue
         params = [p for p in task_model.parameters() if p.requires_grad]
         task_optimizer = torch.optim.SGD(params, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+        train_step = TrainStep(task_optimizer, device, args.amp, args.accumulation_steps)
         task_lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(task_optimizer, milestones=args.lr_steps,
                                                                  gamma=args.lr_gamma)
 
@@ -328,7 +266,8 @@ def main(args):
         print("Start training")
         start_time = time.time()
         for epoch in range(args.start_epoch, args.total_epochs):
-            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq)
+            train_one_epoch(task_model, task_optimizer, data_loader, device, cycle, epoch, args.print_freq,
+                            train_step)
             task_lr_scheduler.step()
             # evaluate after pre-set epoch
             if (epoch + 1) == args.total_epochs:
@@ -349,23 +288,23 @@ def main(args):
                                     sampler=SubsetSequentialSampler(labeled_set), num_workers=args.workers,
                                     # more convenient if we maintain the order of subset
                                     pin_memory=True, collate_fn=utils.collate_fn)
-        u = get_uncertainty(task_model, labeled_loader)
+        u = get_uncertainty(task_model, labeled_loader, args.quality_xi)
         with open("/content/CALD/vis/ltc_labeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                   "wb") as fp:  # Pickling
-            pickle.dump(u, fp)
+            pickle.dump(u.tolist(), fp)
         unlabeled_loader = DataLoader(dataset, batch_size=1, sampler=SubsetSequentialSampler(subset),
                                       num_workers=args.workers, pin_memory=True, collate_fn=utils.collate_fn)
-        uncertainty = get_uncertainty(task_model, unlabeled_loader)
-        arg = np.argsort(uncertainty)
+        uncertainty, embeddings = get_uncertainty(task_model, unlabeled_loader, args.quality_xi, True)
+        arg = np.argsort(uncertainty.cpu().numpy())
         with open("vis/ltc_unlabeled_metric_{}_{}_{}.pkl".format(args.model, args.dataset, cycle),
                   "wb") as fp:  # Pickling
-            pickle.dump(torch.tensor(uncertainty)[arg][:budget_num].numpy(), fp)
+            pickle.dump(uncertainty.cpu()[arg][:budget_num].numpy(), fp)
         
         # Diversity Exploration Computation
         batch_size = 500
-        query_idx = diversity_select(budget_num, subset, batch_size, uncertainty)            
+        query_idx = diversity_select(budget_num, embeddings, batch_size, uncertainty, ids=subset)
         # Update the labeled dataset and the unlabeled dataset, respectively
-        labeled_set += list(torch.tensor(subset)[query_idx].numpy())
+        labeled_set += query_idx
         
         # Update the labeled dataset and the unlabeled dataset, respectively
         #labeled_set += list(torch.tensor(subset)[arg][:budget_num].numpy())
@@ -416,6 +355,12 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[16, 22], nargs='+', type=int, help='decrease lr every step-size epochs')
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
     parser.add_argument('--print-freq', default=1000, type=int, help='print frequency')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        help='train with automatic mixed precision (fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
+    parser.add_argument('--quality-xi', default=0.5, type=float,
+                        help='weight of the classification confidence against the box/proposal IoU in the quality')
     parser.add_argument('--output-dir', default=None, help='path where to save')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('-rp', '--results-path', default='results',